@@ -0,0 +1,81 @@
+import re
+import timeit
+
+import bleach
+
+from models import MessageCreate, PatrolCreate
+from security import ALLOWED_HTML_ATTRS, ALLOWED_HTML_TAGS, sanitize_dict, sanitize_input, sanitize_model
+
+ROUNDS = 20000
+
+PLAIN_MESSAGE = "Reached checkpoint 4, road clear, moving to sector B at 14:20"
+SUSPICIOUS_MESSAGE = "<script>alert(1)</script> need backup {$where: 1} & supplies"
+
+PATROL = {
+    'name': 'Alpha Team',
+    'camp_name': 'Camp Ramu',
+    'unit': '10th Infantry Division',
+    'leader_email': 'leader@example.com',
+    'phone_number': '+8801700000000',
+    'assigned_area': 'Sector 7, north ridge',
+    'soldier_ids': ['S-001', 'S-002', 'S-003', 'S-004'],
+    'hq_id': 'HQ-4C3E5D0B',
+}
+
+
+def legacy_sanitize_input(text: str) -> str:
+    """The pre-tiering implementation: bleach on every string"""
+    if not text:
+        return text
+    cleaned = bleach.clean(text, tags=ALLOWED_HTML_TAGS, attributes=ALLOWED_HTML_ATTRS, strip=True)
+    cleaned = re.sub(r'[\$\{\}]', '', cleaned)
+    return cleaned[:10000]
+
+
+def legacy_sanitize_dict(data: dict) -> dict:
+    return {
+        key: legacy_sanitize_input(value) if isinstance(value, str)
+        else [legacy_sanitize_input(v) if isinstance(v, str) else v for v in value] if isinstance(value, list)
+        else value
+        for key, value in data.items()
+    }
+
+
+def bench(label: str, func) -> float:
+    seconds = min(timeit.repeat(func, number=ROUNDS, repeat=3))
+    per_call_us = seconds / ROUNDS * 1e6
+    print(f"  {label:<40} {per_call_us:8.2f} µs/call")
+    return per_call_us
+
+
+def run_benchmarks():
+    """Compare legacy, tiered and schema-driven sanitization on typical payloads"""
+    assert sanitize_input(PLAIN_MESSAGE) == legacy_sanitize_input(PLAIN_MESSAGE)
+    assert sanitize_input(SUSPICIOUS_MESSAGE) == legacy_sanitize_input(SUSPICIOUS_MESSAGE)
+
+    print("Plain-text message:")
+    legacy = bench("legacy sanitize_input", lambda: legacy_sanitize_input(PLAIN_MESSAGE))
+    tiered = bench("tiered sanitize_input", lambda: sanitize_input(PLAIN_MESSAGE))
+    print(f"  speedup x{legacy / tiered:.1f}")
+
+    print("Suspicious message (bleach path):")
+    bench("legacy sanitize_input", lambda: legacy_sanitize_input(SUSPICIOUS_MESSAGE))
+    bench("tiered sanitize_input", lambda: sanitize_input(SUSPICIOUS_MESSAGE))
+
+    message = MessageCreate(content=PLAIN_MESSAGE)
+    print("MessageCreate:")
+    legacy = bench("legacy sanitize_dict", lambda: legacy_sanitize_dict(message.model_dump()))
+    bench("tiered sanitize_dict", lambda: sanitize_dict(message.model_dump()))
+    schema = bench("sanitize_model", lambda: sanitize_model(message))
+    print(f"  speedup x{legacy / schema:.1f}")
+
+    patrol = PatrolCreate(**PATROL)
+    print("PatrolCreate:")
+    legacy = bench("legacy sanitize_dict", lambda: legacy_sanitize_dict(patrol.model_dump()))
+    bench("tiered sanitize_dict", lambda: sanitize_dict(patrol.model_dump()))
+    schema = bench("sanitize_model", lambda: sanitize_model(patrol))
+    print(f"  speedup x{legacy / schema:.1f}")
+
+
+if __name__ == "__main__":
+    run_benchmarks()
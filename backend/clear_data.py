@@ -21,6 +21,9 @@ async def clear_all_data():
     await db.trails.delete_many({})
     print("✓ Cleared trails")
     
+    await db.trail_points.delete_many({})
+    print("✓ Cleared trail points")
+    
     await db.access_codes.delete_many({})
     print("✓ Cleared access codes")
     
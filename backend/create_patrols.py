@@ -75,6 +75,7 @@ async def clear_and_create_patrols():
     await db.patrols.delete_many({})
     await db.locations.delete_many({})
     await db.trails.delete_many({})
+    await db.trail_points.delete_many({})
     print("✓ Cleared existing data")
     
     print(f"\nCreating 229 patrols...")
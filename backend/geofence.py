@@ -0,0 +1,354 @@
+"""
+Geofence Engine
+Checks every location the bridge flushes against the polygons of the
+uploaded KML layers. Polygons are held in a shapely STRtree, so one flush is
+a single vectorized point-in-polygon query however many patrols and areas
+there are.
+
+Per patrol the engine keeps the set of areas it is inside and whether it is
+outside its assigned area, and raises enter / exit / out_of_area /
+back_in_area events only when that state changes. The state is also stored
+on the patrol document and replaced with a compare-and-set, so when shared
+subscriptions spread a patrol's fixes over several workers each transition
+is still raised once. The stored state carries the time of the fix it was
+computed from, and only a newer fix may replace it, so a delayed fix handled
+by another worker cannot undo a later transition.
+
+Fences come from the KML sources recorded by the layer store, each scoped to
+the HQ that uploaded it, and are reloaded every GEOFENCE_REFRESH_SECONDS.
+
+A patrol's assigned area (assigned_area, else camp_name) is matched to
+polygons by name, ignoring case and generic words: "Patiya" matches the
+"Patiya Army Camp" polygon.
+"""
+import asyncio
+import os
+import re
+import time
+from typing import Dict, List, Optional, Set
+
+import numpy as np
+import orjson
+import shapely
+from pymongo import ReturnDocument
+from shapely.geometry import shape
+
+from kml_layers import KML_LAYER_SOURCES, artifact_path
+from kml_parser import parse_kml
+from patrol_cache import patrol_cache
+from trail_store import parse_timestamp
+
+GEOFENCE_STATE_FIELD = 'geofence'
+# Local state older than this is re-checked against the stored state (other workers' transitions)
+GEOFENCE_SYNC_SECONDS = float(os.environ.get('GEOFENCE_SYNC_SECONDS', '30'))
+# How often the fences are reloaded from kml_layer_sources (uploads and deletions on other workers)
+GEOFENCE_REFRESH_SECONDS = float(os.environ.get('GEOFENCE_REFRESH_SECONDS', '60'))
+
+_AREA_STOPWORDS = {'army', 'camp', 'aor', 'area', 'the'}
+
+
+def area_key(name: Optional[str]) -> Optional[str]:
+    """'Patiya Army Camp' -> 'patiya'; used to match assigned areas to polygon names"""
+    words = [w for w in re.findall(r'[a-z0-9]+', (name or '').lower()) if w not in _AREA_STOPWORDS]
+    return ' '.join(words) or None
+
+
+class Fence:
+    __slots__ = ('id', 'name', 'folder', 'hq_id', 'source_id', 'key', 'geometry')
+
+    def __init__(self, fence_id: str, name: Optional[str], folder: Optional[str], hq_id: Optional[str],
+                 source_id: str, geometry):
+        self.id = fence_id
+        self.name = name
+        self.folder = folder
+        self.hq_id = hq_id  # None: applies to every HQ
+        self.source_id = source_id
+        self.key = area_key(name)
+        self.geometry = geometry
+
+
+class _PatrolFences:
+    __slots__ = ('inside', 'out_of_area', 'synced_at')
+
+    def __init__(self, inside: List[str], out_of_area: Optional[bool], synced_at: float):
+        self.inside = inside
+        self.out_of_area = out_of_area
+        self.synced_at = synced_at
+
+
+class GeofenceEngine:
+    """STRtree over KML polygons plus per-patrol inside/outside state; runs on the event loop"""
+
+    def __init__(self):
+        self._sources: Dict[str, List[Fence]] = {}
+        self._fences: List[Fence] = []
+        self._by_id: Dict[str, Fence] = {}
+        self._tree: Optional[shapely.STRtree] = None
+        self._by_area: Dict[str, List[Fence]] = {}
+        self._state: Dict[str, _PatrolFences] = {}
+        self._loaded: Dict[str, Optional[str]] = {}  # source_id -> updated_at it was loaded at
+        self._task: Optional[asyncio.Task] = None
+
+        self.checks = 0
+        self.transitions = 0
+        self.events = 0
+        self.conflicts = 0
+        self.errors = 0
+
+    def _rebuild(self) -> None:
+        self._fences = [fence for fences in self._sources.values() for fence in fences]
+        self._by_id = {f.id: f for f in self._fences}
+        self._tree = shapely.STRtree([f.geometry for f in self._fences]) if self._fences else None
+        self._by_area = {}
+        for fence in self._fences:
+            if fence.key:
+                self._by_area.setdefault(fence.key, []).append(fence)
+
+    def load_features(self, source_id: str, features: List[dict], hq_id: Optional[str] = None) -> int:
+        """Replace a source's fences with the (Multi)Polygon features of a GeoJSON collection"""
+        fences = []
+        for index, feature in enumerate(features):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+                continue
+            polygon = shape(geometry)
+            if not polygon.is_valid:
+                polygon = shapely.make_valid(polygon)
+            shapely.prepare(polygon)
+            properties = feature.get('properties') or {}
+            fences.append(Fence(f"{source_id}:{index}", properties.get('name'), properties.get('folder'),
+                                hq_id, source_id, polygon))
+        self._sources[source_id] = fences
+        self._rebuild()
+        return len(fences)
+
+    def load_kml(self, source_id: str, data: bytes, hq_id: Optional[str] = None) -> int:
+        """Load (or reload) an uploaded KML/KMZ; call from the upload handler"""
+        return self.load_features(source_id, parse_kml(data)['features'], hq_id)
+
+    def remove_source(self, source_id: str) -> None:
+        """Drop a deleted KML's fences"""
+        if self._sources.pop(source_id, None) is not None:
+            self._rebuild()
+
+    @staticmethod
+    def _read_layers(manifest: dict) -> List[dict]:
+        """Features of a source's converted layers (blocking file reads)"""
+        features = []
+        for layer in manifest.get('layers') or ():
+            features.extend(orjson.loads(artifact_path(layer['id']).read_bytes())['features'])
+        return features
+
+    async def load_sources(self, db) -> int:
+        """
+        Load the uploaded KML sources from the layer store with their HQ, and
+        drop fences of deleted ones. URL sources are map overlays fetched on
+        request, not geofences. A source that fails to load is skipped and
+        retried on the next refresh.
+        """
+        sources = await db[KML_LAYER_SOURCES].find(
+            {'url': {'$exists': False}},
+            {'_id': 0, 'source_id': 1, 'hq_id': 1, 'manifest': 1, 'updated_at': 1}
+        ).to_list(None)
+
+        seen = set()
+        for source in sources:
+            source_id = source['source_id']
+            seen.add(source_id)
+            if source_id in self._loaded and self._loaded[source_id] == source.get('updated_at'):
+                continue
+            try:
+                features = await asyncio.to_thread(self._read_layers, source.get('manifest') or {})
+                self.load_features(source_id, features, source.get('hq_id'))
+            except Exception as e:
+                self.errors += 1
+                print(f"Skipping geofence source {source_id}: {e}")
+                continue
+            self._loaded[source_id] = source.get('updated_at')
+
+        for source_id in set(self._sources) - seen:
+            self._loaded.pop(source_id, None)
+            self.remove_source(source_id)
+        return len(self._fences)
+
+    async def _run(self, db) -> None:
+        while True:
+            await asyncio.sleep(GEOFENCE_REFRESH_SECONDS)
+            try:
+                await self.load_sources(db)
+            except Exception as e:
+                print(f"Failed to refresh geofence sources: {e}")
+
+    async def start(self, db) -> int:
+        """Load the fences and keep them refreshed (call from the event loop); returns the fence count"""
+        if self._task is not None:
+            return len(self._fences)
+        loaded = await self.load_sources(db)
+        self._task = asyncio.get_running_loop().create_task(self._run(db))
+        return loaded
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def locate(self, points: List[tuple]) -> List[Set[int]]:
+        """Indexes (into the current fence list) of the fences containing each (lat, lng)"""
+        result: List[Set[int]] = [set() for _ in points]
+        if self._tree is None or not points:
+            return result
+        coords = np.array([(lng, lat) for lat, lng in points], dtype=float)
+        point_idx, fence_idx = self._tree.query(shapely.points(coords), predicate='within')
+        for p, f in zip(point_idx.tolist(), fence_idx.tolist()):
+            result[p].add(f)
+        return result
+
+    def _assigned(self, meta: dict, hq_id: Optional[str]) -> List[Fence]:
+        key = area_key(meta.get('assigned_area') or meta.get('camp_name'))
+        return [f for f in self._by_area.get(key, ()) if f.hq_id in (None, hq_id)]
+
+    async def process(self, db, updates: List[dict]) -> List[dict]:
+        """Check the latest point of each flushed patrol; returns the events raised"""
+        if self._tree is None or not updates:
+            return []
+        self.checks += len(updates)
+        patrols = await patrol_cache.get_many(db, {u['patrol_id'] for u in updates})
+        located = self.locate([(u['latitude'], u['longitude']) for u in updates])
+
+        now = time.monotonic()
+        changed = []
+        for update, fence_idx in zip(updates, located):
+            meta = patrols.get(update['patrol_id'])
+            if meta is None:
+                continue
+            hq_id = update.get('hq_id') or meta.get('hq_id')
+            inside = sorted(self._fences[i].id for i in fence_idx if self._fences[i].hq_id in (None, hq_id))
+            assigned = self._assigned(meta, hq_id)
+            out_of_area = not any(f.id in inside for f in assigned) if assigned else None
+
+            state = self._state.get(update['patrol_id'])
+            if (state is not None and state.inside == inside and state.out_of_area == out_of_area
+                    and now - state.synced_at < GEOFENCE_SYNC_SECONDS):
+                continue
+            changed.append((update, meta, hq_id, inside, out_of_area))
+
+        if not changed:
+            return []
+        results = await asyncio.gather(
+            *(self._commit(db, *args) for args in changed), return_exceptions=True
+        )
+        events = []
+        for result in results:
+            if isinstance(result, Exception):
+                self.errors += 1
+                print(f"Geofence state update failed: {result}")
+            else:
+                events.extend(result)
+        self.events += len(events)
+        return events
+
+    async def _commit(self, db, update: dict, meta: dict, hq_id: Optional[str],
+                      inside: List[str], out_of_area: Optional[bool]) -> List[dict]:
+        """
+        Compare-and-set the stored state: only a fix newer than the one the
+        stored state was computed from may replace it. Events are the diff
+        against what was stored.
+        """
+        patrol_id = update['patrol_id']
+        at = parse_timestamp(update['timestamp'])
+        previous = await db.patrols.find_one_and_update(
+            {'id': patrol_id, f"{GEOFENCE_STATE_FIELD}.at": {'$not': {'$gte': at}}},
+            {'$set': {GEOFENCE_STATE_FIELD: {'inside': inside, 'out_of_area': out_of_area, 'at': at}}},
+            projection={'_id': 0, GEOFENCE_STATE_FIELD: 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if previous is None:
+            # A newer fix is already recorded (by another worker): adopt its state
+            self.conflicts += 1
+            current = await db.patrols.find_one({'id': patrol_id}, {'_id': 0, GEOFENCE_STATE_FIELD: 1})
+            stored = (current or {}).get(GEOFENCE_STATE_FIELD)
+            if stored:
+                self._state[patrol_id] = _PatrolFences(stored.get('inside') or [], stored.get('out_of_area'),
+                                                       time.monotonic())
+            return []
+        self._state[patrol_id] = _PatrolFences(inside, out_of_area, time.monotonic())
+
+        stored = previous.get(GEOFENCE_STATE_FIELD)
+        if stored and (stored.get('inside') or []) == inside and stored.get('out_of_area') == out_of_area:
+            return []  # Same areas; only the fix time moved on
+        self.transitions += 1
+
+        fences = self._by_id
+
+        def event(kind: str, fence: Optional[Fence], area: Optional[str] = None) -> dict:
+            return {
+                'event': kind,
+                'patrol_id': patrol_id,
+                'patrol_name': meta.get('name'),
+                'hq_id': hq_id,
+                'fence_id': fence.id if fence else None,
+                'fence_name': (fence.name or fence.folder) if fence else area,
+                'folder': fence.folder if fence else None,
+                'latitude': update['latitude'],
+                'longitude': update['longitude'],
+                'timestamp': update['timestamp'],
+            }
+
+        area = meta.get('assigned_area') or meta.get('camp_name')
+        if stored is None:
+            # First fix seen by the engine: baseline silently, except for being out of area
+            return [event('out_of_area', None, area)] if out_of_area else []
+
+        events = []
+        before = set(stored.get('inside') or [])
+        for fence_id in sorted(set(inside) - before):
+            events.append(event('enter', fences.get(fence_id)))
+        for fence_id in sorted(before - set(inside)):
+            if fence_id in fences:  # Fences from a removed KML do not raise exits
+                events.append(event('exit', fences[fence_id]))
+        was_out = stored.get('out_of_area')
+        if out_of_area is not None and was_out is not None and out_of_area != was_out:
+            events.append(event('out_of_area' if out_of_area else 'back_in_area', None, area))
+        elif out_of_area and was_out is None:
+            events.append(event('out_of_area', None, area))
+        return events
+
+    def forget(self, patrol_id: str) -> None:
+        self._state.pop(patrol_id, None)
+
+    def stats(self) -> dict:
+        return {
+            'sources': len(self._sources),
+            'fences': len(self._fences),
+            'tracked_patrols': len(self._state),
+            'checks': self.checks,
+            'transitions': self.transitions,
+            'events': self.events,
+            'conflicts': self.conflicts,
+            'errors': self.errors,
+        }
+
+
+def event_message(event: dict) -> str:
+    """Human-readable notification text"""
+    patrol = event.get('patrol_name') or event['patrol_id']
+    area = event.get('fence_name') or 'unnamed area'
+    return {
+        'enter': f"{patrol} entered {area}",
+        'exit': f"{patrol} left {area}",
+        'out_of_area': f"{patrol} is outside assigned area {area}",
+        'back_in_area': f"{patrol} returned to assigned area {area}",
+    }[event['event']]
+
+
+def geofence_notification_id(event: dict) -> str:
+    """Same transition -> same id, so a redelivered flush cannot notify twice"""
+    return f"GEOFENCE_{event['patrol_id']}_{event['event']}_{event.get('fence_id') or 'area'}_{event['timestamp']}"
+
+
+geofence_engine = GeofenceEngine()
@@ -0,0 +1,321 @@
+"""
+Inactivity SOS Monitor
+Server-side replacement for polling /api/inactivity/check. Every tracked
+patrol has a deadline of last_location_time + its HQ's threshold_minutes in
+a min-heap; one task sleeps until the earliest deadline and raises an
+auto-triggered SOS when a patrol misses it.
+
+Ingest calls touch() with each flush. That only moves the patrol's
+last-seen time: the heap entry is checked when it comes due and pushed
+again at the real deadline if the patrol reported since. The heap stays at
+about one entry per patrol and an update costs O(1), a reschedule O(log n).
+
+The alert is upserted on a deterministic id (patrol + last_location_time),
+so it is raised once per silence even when several workers watch the same
+patrol. A newer fix re-arms the patrol. A check that fails (database
+unreachable) keeps the watch and retries it with a growing backoff.
+"""
+import asyncio
+import heapq
+import os
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pymongo.errors import DuplicateKeyError
+
+import trail_store
+from models import InactivityConfig, SOSAlert
+
+INACTIVITY_CONFIG_COLLECTION = 'inactivity_config'
+INACTIVITY_CONFIG_REFRESH_SECONDS = float(os.environ.get('INACTIVITY_CONFIG_REFRESH_SECONDS', '60'))
+INACTIVITY_RETRY_SECONDS = float(os.environ.get('INACTIVITY_RETRY_SECONDS', '5'))
+INACTIVITY_RETRY_MAX_SECONDS = float(os.environ.get('INACTIVITY_RETRY_MAX_SECONDS', '300'))
+
+DEFAULT_CONFIG = InactivityConfig(hq_id='')
+
+AlertHandler = Callable[..., Awaitable[None]]
+
+
+async def ensure_inactivity_indexes(db) -> None:
+    """Unique ids on auto-triggered alerts make the insert idempotent across workers"""
+    try:
+        await db.sos_alerts.create_index(
+            'id', unique=True, name='auto_sos_id',
+            partialFilterExpression={'auto_triggered': True}
+        )
+    except Exception as e:
+        print(f"Could not create unique auto SOS index (duplicate ids?): {e}")
+
+
+def auto_sos_id(patrol_id: str, last_seen: float) -> str:
+    return f"AUTO_SOS_{patrol_id}_{int(last_seen)}"
+
+
+class _Watch:
+    __slots__ = ('hq_id', 'last_seen', 'scheduled', 'failures')
+
+    def __init__(self, hq_id: Optional[str], last_seen: float, scheduled: float):
+        self.hq_id = hq_id
+        self.last_seen = last_seen
+        self.scheduled = scheduled  # Deadline of this patrol's live heap entry
+        self.failures = 0           # Consecutive failed checks, for the retry backoff
+
+
+class InactivityMonitor:
+    """Deadline heap over tracked patrols; touch() and set_config() run on the event loop"""
+
+    def __init__(self):
+        self._watches: Dict[str, _Watch] = {}
+        self._heap: List[Tuple[float, str]] = []
+        self._configs: Dict[str, Tuple[bool, float]] = {}  # hq_id -> (enabled, threshold seconds)
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._configs_loaded_at = 0.0
+        self.db = None
+        self.on_alert: Optional[AlertHandler] = None
+
+        self.touches = 0
+        self.reschedules = 0
+        self.fired = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def _config(self, hq_id: Optional[str]) -> Tuple[bool, float]:
+        return self._configs.get(hq_id) or (DEFAULT_CONFIG.enabled, DEFAULT_CONFIG.threshold_minutes * 60.0)
+
+    def _push(self, patrol_id: str, watch: _Watch, deadline: float) -> None:
+        watch.scheduled = deadline
+        earliest = self._heap[0][0] if self._heap else None
+        heapq.heappush(self._heap, (deadline, patrol_id))
+        if self._wakeup is not None and (earliest is None or deadline < earliest):
+            self._wakeup.set()
+
+    def touch(self, patrol_id: str, hq_id: Optional[str], timestamp) -> None:
+        """Record a fix (or filtered fix) for a patrol; re-arms it after an alert"""
+        self.touches += 1
+        self._watch(patrol_id, hq_id, trail_store.parse_timestamp(timestamp).timestamp())
+
+    def _watch(self, patrol_id: str, hq_id: Optional[str], last_seen: float) -> None:
+        watch = self._watches.get(patrol_id)
+        if watch is None:
+            watch = _Watch(hq_id, last_seen, 0.0)
+            self._watches[patrol_id] = watch
+            self._push(patrol_id, watch, last_seen + self._config(hq_id)[1])
+        elif last_seen > watch.last_seen:
+            watch.last_seen = last_seen
+            watch.hq_id = hq_id or watch.hq_id
+
+    def forget(self, patrol_id: str) -> None:
+        """Stop watching a patrol (tracking stopped / session ended); its heap entry goes stale"""
+        self._watches.pop(patrol_id, None)
+
+    def _settle(self, patrol_id: str, watch: _Watch, checked: float) -> None:
+        """
+        A check of the silence since `checked` is done: stop watching until the
+        next fix, unless one arrived while the check was awaiting the database
+        """
+        if self._watches.get(patrol_id) is not watch:
+            return
+        if watch.last_seen > checked:
+            watch.failures = 0
+            self._push(patrol_id, watch, watch.last_seen + self._config(watch.hq_id)[1])
+        else:
+            self.forget(patrol_id)
+
+    def _retry(self, patrol_id: str, watch: _Watch) -> None:
+        """Keep a watch whose check failed and look again after a backoff"""
+        if self._watches.get(patrol_id) is not watch:
+            return
+        backoff = min(INACTIVITY_RETRY_MAX_SECONDS, INACTIVITY_RETRY_SECONDS * 2 ** watch.failures)
+        watch.failures += 1
+        self._push(patrol_id, watch, time.time() + backoff)
+
+    def set_config(self, hq_id: str, enabled: bool, threshold_minutes: int) -> None:
+        """Apply an HQ's config now (call from the config endpoint); earlier deadlines are pushed immediately"""
+        self._configs[hq_id] = (enabled, threshold_minutes * 60.0)
+        for patrol_id, watch in self._watches.items():
+            if watch.hq_id != hq_id:
+                continue
+            deadline = watch.last_seen + threshold_minutes * 60.0
+            if deadline < watch.scheduled:
+                self._push(patrol_id, watch, deadline)
+
+    async def _load_configs(self) -> None:
+        configs = await self.db[INACTIVITY_CONFIG_COLLECTION].find(
+            {}, {'_id': 0, 'hq_id': 1, 'enabled': 1, 'threshold_minutes': 1}
+        ).to_list(None)
+        self._configs_loaded_at = time.monotonic()
+        for config in configs:
+            enabled = config.get('enabled', DEFAULT_CONFIG.enabled)
+            threshold_minutes = config.get('threshold_minutes', DEFAULT_CONFIG.threshold_minutes)
+            if self._configs.get(config.get('hq_id')) != (enabled, threshold_minutes * 60.0):
+                self.set_config(config.get('hq_id'), enabled, threshold_minutes)
+
+    async def _seed_watches(self) -> int:
+        """
+        Watch the patrols that were already tracking when this process started, from
+        their stored last fix; a patrol that went silent while no worker was running
+        is due at once
+        """
+        seeded = 0
+        cursor = self.db.patrols.find(
+            {'is_tracking': True, 'last_location_time': {'$ne': None}},
+            {'_id': 0, 'id': 1, 'hq_id': 1, 'last_location_time': 1, 'last_location_at': 1}
+        )
+        async for patrol in cursor:
+            try:
+                last_seen = trail_store.parse_timestamp(
+                    patrol.get('last_location_at') or patrol['last_location_time']
+                ).timestamp()
+            except (TypeError, ValueError):
+                continue
+            self._watch(patrol['id'], patrol.get('hq_id'), last_seen)
+            seeded += 1
+        return seeded
+
+    async def _fire(self, patrol_id: str, watch: _Watch) -> None:
+        """
+        Deadline passed: confirm against the database, then raise the alert once.
+        The watch is only dropped once the check has completed; if it raises,
+        the caller retries it.
+        """
+        last_seen = watch.last_seen
+        patrol = await self.db.patrols.find_one(
+            {'id': patrol_id},
+            {'_id': 0, 'id': 1, 'hq_id': 1, 'name': 1, 'latitude': 1, 'longitude': 1,
+             'last_location_time': 1, 'is_tracking': 1}
+        )
+        if not patrol or not patrol.get('is_tracking'):
+            self._settle(patrol_id, watch, last_seen)
+            self.skipped += 1
+            return
+
+        # Another worker may have ingested newer fixes for this patrol
+        if patrol.get('last_location_time'):
+            stored = trail_store.parse_timestamp(patrol['last_location_time']).timestamp()
+            if stored > watch.last_seen:
+                watch.last_seen = stored
+                watch.failures = 0
+                self._push(patrol_id, watch, stored + self._config(watch.hq_id)[1])
+                self.reschedules += 1
+                return
+
+        if await self.db.sos_alerts.find_one({'patrol_id': patrol_id, 'resolved': False}, {'_id': 1}):
+            self._settle(patrol_id, watch, last_seen)  # Already in SOS; re-armed by the next fix
+            self.skipped += 1
+            return
+
+        now = datetime.now(timezone.utc)
+        inactive_minutes = int((now.timestamp() - last_seen) // 60)
+        message = f"No movement for {inactive_minutes} minutes"
+        alert = SOSAlert(
+            patrol_id=patrol_id,
+            latitude=patrol.get('latitude') or 0.0,
+            longitude=patrol.get('longitude') or 0.0,
+            message=message,
+            timestamp=now,
+            auto_triggered=True
+        ).model_dump()
+        alert.update({
+            'id': auto_sos_id(patrol_id, last_seen),
+            'hq_id': patrol.get('hq_id'),
+            'patrol_name': patrol.get('name'),
+            'inactive_minutes': inactive_minutes,
+            'timestamp': now.isoformat(),
+        })
+        try:
+            result = await self.db.sos_alerts.update_one({'id': alert['id']}, {'$setOnInsert': alert}, upsert=True)
+        except DuplicateKeyError:
+            result = None  # Concurrent upsert from another worker won
+        self._settle(patrol_id, watch, last_seen)
+        if result is None or result.upserted_id is None:
+            self.duplicates += 1  # Raised by another worker
+            return
+
+        self.fired += 1
+        print(f"Auto SOS for {patrol_id}: {message}")
+        if self.on_alert:
+            await self.on_alert(patrol.get('hq_id'), patrol_id, message, alert['latitude'], alert['longitude'],
+                                alert['timestamp'], auto_triggered=True)
+
+    async def _process_due(self) -> None:
+        now = time.time()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, patrol_id = heapq.heappop(self._heap)
+            watch = self._watches.get(patrol_id)
+            if watch is None or watch.scheduled != deadline:
+                continue  # Forgotten, or superseded by an earlier reschedule
+            enabled, threshold = self._config(watch.hq_id)
+            if not enabled:
+                self.forget(patrol_id)
+                continue
+            due = watch.last_seen + threshold
+            if due > now:
+                self._push(patrol_id, watch, due)  # Reported since this entry was pushed
+                self.reschedules += 1
+                continue
+            try:
+                await self._fire(patrol_id, watch)
+            except Exception as e:
+                self.errors += 1
+                self._retry(patrol_id, watch)
+                print(f"Inactivity check failed for {patrol_id}, retrying: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            timeout = INACTIVITY_CONFIG_REFRESH_SECONDS
+            if self._heap:
+                timeout = min(timeout, max(0.0, self._heap[0][0] - time.time()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if time.monotonic() - self._configs_loaded_at >= INACTIVITY_CONFIG_REFRESH_SECONDS:
+                    await self._load_configs()
+            except Exception as e:
+                print(f"Failed to refresh inactivity configs: {e}")
+            await self._process_due()
+
+    async def start(self, db, on_alert: Optional[AlertHandler] = None) -> None:
+        """Load HQ configs, watch tracking patrols and start the deadline task (call from the event loop)"""
+        if self._task is not None:
+            return
+        self.db = db
+        self.on_alert = on_alert
+        await ensure_inactivity_indexes(db)
+        await self._load_configs()
+        seeded = await self._seed_watches()
+        print(f"Inactivity monitor watching {seeded} tracking patrols")
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> dict:
+        next_deadline = self._heap[0][0] if self._heap else None
+        return {
+            'watched': len(self._watches),
+            'heap_size': len(self._heap),
+            'next_deadline_in_seconds': round(next_deadline - time.time(), 1) if next_deadline else None,
+            'touches': self.touches,
+            'reschedules': self.reschedules,
+            'fired': self.fired,
+            'duplicates': self.duplicates,
+            'skipped': self.skipped,
+            'errors': self.errors,
+        }
+
+
+inactivity_monitor = InactivityMonitor()
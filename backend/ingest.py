@@ -0,0 +1,385 @@
+"""
+Batched Location Ingest Pipeline
+Buffers patrol location fixes for a short window, then writes them to MongoDB
+in two round trips: one insert_many into the trail time-series collection and
+one bulk_write of the latest position per patrol
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+
+from inactivity_monitor import inactivity_monitor
+from location_filter import KEEP, LocationFilter
+from patrol_cache import PatrolMetaCache, patrol_cache
+from patrol_geo import geo_point
+from trail_simplify import simplified_trail_cache
+from trail_stats import TRAIL_SESSIONS_COLLECTION, trail_stats
+from trail_store import format_timestamp, insert_points, make_point, parse_timestamp
+
+# Configuration
+INGEST_FLUSH_INTERVAL_MS = int(os.environ.get('INGEST_FLUSH_INTERVAL_MS', '200'))
+INGEST_MAX_BATCH = int(os.environ.get('INGEST_MAX_BATCH', '500'))
+INGEST_MAX_QUEUE = int(os.environ.get('INGEST_MAX_QUEUE', '10000'))
+INGEST_ENQUEUE_TIMEOUT = float(os.environ.get('INGEST_ENQUEUE_TIMEOUT', '2.0'))  # seconds to wait when queue is full
+
+# Session dates follow Bangladesh time (UTC+6)
+BD_OFFSET = timedelta(hours=6)
+
+
+def current_session_date() -> str:
+    """Return today's session date (YYYY-MM-DD) in Bangladesh time"""
+    return (datetime.now(timezone.utc) + BD_OFFSET).strftime('%Y-%m-%d')
+
+
+async def stored_session_dates(db, patrol_ids: Iterable[str]) -> Dict[str, str]:
+    """
+    Session date stored on each patrol document (patrols without one are left
+    out). Read fresh rather than from the patrol cache: /api/verify-code and
+    session resets change it on any worker.
+    """
+    patrol_ids = list(patrol_ids)
+    if not patrol_ids:
+        return {}
+    cursor = db.patrols.find({'id': {'$in': patrol_ids}}, {'_id': 0, 'id': 1, 'session_date': 1})
+    return {doc['id']: doc['session_date'] async for doc in cursor if doc.get('session_date')}
+
+
+class IngestMetrics:
+    """Counters for batch size, flush latency and queue pressure"""
+
+    def __init__(self):
+        self.points_received = 0
+        self.points_written = 0
+        self.points_dropped = 0
+        self.backpressure_waits = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.touch_updates = 0      # filtered fixes that only advanced last_location_time
+        self.broadcasts_saved = 0   # patrols whose flush had nothing new to show
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    def record_flush(self, batch_size: int, elapsed_ms: float) -> None:
+        self.flushes += 1
+        self.points_written += batch_size
+        self.last_batch_size = batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+
+    def snapshot(self, queue_depth: int = 0) -> dict:
+        return {
+            'queue_depth': queue_depth,
+            'points_received': self.points_received,
+            'points_written': self.points_written,
+            'points_dropped': self.points_dropped,
+            'backpressure_waits': self.backpressure_waits,
+            'flushes': self.flushes,
+            'flush_errors': self.flush_errors,
+            'touch_updates': self.touch_updates,
+            'broadcasts_saved': self.broadcasts_saved,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': round(self.points_written / self.flushes, 2) if self.flushes else 0,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.flushes, 2) if self.flushes else 0,
+        }
+
+
+class LocationIngestPipeline:
+    """
+    Bounded buffer between message handlers and MongoDB.
+
+    Points are queued with submit() and flushed every INGEST_FLUSH_INTERVAL_MS
+    or as soon as INGEST_MAX_BATCH points are waiting. When the queue is full,
+    submit() waits (backpressure) and drops the point after INGEST_ENQUEUE_TIMEOUT.
+    """
+
+    def __init__(
+        self,
+        flush_interval_ms: int = INGEST_FLUSH_INTERVAL_MS,
+        max_batch: int = INGEST_MAX_BATCH,
+        max_queue: int = INGEST_MAX_QUEUE,
+        cache: PatrolMetaCache = patrol_cache,
+    ):
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.max_batch = max_batch
+        self.max_queue = max_queue
+        self.cache = cache
+        self.metrics = IngestMetrics()
+        self.filter = LocationFilter()
+
+        self.db = None
+        self.on_flush: Optional[Callable[[List[dict]], Awaitable[None]]] = None
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._batch: List[dict] = []  # Points taken off the queue, not yet handed to flush()
+        self._flushing: Optional[asyncio.Future] = None
+        self._latest: Dict[str, str] = {}  # patrol_id -> newest timestamp written to the patrol document
+
+    def start(self, db, on_flush: Optional[Callable[[List[dict]], Awaitable[None]]] = None) -> None:
+        """Start the background flush task (must be called from the event loop)"""
+        self.db = db
+        self.on_flush = on_flush
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the flush task and write whatever is still buffered, including the batch it held"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushing is not None:
+            # Cancelling _run does not interrupt a flush that was already writing
+            try:
+                await self._flushing
+            except Exception as e:
+                print(f"Error flushing location batch: {e}")
+            self._flushing = None
+
+        remaining, self._batch = self._batch, []
+        while self.queue and not self.queue.empty():
+            remaining.append(self.queue.get_nowait())
+        for i in range(0, len(remaining), self.max_batch):
+            await self.flush(remaining[i:i + self.max_batch])
+
+    async def submit(self, patrol_id: str, latitude: float, longitude: float, timestamp: str,
+                     accuracy: Optional[float] = None, filtered: bool = True) -> bool:
+        """
+        Queue a location fix. Returns False if it was dropped under sustained backpressure.
+        Fixes the jitter filter rejects are queued as touches: they advance
+        last_location_time but are not stored or broadcast. Pass filtered=False for
+        buffered fixes (multi-point batches), which are older than the live reference.
+        """
+        if self.queue is None:
+            raise RuntimeError("Ingest pipeline not started")
+
+        self.metrics.points_received += 1
+        point = {
+            'patrol_id': patrol_id,
+            'latitude': float(latitude),
+            'longitude': float(longitude),
+            'timestamp': format_timestamp(timestamp),
+        }
+        if filtered:
+            if self.filter.check(patrol_id, point['latitude'], point['longitude'], timestamp, accuracy) == KEEP:
+                point['filtered'] = True  # The filter's pending reference until flush() settles it
+            else:
+                point['touch'] = True
+        try:
+            self.queue.put_nowait(point)
+            return True
+        except asyncio.QueueFull:
+            self.metrics.backpressure_waits += 1
+
+        try:
+            await asyncio.wait_for(self.queue.put(point), timeout=INGEST_ENQUEUE_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            self.metrics.points_dropped += 1
+            if point.get('filtered'):
+                self.filter.discard(patrol_id, point['timestamp'])
+            print(f"Ingest queue full, dropped location for {patrol_id}")
+            return False
+
+    async def write_batch(self, points: List[dict]) -> bool:
+        """
+        Write already-validated points immediately, bypassing the queue (offline replay).
+        Returns False if a write failed so the caller can have the client retry.
+        """
+        self.metrics.points_received += len(points)
+        points = [{**p, 'timestamp': format_timestamp(p['timestamp'])} for p in points]
+        written = True
+        for i in range(0, len(points), self.max_batch):
+            written = await self.flush(points[i:i + self.max_batch]) and written
+        return written
+
+    def forget(self, patrol_id: str) -> None:
+        """Drop a patrol's filter reference and latest-position guard, e.g. when its session ends"""
+        self.filter.forget(patrol_id)
+        self._latest.pop(patrol_id, None)
+
+    def stats(self) -> dict:
+        """Current pipeline metrics"""
+        stats = self.metrics.snapshot(self.queue.qsize() if self.queue else 0)
+        stats['filter'] = self.filter.stats()
+        return stats
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch = batch = [await self.queue.get()]
+            deadline = loop.time() + self.flush_interval
+
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            # Shielded: a cancelled _run leaves the write to finish, stop() awaits it
+            self._batch = []
+            self._flushing = asyncio.ensure_future(self.flush(batch))
+            try:
+                await asyncio.shield(self._flushing)
+            except Exception as e:
+                print(f"Error flushing location batch: {e}")
+            self._flushing = None
+
+    async def flush(self, batch: List[dict]) -> bool:
+        """Write a batch of points: one trail insert and one patrol bulk_write per batch"""
+        if not batch:
+            return True
+
+        started = time.perf_counter()
+
+        grouped: Dict[str, List[dict]] = {}
+        touches: Dict[str, str] = {}  # patrol_id -> newest filtered-out fix
+        kept: Dict[str, str] = {}     # patrol_id -> newest fix the filter kept
+        for point in batch:
+            if point.get('filtered') and point['timestamp'] > kept.get(point['patrol_id'], ''):
+                kept[point['patrol_id']] = point['timestamp']
+            if point.get('touch'):
+                if point['timestamp'] > touches.get(point['patrol_id'], ''):
+                    touches[point['patrol_id']] = point['timestamp']
+                continue
+            grouped.setdefault(point['patrol_id'], []).append(point)
+
+        # Metadata is served from the cache (only unseen patrols cost a read); the session is read fresh
+        patrols, stored_sessions = await asyncio.gather(
+            self.cache.get_many(self.db, list(grouped.keys() | touches.keys())),
+            stored_session_dates(self.db, grouped.keys())
+        )
+
+        default_session_date = current_session_date()
+        operations = []
+        trail_docs = []
+        sessions = {}
+        flushed = []
+        latest_written: Dict[str, str] = {}  # Moved into self._latest only once the writes succeed
+        for patrol_id, points in grouped.items():
+            patrol = patrols.get(patrol_id)
+            if not patrol:
+                continue
+
+            points.sort(key=lambda p: p['timestamp'])
+            latest = points[-1]
+            session_date = stored_sessions.get(patrol_id) or default_session_date
+            if patrol_id not in stored_sessions:
+                # Only fills a missing session: a session started since the read above is never overwritten
+                operations.append(UpdateOne(
+                    {'id': patrol_id, 'session_date': {'$in': [None, '']}},
+                    {'$set': {'session_date': session_date}}
+                ))
+
+            trail_docs.extend(
+                make_point(patrol_id, patrol.get('hq_id'), session_date, p['latitude'], p['longitude'],
+                           p['timestamp'])
+                for p in points
+            )
+            sessions[(patrol_id, session_date)] = (patrol.get('hq_id'), points)
+
+            # Replayed offline points can be older than the live position; they only extend the trail
+            known = self._latest.get(patrol_id)
+            if known is not None and latest['timestamp'] < known:
+                continue
+            latest_written[patrol_id] = latest['timestamp']
+
+            # Guarded on a BSON date: string order only holds while every writer uses one format
+            latest_at = parse_timestamp(latest['timestamp'])
+            operations.append(UpdateOne(
+                {'id': patrol_id, 'last_location_at': {'$not': {'$gt': latest_at}}},
+                {
+                    '$set': {
+                        'latitude': latest['latitude'],
+                        'longitude': latest['longitude'],
+                        'location': geo_point(latest['latitude'], latest['longitude']),
+                        'last_update': latest['timestamp'],
+                        'last_location_time': latest['timestamp'],
+                        'last_location_at': latest_at,
+                        'is_tracking': True,
+                        'tracking_stopped': False
+                    }
+                }
+            ))
+            flushed.append({
+                'patrol_id': patrol_id,
+                'hq_id': patrol.get('hq_id'),
+                'latitude': latest['latitude'],
+                'longitude': latest['longitude'],
+                'timestamp': latest['timestamp'],
+            })
+
+        # Filtered fixes still prove the patrol is alive (inactivity detection reads last_location_time)
+        for patrol_id, touched_at in touches.items():
+            if patrol_id not in patrols:
+                continue
+            if patrol_id not in grouped:
+                self.metrics.broadcasts_saved += 1
+            self.metrics.touch_updates += 1
+            touched_dt = parse_timestamp(touched_at)
+            operations.append(UpdateOne(
+                {'id': patrol_id, 'last_location_at': {'$not': {'$gt': touched_dt}}},
+                {'$set': {'last_location_time': touched_at, 'last_location_at': touched_dt,
+                          'is_tracking': True, 'tracking_stopped': False}}
+            ))
+
+        if trail_docs or operations:
+            try:
+                writes = []
+                stats_tails = {}
+                if trail_docs:
+                    stats_operations, stats_tails = await trail_stats.prepare(self.db, sessions)
+                    writes.append(insert_points(self.db, trail_docs))
+                    writes.append(self.db[TRAIL_SESSIONS_COLLECTION].bulk_write(stats_operations, ordered=False))
+                if operations:
+                    writes.append(self.db.patrols.bulk_write(operations, ordered=False))
+                await asyncio.gather(*writes)
+            except Exception as e:
+                self.metrics.flush_errors += 1
+                print(f"Bulk write failed for {len(sessions)} patrols: {e}")
+                for patrol_id, timestamp in kept.items():
+                    self.filter.discard(patrol_id, timestamp)
+                return False
+            trail_stats.commit(stats_tails)
+        self._latest.update(latest_written)
+
+        for patrol_id, timestamp in kept.items():
+            if patrol_id in patrols:
+                self.filter.commit(patrol_id, timestamp)
+            else:
+                self.filter.discard(patrol_id, timestamp)
+
+        simplified_trail_cache.invalidate_many(patrol_id for patrol_id, _ in sessions)
+        self.metrics.record_flush(len(trail_docs), (time.perf_counter() - started) * 1000)
+
+        for patrol_id in grouped.keys() | touches.keys():
+            if patrol_id in patrols:
+                newest = max(grouped[patrol_id][-1]['timestamp'] if patrol_id in grouped else '',
+                             touches.get(patrol_id, ''))
+                inactivity_monitor.touch(patrol_id, patrols[patrol_id].get('hq_id'), newest)
+
+        if self.on_flush and flushed:
+            await self.on_flush(flushed)
+        return True
@@ -0,0 +1,171 @@
+"""
+KML/KMZ -> GeoJSON
+Stdlib parser for the Google My Maps / Earth exports HQs upload. Each
+Placemark becomes a GeoJSON Feature whose properties carry its name,
+styleUrl, enclosing Folder name and ExtendedData values; KMZ archives are
+unpacked to their main document.
+"""
+import io
+import math
+import os
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from typing import Iterator, List, Optional
+
+KMZ_MAGIC = b'PK\x03\x04'
+# Largest KML document accepted, fetched or unpacked from a KMZ
+KML_MAX_BYTES = int(os.environ.get('KML_MAX_BYTES', str(50 * 1024 * 1024)))
+
+
+class KMLError(ValueError):
+    """Unreadable or unsupported KML/KMZ document"""
+
+
+def read_kml_bytes(data: bytes) -> bytes:
+    """
+    The KML document itself; KMZ (zip) archives use doc.kml or their first .kml
+    entry, unpacked only up to KML_MAX_BYTES whatever size the archive declares
+    """
+    if not data.startswith(KMZ_MAGIC):
+        return data
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = [n for n in archive.namelist() if n.lower().endswith('.kml')]
+            if not names:
+                raise KMLError("KMZ archive contains no .kml document")
+            info = archive.getinfo('doc.kml' if 'doc.kml' in names else names[0])
+            if info.file_size > KML_MAX_BYTES:
+                raise KMLError(f"KML document larger than {KML_MAX_BYTES} bytes")
+            with archive.open(info) as member:
+                document = member.read(KML_MAX_BYTES + 1)
+    except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError) as e:
+        # RuntimeError: encrypted entry; NotImplementedError: unsupported compression
+        raise KMLError(f"Invalid KMZ archive: {e}")
+    if len(document) > KML_MAX_BYTES:
+        raise KMLError(f"KML document larger than {KML_MAX_BYTES} bytes")
+    return document
+
+
+def _tag(element) -> str:
+    return element.tag.rsplit('}', 1)[-1]
+
+
+def _child(element, name: str):
+    for child in element:
+        if _tag(child) == name:
+            return child
+    return None
+
+
+def _text(element, name: str) -> Optional[str]:
+    child = _child(element, name)
+    return child.text.strip() if child is not None and child.text else None
+
+
+def _coordinates(element) -> List[List[float]]:
+    """'lng,lat[,alt] lng,lat ...' -> [[lng, lat], ...] (altitude dropped)"""
+    node = next((e for e in element.iter() if _tag(e) == 'coordinates'), None)
+    if node is None or not node.text:
+        return []
+    points = []
+    for chunk in node.text.split():
+        parts = chunk.split(',')
+        if len(parts) >= 2:
+            try:
+                lng, lat = float(parts[0]), float(parts[1])
+            except ValueError:
+                raise KMLError(f"Invalid coordinate: {chunk[:50]!r}")
+            if not (math.isfinite(lng) and math.isfinite(lat)):
+                raise KMLError(f"Invalid coordinate: {chunk[:50]!r}")
+            points.append([lng, lat])
+    return points
+
+
+def _polygon(element) -> Optional[list]:
+    rings = []
+    for boundary in ('outerBoundaryIs', 'innerBoundaryIs'):
+        for node in element:
+            if _tag(node) == boundary:
+                ring = _coordinates(node)
+                if ring and ring[0] != ring[-1]:
+                    ring.append(ring[0])
+                if len(ring) >= 4:  # A closed ring needs 3 distinct corners
+                    rings.append(ring)
+        if not rings:
+            return None  # No usable outer ring
+    return rings
+
+
+def _geometry(element) -> Optional[dict]:
+    kind = _tag(element)
+    if kind == 'Point':
+        coords = _coordinates(element)
+        return {'type': 'Point', 'coordinates': coords[0]} if coords else None
+    if kind in ('LineString', 'LinearRing'):
+        coords = _coordinates(element)
+        return {'type': 'LineString', 'coordinates': coords} if len(coords) >= 2 else None
+    if kind == 'Polygon':
+        rings = _polygon(element)
+        return {'type': 'Polygon', 'coordinates': rings} if rings else None
+    if kind == 'MultiGeometry':
+        parts = [g for g in (_geometry(child) for child in element) if g]
+        if not parts:
+            return None
+        kinds = {p['type'] for p in parts}
+        if kinds == {'Polygon'}:
+            return {'type': 'MultiPolygon', 'coordinates': [p['coordinates'] for p in parts]}
+        if kinds == {'LineString'}:
+            return {'type': 'MultiLineString', 'coordinates': [p['coordinates'] for p in parts]}
+        if kinds == {'Point'}:
+            return {'type': 'MultiPoint', 'coordinates': [p['coordinates'] for p in parts]}
+        return {'type': 'GeometryCollection', 'geometries': parts}
+    return None
+
+
+def _feature(placemark, folder: Optional[str]) -> Optional[dict]:
+    geometry = None
+    for child in placemark:
+        geometry = _geometry(child)
+        if geometry:
+            break
+    if geometry is None:
+        return None
+
+    properties = {
+        'name': _text(placemark, 'name'),
+        'description': _text(placemark, 'description'),
+        'styleUrl': _text(placemark, 'styleUrl'),
+        'folder': folder,
+    }
+    extended = _child(placemark, 'ExtendedData')
+    if extended is not None:
+        for data in extended.iter():
+            if _tag(data) == 'Data' and data.get('name') and data.get('name') not in properties:
+                properties[data.get('name')] = _text(data, 'value')
+    return {'type': 'Feature', 'geometry': geometry, 'properties': properties}
+
+
+def _walk(element, folder: Optional[str]) -> Iterator[dict]:
+    for child in element:
+        kind = _tag(child)
+        if kind == 'Placemark':
+            feature = _feature(child, folder)
+            if feature:
+                yield feature
+        elif kind in ('Folder', 'Document'):
+            yield from _walk(child, _text(child, 'name') if kind == 'Folder' else folder)
+
+
+def parse_kml(data: bytes) -> dict:
+    """KML or KMZ bytes -> GeoJSON FeatureCollection (document name in `name`)"""
+    try:
+        root = ET.fromstring(read_kml_bytes(data))
+    except ET.ParseError as e:
+        raise KMLError(f"Invalid KML: {e}")
+    document = _child(root, 'Document')
+    return {
+        'type': 'FeatureCollection',
+        'name': _text(document if document is not None else root, 'name'),
+        'features': list(_walk(root, None)),
+    }
@@ -0,0 +1,82 @@
+"""
+KML Layer API Routes
+Manifests and pre-converted GeoJSON layers from the KML layer store. Mount
+on the main app with app.include_router(router).
+"""
+from urllib.parse import urlparse
+
+import httpx
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+
+from database import get_db
+from kml_layers import LAYER_ID_PATTERN, artifact_path, get_source, url_allowed, url_source
+from kml_parser import KMLError
+
+router = APIRouter(prefix="/api/kml")
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+
+def _manifest_response(source: dict) -> dict:
+    return {
+        'source_id': source['source_id'],
+        'name': source.get('name'),
+        'updated_at': source.get('updated_at'),
+        **source['manifest'],
+    }
+
+
+def _negotiate(accept_encoding: str) -> str:
+    offered = {part.split(';')[0].strip() for part in accept_encoding.lower().split(',')}
+    for encoding in ('br', 'gzip'):
+        if encoding in offered:
+            return encoding
+    return 'identity'
+
+
+@router.get("/manifest")
+async def get_url_manifest(url: str):
+    """Layers of a remote KML/KMZ (e.g. a Google My Maps export), converted once and refreshed periodically"""
+    if urlparse(url).scheme not in ('http', 'https'):
+        raise HTTPException(status_code=400, detail="Only http(s) KML URLs are supported")
+    if not url_allowed(url):
+        raise HTTPException(status_code=403, detail="KML URLs from this host are not allowed")
+    try:
+        source = await url_source(get_db(), url)
+    except (httpx.HTTPError, KMLError, ValueError) as e:
+        raise HTTPException(status_code=502, detail=f"Could not load KML: {e}")
+    return _manifest_response(source)
+
+
+@router.get("/files/{file_id}/layers")
+async def get_file_manifest(file_id: str):
+    """Layers of an uploaded KML file"""
+    source = await get_source(get_db(), file_id)
+    if not source:
+        raise HTTPException(status_code=404, detail="No converted layers for this file")
+    return _manifest_response(source)
+
+
+@router.get("/layers/{layer_id}")
+async def get_layer(layer_id: str, request: Request):
+    """
+    One layer as GeoJSON. The id is a content hash, so the response is
+    immutable: ETag is the id, and br/gzip copies are served when accepted.
+    """
+    if not LAYER_ID_PATTERN.match(layer_id):
+        raise HTTPException(status_code=404, detail="Layer not found")
+    etag = f'"{layer_id}"'
+    headers = {'ETag': etag, 'Cache-Control': IMMUTABLE_CACHE, 'Vary': 'Accept-Encoding'}
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+
+    if not artifact_path(layer_id).exists():
+        raise HTTPException(status_code=404, detail="Layer not found")
+    encoding = _negotiate(request.headers.get('accept-encoding', ''))
+    path = artifact_path(layer_id, encoding)
+    if encoding == 'identity' or not path.exists():
+        path = artifact_path(layer_id)
+    else:
+        headers['Content-Encoding'] = encoding
+    return FileResponse(path, media_type='application/geo+json', headers=headers)
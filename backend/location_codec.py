@@ -0,0 +1,91 @@
+"""
+Binary Location Payload
+Compact alternative to JSON for patrol/{patrol_id}/location on weak links.
+Devices publish it on patrol/{patrol_id}/location/bin, or on the plain
+location topic where the magic byte tells it apart from JSON.
+
+Layout (little-endian), version 1:
+    header  8 bytes   uint8 magic (0xB1), uint8 version, uint16 count, uint32 base_time
+    point  14 bytes   int32 lat * 1e7, int32 lng * 1e7, uint32 seconds after base_time,
+                      uint16 accuracy in decimetres (0xFFFF = unknown)
+
+One fix is 22 bytes against ~60-90 bytes of JSON; each extra fix in the
+same message costs 14 bytes.
+"""
+import struct
+from datetime import datetime, timezone
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+MAGIC = 0xB1
+VERSION = 1
+BINARY_TOPIC_SUFFIX = 'bin'
+COORD_SCALE = 10_000_000  # 1e-7 degrees, ~1 cm
+ACCURACY_UNKNOWN = 0xFFFF
+
+HEADER = struct.Struct('<BBHI')
+POINT_DTYPE = np.dtype([('lat', '<i4'), ('lng', '<i4'), ('dt', '<u4'), ('acc', '<u2')])
+
+
+class PayloadError(ValueError):
+    """Malformed or unsupported binary payload"""
+
+
+def is_binary(payload: bytes, topic: Optional[str] = None) -> bool:
+    """Binary if published on the /bin topic or if it starts with the magic byte (JSON cannot)"""
+    if topic and topic.endswith('/' + BINARY_TOPIC_SUFFIX):
+        return True
+    return len(payload) > 0 and payload[0] == MAGIC
+
+
+def decode_locations(payload: bytes) -> List[dict]:
+    """
+    Decode to [{'latitude', 'longitude', 'timestamp', 'accuracy'}, ...].
+    The point array is read in place with np.frombuffer (no copy of the payload).
+    """
+    if len(payload) < HEADER.size:
+        raise PayloadError("Payload shorter than header")
+    magic, version, count, base_time = HEADER.unpack_from(payload)
+    if magic != MAGIC:
+        raise PayloadError("Bad magic byte")
+    if version != VERSION:
+        raise PayloadError(f"Unsupported payload version {version}")
+    if len(payload) != HEADER.size + count * POINT_DTYPE.itemsize:
+        raise PayloadError(f"Payload length does not match {count} points")
+
+    points = np.frombuffer(payload, dtype=POINT_DTYPE, count=count, offset=HEADER.size)
+    lats = points['lat'] / COORD_SCALE
+    lngs = points['lng'] / COORD_SCALE
+    times = base_time + points['dt'].astype(np.int64)
+    accuracy = points['acc']
+
+    return [{
+        'latitude': float(lats[i]),
+        'longitude': float(lngs[i]),
+        'timestamp': datetime.fromtimestamp(int(times[i]), tz=timezone.utc).isoformat(),
+        'accuracy': None if accuracy[i] == ACCURACY_UNKNOWN else float(accuracy[i]) / 10.0,
+    } for i in range(count)]
+
+
+def encode_locations(points: Sequence[dict]) -> bytes:
+    """
+    Reference encoder (device firmware / tests). Points need 'latitude', 'longitude',
+    'timestamp' (epoch seconds or datetime) and optionally 'accuracy' in metres.
+    """
+    if not points:
+        raise PayloadError("No points to encode")
+    times = [
+        int(p['timestamp'].timestamp()) if isinstance(p['timestamp'], datetime) else int(p['timestamp'])
+        for p in points
+    ]
+    base_time = min(times)
+    packed = np.zeros(len(points), dtype=POINT_DTYPE)
+    packed['lat'] = [round(p['latitude'] * COORD_SCALE) for p in points]
+    packed['lng'] = [round(p['longitude'] * COORD_SCALE) for p in points]
+    packed['dt'] = [t - base_time for t in times]
+    packed['acc'] = [
+        ACCURACY_UNKNOWN if p.get('accuracy') is None else min(round(p['accuracy'] * 10), ACCURACY_UNKNOWN - 1)
+        for p in points
+    ]
+    return HEADER.pack(MAGIC, VERSION, len(points), base_time) + packed.tobytes()
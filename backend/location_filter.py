@@ -0,0 +1,132 @@
+"""
+GPS Jitter Filter
+Per-patrol state that decides whether a fix is worth storing. A stationary
+patrol's fixes wander inside the receiver's error circle; storing and
+broadcasting each of them adds nothing. Fixes are dropped when they are:
+  - duplicates of the last kept fix (same timestamp or older),
+  - within an accuracy-scaled radius of the last kept fix, unless
+    LOCATION_HEARTBEAT_SECONDS have passed since it (so trails keep a pulse),
+  - further than a plausible speed allows (GPS glitches), unless several
+    such jumps arrive in a row (the patrol really is there, e.g. after a
+    bad first fix).
+
+A kept fix is pending until the ingest flush that writes it calls commit();
+only then does it become the reference. If the fix is dropped or its write
+fails, discard() falls back to the last written reference, so later fixes
+are not judged against a point that was never stored.
+"""
+import os
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import trail_store
+
+JITTER_MIN_RADIUS_M = float(os.environ.get('JITTER_MIN_RADIUS_M', '8'))
+JITTER_ACCURACY_FACTOR = float(os.environ.get('JITTER_ACCURACY_FACTOR', '1.0'))  # radius = accuracy * factor
+JITTER_MAX_RADIUS_M = float(os.environ.get('JITTER_MAX_RADIUS_M', '50'))
+LOCATION_HEARTBEAT_SECONDS = float(os.environ.get('LOCATION_HEARTBEAT_SECONDS', '60'))
+MAX_PATROL_SPEED_KMH = float(os.environ.get('MAX_PATROL_SPEED_KMH', '200'))
+MAX_CONSECUTIVE_SPEED_REJECTS = int(os.environ.get('MAX_CONSECUTIVE_SPEED_REJECTS', '3'))
+LOCATION_FILTER_MAX_PATROLS = int(os.environ.get('LOCATION_FILTER_MAX_PATROLS', '50000'))
+
+KEEP = 'keep'
+DUPLICATE = 'duplicate'
+JITTER = 'jitter'
+SPEED = 'speed'
+
+
+Fix = Tuple[float, float, float]  # lat, lng, epoch seconds
+
+
+class _PatrolState:
+    __slots__ = ('reference', 'pending', 'speed_rejects')
+
+    def __init__(self):
+        self.reference: Optional[Fix] = None  # Last kept fix that was written
+        self.pending: Optional[Fix] = None    # Newest kept fix not written yet
+        self.speed_rejects = 0
+
+
+class LocationFilter:
+    """Stateful per-patrol filter (LRU-bounded); one instance per ingest pipeline"""
+
+    def __init__(self, max_patrols: int = LOCATION_FILTER_MAX_PATROLS):
+        self.max_patrols = max_patrols
+        self._state: "OrderedDict[str, _PatrolState]" = OrderedDict()
+        self.kept = 0
+        self.duplicates = 0
+        self.jitter = 0
+        self.speed_rejects = 0
+
+    def check(self, patrol_id: str, latitude: float, longitude: float, timestamp,
+              accuracy: Optional[float] = None) -> str:
+        """Classify a fix (KEEP, DUPLICATE, JITTER or SPEED); a kept fix is pending until commit()"""
+        ts = trail_store.parse_timestamp(timestamp).timestamp()
+        state = self._state.get(patrol_id)
+        if state is None:
+            state = self._state[patrol_id] = _PatrolState()
+            while len(self._state) > self.max_patrols:
+                self._state.popitem(last=False)
+        else:
+            self._state.move_to_end(patrol_id)
+
+        last = state.pending or state.reference
+        if last is None:
+            state.pending = (latitude, longitude, ts)
+            self.kept += 1
+            return KEEP
+
+        last_lat, last_lng, last_ts = last
+        elapsed = ts - last_ts
+        if elapsed <= 0:
+            self.duplicates += 1
+            return DUPLICATE
+
+        distance_m = trail_store.haversine_km(last_lat, last_lng, latitude, longitude) * 1000.0
+        radius = JITTER_MIN_RADIUS_M
+        if accuracy:
+            radius = min(max(radius, accuracy * JITTER_ACCURACY_FACTOR), JITTER_MAX_RADIUS_M)
+        if distance_m < radius and elapsed < LOCATION_HEARTBEAT_SECONDS:
+            self.jitter += 1
+            return JITTER
+
+        speed_kmh = (distance_m / 1000.0) / (elapsed / 3600.0)
+        if speed_kmh > MAX_PATROL_SPEED_KMH and state.speed_rejects < MAX_CONSECUTIVE_SPEED_REJECTS:
+            state.speed_rejects += 1
+            self.speed_rejects += 1
+            return SPEED
+
+        state.pending = (latitude, longitude, ts)
+        state.speed_rejects = 0
+        self.kept += 1
+        return KEEP
+
+    def commit(self, patrol_id: str, timestamp) -> None:
+        """The kept fixes of a patrol up to timestamp were written"""
+        state = self._state.get(patrol_id)
+        if state is not None and state.pending is not None \
+                and state.pending[2] <= trail_store.parse_timestamp(timestamp).timestamp():
+            state.reference, state.pending = state.pending, None
+
+    def discard(self, patrol_id: str, timestamp) -> None:
+        """The kept fixes of a patrol up to timestamp were dropped or failed to write"""
+        state = self._state.get(patrol_id)
+        if state is not None and state.pending is not None \
+                and state.pending[2] <= trail_store.parse_timestamp(timestamp).timestamp():
+            state.pending = None
+
+    def forget(self, patrol_id: str) -> None:
+        """Drop a patrol's reference fix, e.g. when its session ends"""
+        self._state.pop(patrol_id, None)
+
+    def stats(self) -> dict:
+        filtered = self.duplicates + self.jitter + self.speed_rejects
+        total = self.kept + filtered
+        return {
+            'kept': self.kept,
+            'duplicates': self.duplicates,
+            'jitter': self.jitter,
+            'speed_rejects': self.speed_rejects,
+            'filtered': filtered,
+            'filtered_ratio': round(filtered / total, 3) if total else 0,
+        }
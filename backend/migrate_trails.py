@@ -0,0 +1,90 @@
+import asyncio
+from motor.motor_asyncio import AsyncIOMotorClient
+import os
+
+from ingest import current_session_date
+from trail_stats import trail_stats
+from trail_store import TRAIL_COLLECTION, ensure_trail_collection, existing_timestamps, make_point
+
+MONGO_URL = os.environ['MONGO_URL']
+DB_NAME = os.environ['DB_NAME']
+
+BATCH_SIZE = 5000
+
+def _ts_ms(doc: dict) -> int:
+    return round(doc['ts'].timestamp() * 1000)
+
+async def _unstored(db, patrol_id: str, docs: list) -> list:
+    """Drop points a previous (interrupted) run already copied, plus repeats within the trail"""
+    by_session = {}
+    for doc in docs:
+        by_session.setdefault(doc['meta']['session_date'], []).append(doc)
+
+    fresh = []
+    for session_date, session_docs in by_session.items():
+        seen = await existing_timestamps(db, patrol_id, session_date, [_ts_ms(d) for d in session_docs])
+        for doc in session_docs:
+            ts_ms = _ts_ms(doc)
+            if ts_ms not in seen:
+                seen.add(ts_ms)
+                fresh.append(doc)
+    return fresh
+
+async def migrate_patrol(db, patrol: dict) -> tuple:
+    """Copy one patrol's embedded trail; returns (points copied, points already stored)"""
+    patrol_id = patrol['id']
+    fallback_date = patrol.get('session_date') or current_session_date()
+
+    docs = []
+    session_dates = set()
+    for point in patrol.get('trail', []):
+        lat = point.get('lat', point.get('latitude'))
+        lng = point.get('lng', point.get('longitude'))
+        if lat is None or lng is None or not point.get('timestamp'):
+            continue
+        session_date = point.get('session_date') or fallback_date
+        session_dates.add(session_date)
+        docs.append(make_point(patrol_id, patrol.get('hq_id'), session_date, lat, lng, point['timestamp']))
+
+    # A rerun after a crash between the copy and the $unset below must not duplicate points
+    fresh = await _unstored(db, patrol_id, docs)
+    for i in range(0, len(fresh), BATCH_SIZE):
+        await db[TRAIL_COLLECTION].insert_many(fresh[i:i + BATCH_SIZE], ordered=False)
+
+    # Session stats (distance, moving time, ...) are computed once from the copied points
+    for session_date in session_dates:
+        await trail_stats.rebuild(db, patrol_id, session_date, patrol.get('hq_id'))
+
+    # Only drop the embedded array once its points are safely copied
+    await db.patrols.update_one({'id': patrol_id}, {'$unset': {'trail': ''}})
+    return len(fresh), len(docs) - len(fresh)
+
+async def migrate_trails():
+    """One-shot move of embedded patrol `trail` arrays into the trail_points time-series collection"""
+    client = AsyncIOMotorClient(MONGO_URL)
+    db = client[DB_NAME]
+
+    print("Ensuring trail time-series collection...")
+    await ensure_trail_collection(db)
+    print(f"✓ {TRAIL_COLLECTION} ready")
+
+    migrated_patrols = 0
+    migrated_points = 0
+
+    cursor = db.patrols.find(
+        {'trail.0': {'$exists': True}},
+        {'_id': 0, 'id': 1, 'hq_id': 1, 'session_date': 1, 'trail': 1}
+    )
+    async for patrol in cursor:
+        copied, skipped = await migrate_patrol(db, patrol)
+        migrated_patrols += 1
+        migrated_points += copied
+        note = f" ({skipped} already stored)" if skipped else ""
+        print(f"  ✓ {patrol['id']}: {copied} points{note}")
+
+    print(f"\n✓ Migrated {migrated_points} points from {migrated_patrols} patrols")
+
+    client.close()
+
+if __name__ == "__main__":
+    asyncio.run(migrate_trails())
@@ -1,8 +1,20 @@
-from pydantic import BaseModel, Field, ConfigDict
-from typing import Optional, List
+from pydantic import BaseModel, Field, ConfigDict, StringConstraints
+from typing import Annotated, Optional, List
 from datetime import datetime
 from enum import Enum
 
+# Marks user-entered free text; security.sanitize_model() cleans only these fields
+FREE_TEXT = {'free_text': True}
+
+# Other string fields are left alone by sanitize_model(), so they are held to a
+# character set that cannot carry markup
+EMAIL_PATTERN = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
+PHONE_PATTERN = r'^(\+?[0-9][0-9 ()-]{5,19})?$'  # Empty allowed: the dashboard form sends ''
+ID_PATTERN = r'^[A-Za-z0-9_-]+$'
+USERNAME_PATTERN = r'^[A-Za-z0-9_.-]+$'
+SoldierId = Annotated[str, StringConstraints(strip_whitespace=True, max_length=64,
+                                             pattern=r'^[A-Za-z0-9][A-Za-z0-9 _./-]*$')]
+
 class PatrolStatus(str, Enum):
     ACTIVE = "active"
     INACTIVE = "inactive"
@@ -15,24 +27,28 @@ class LocationPoint(BaseModel):
     accuracy: Optional[float] = None
     timestamp: datetime
 
+class LocationBatch(BaseModel):
+    """Queued fixes replayed by a patrol device after a coverage gap (device timestamps kept)"""
+    points: List[LocationPoint] = Field(..., max_length=1000)
+
 class Soldier(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     
-    id: str
-    name: str
-    email: str
-    rank: Optional[str] = None
-    unit: Optional[str] = None
+    id: SoldierId
+    name: str = Field(..., json_schema_extra=FREE_TEXT)
+    email: str = Field(..., pattern=EMAIL_PATTERN, max_length=254)
+    rank: Optional[str] = Field(None, json_schema_extra=FREE_TEXT)
+    unit: Optional[str] = Field(None, json_schema_extra=FREE_TEXT)
 
 class PatrolCreate(BaseModel):
-    name: str
-    camp_name: str
-    unit: str
-    leader_email: str
-    phone_number: Optional[str] = None  # Mobile number for direct contact
-    assigned_area: str
-    soldier_ids: List[str]
-    hq_id: str  # Added HQ association
+    name: str = Field(..., json_schema_extra=FREE_TEXT)
+    camp_name: str = Field(..., json_schema_extra=FREE_TEXT)
+    unit: str = Field(..., json_schema_extra=FREE_TEXT)
+    leader_email: str = Field(..., pattern=EMAIL_PATTERN)
+    phone_number: Optional[str] = Field(None, pattern=PHONE_PATTERN)  # Mobile number for direct contact
+    assigned_area: str = Field(..., json_schema_extra=FREE_TEXT)
+    soldier_ids: List[SoldierId]
+    hq_id: str = Field(..., pattern=ID_PATTERN)  # Added HQ association
 
 class PatrolUpdate(BaseModel):
     latitude: float
@@ -66,12 +82,30 @@ class TrailPoint(BaseModel):
     longitude: float
     timestamp: datetime
 
+class TrailBoundingBox(BaseModel):
+    min_lat: float
+    min_lng: float
+    max_lat: float
+    max_lng: float
+
+class TrailStats(BaseModel):
+    """Running aggregates for a patrol session (maintained on ingest)"""
+    point_count: int = 0
+    total_distance: float = 0  # km
+    moving_minutes: float = 0
+    max_speed_kmh: float = 0
+    bbox: Optional[TrailBoundingBox] = None
+    first_timestamp: Optional[datetime] = None
+    last_timestamp: Optional[datetime] = None
+
 class PatrolTrailResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     
     patrol_id: str
     points: List[TrailPoint]
     total_distance: float
+    stats: Optional[TrailStats] = None
+    next_cursor: Optional[str] = None  # Pass as `since` to fetch only newer points
 
 class AccessCode(BaseModel):
     model_config = ConfigDict(from_attributes=True)
@@ -88,10 +122,10 @@ class CodeVerification(BaseModel):
     email: str
 
 class HQCreate(BaseModel):
-    username: str
+    username: str = Field(..., pattern=USERNAME_PATTERN, min_length=3, max_length=64)
     password: str
-    hq_name: str
-    location: str
+    hq_name: str = Field(..., json_schema_extra=FREE_TEXT)
+    location: str = Field(..., json_schema_extra=FREE_TEXT)
 
 class HQResponse(BaseModel):
     model_config = ConfigDict(from_attributes=True)
@@ -116,10 +150,10 @@ class HQLoginResponse(BaseModel):
 class SOSAlert(BaseModel):
     model_config = ConfigDict(from_attributes=True)
     
-    patrol_id: str
+    patrol_id: str = Field(..., pattern=ID_PATTERN, max_length=64)
     latitude: float
     longitude: float
-    message: Optional[str] = "EMERGENCY SOS"
+    message: Optional[str] = Field("EMERGENCY SOS", json_schema_extra=FREE_TEXT)
     timestamp: Optional[datetime] = None
     resolved: bool = False
     auto_triggered: bool = False  # True if triggered by inactivity detection
@@ -133,8 +167,8 @@ class MessageType(str, Enum):
 
 class MessageCreate(BaseModel):
     """Create a new message"""
-    content: str
-    recipient_patrol_id: Optional[str] = None  # None for broadcast
+    content: str = Field(..., json_schema_extra=FREE_TEXT)
+    recipient_patrol_id: Optional[str] = Field(None, pattern=ID_PATTERN, max_length=64)  # None for broadcast
     message_type: MessageType = MessageType.DIRECT
 
 
@@ -5,19 +5,46 @@ Bridges MQTT messages to WebSocket for real-time dashboard updates
 import asyncio
 import json
 import os
+import socket
+import uuid
 from datetime import datetime, timezone
-from typing import Dict, Set
+from typing import Dict, Optional, Set
 import paho.mqtt.client as mqtt
+from paho.mqtt.subscribeoptions import SubscribeOptions
 from motor.motor_asyncio import AsyncIOMotorClient
 
+from geofence import event_message, geofence_engine, geofence_notification_id
+from inactivity_monitor import inactivity_monitor
+from ingest import LocationIngestPipeline
+from kml_layers import ensure_kml_layer_indexes
+from location_codec import BINARY_TOPIC_SUFFIX, PayloadError, decode_locations, is_binary
+from mqtt_handoff import MessageHandoff
+from mqtt_partitions import PartitionLeases, ensure_partition_indexes, partition_leases
+from patrol_cache import patrol_cache
+from patrol_geo import SOS_NEAREST_MAX_KM, SOS_NEAREST_PATROLS, ensure_geo_indexes, nearest_patrols
+from security import parse_accuracy, validate_coordinates
+from trail_stats import ensure_stats_indexes, trail_stats
+from trail_store import ensure_trail_collection, format_timestamp
+from ws_registry import connection_registry, encode_message, location_coalescer
+
 # Configuration
 MQTT_BROKER_HOST = os.environ.get('MQTT_BROKER_HOST', 'localhost')
 MQTT_BROKER_PORT = int(os.environ.get('MQTT_BROKER_PORT', '1883'))
 MQTT_USERNAME = os.environ.get('MQTT_USERNAME', 'patrol_bridge')
 MQTT_PASSWORD = os.environ.get('MQTT_PASSWORD', '')  # Empty string if not set - allows anonymous
 MQTT_TOPIC_LOCATION = 'patrol/+/location'  # patrol/{patrol_id}/location
+MQTT_TOPIC_LOCATION_BIN = f'patrol/+/location/{BINARY_TOPIC_SUFFIX}'  # binary payloads, see location_codec.py
 MQTT_TOPIC_SOS = 'patrol/+/sos'  # patrol/{patrol_id}/sos
 MQTT_TOPIC_STATUS = 'patrol/+/status'  # patrol/{patrol_id}/status
+MQTT_TOPIC_FANOUT = 'hq/+/bridge/+'  # hq/{hq_id}/bridge/{locations|sos|geofence}: broadcasts relayed between workers
+
+# Set on every bridge worker to run several of them. SOS messages then go through this
+# shared-subscription group (one worker each). Location messages reach every worker and only
+# the holder of the patrol's partition handles them (see mqtt_partitions.py), so per-patrol
+# state and ordering stay in one process. Status messages are handled by every worker: each
+# drops its own state for a finished patrol. Empty: a single worker handles everything.
+MQTT_SHARED_GROUP = os.environ.get('MQTT_SHARED_GROUP', '')
+MQTT_CLIENT_ID = os.environ.get('MQTT_CLIENT_ID') or f"patrol_bridge_{socket.gethostname()}_{os.getpid()}"
 
 MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.environ.get('DB_NAME', 'test_database')
@@ -25,9 +52,37 @@ DB_NAME = os.environ.get('DB_NAME', 'test_database')
 # WebSocket clients to broadcast to (shared with server.py)
 websocket_clients: Dict[str, Set] = {}
 
+def shared_topic(topic: str) -> str:
+    """$share/{group}/{topic} when shared subscriptions are enabled"""
+    return f"$share/{MQTT_SHARED_GROUP}/{topic}" if MQTT_SHARED_GROUP else topic
+
+
+def sos_notification_id(patrol_id: str, payload: dict) -> str:
+    """
+    Same SOS message -> same id, so a redelivery (QoS retry or a shared-subscription
+    failover to another worker) cannot raise the alert twice. Devices should send an
+    `id` (or `timestamp`); otherwise the id stamped on receipt keeps repeats distinct.
+    """
+    key = payload.get('id') or payload.get('timestamp') or payload.get('received_id')
+    return f"SOS_{patrol_id}_{key}"
+
+
+async def ensure_bridge_indexes(db) -> None:
+    """Unique SOS notification ids make alert inserts idempotent across workers"""
+    try:
+        await db.notifications.create_index(
+            'id', unique=True, name='notification_id',
+            partialFilterExpression={'id': {'$type': 'string'}}
+        )
+    except Exception as e:
+        print(f"Could not create unique notification index (duplicate ids?): {e}")
+
+
 class MQTTBridge:
-    def __init__(self):
-        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="patrol_bridge")
+    def __init__(self, client_id: str = MQTT_CLIENT_ID, partitions: PartitionLeases = partition_leases):
+        self.client_id = client_id
+        self.partitions = partitions
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id, protocol=mqtt.MQTTv5)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
@@ -38,6 +93,8 @@ class MQTTBridge:
         
         self.db = None
         self.loop = None
+        self.ingest = LocationIngestPipeline()
+        self.handoff = MessageHandoff(self.process_message)
         
     async def init_db(self):
         """Initialize database connection"""
@@ -46,14 +103,21 @@ class MQTTBridge:
         
     def on_connect(self, client, userdata, flags, rc, properties=None):
         """Called when connected to MQTT broker"""
-        print(f"MQTT Connected with result code {rc}")
-        # Subscribe to patrol topics
-        client.subscribe(MQTT_TOPIC_LOCATION)
-        client.subscribe(MQTT_TOPIC_SOS)
-        client.subscribe(MQTT_TOPIC_STATUS)
-        print(f"Subscribed to: {MQTT_TOPIC_LOCATION}, {MQTT_TOPIC_SOS}, {MQTT_TOPIC_STATUS}")
+        print(f"MQTT Connected as {self.client_id} with result code {rc}")
+        # SOS is shared (one worker of the group); locations are filtered by partition in on_message
+        topics = [
+            (MQTT_TOPIC_LOCATION, SubscribeOptions(qos=1)),
+            (MQTT_TOPIC_LOCATION_BIN, SubscribeOptions(qos=1)),
+            (shared_topic(MQTT_TOPIC_SOS), SubscribeOptions(qos=2)),
+            (MQTT_TOPIC_STATUS, SubscribeOptions(qos=2)),
+        ]
+        if MQTT_SHARED_GROUP:
+            # Not shared: every worker relays broadcasts to its own WebSocket clients
+            topics.append((MQTT_TOPIC_FANOUT, SubscribeOptions(qos=1, noLocal=True)))
+        client.subscribe(topics)
+        print(f"Subscribed to: {', '.join(topic for topic, _ in topics)}")
         
-    def on_disconnect(self, client, userdata, rc, properties=None, reason_code=None):
+    def on_disconnect(self, client, userdata, flags, rc, properties=None):
         """Called when disconnected from MQTT broker"""
         print(f"MQTT Disconnected with result code {rc}")
         
@@ -66,15 +130,30 @@ class MQTTBridge:
                 
             patrol_id = topic_parts[1]
             message_type = topic_parts[2]
+            if topic_parts[0] == 'hq':
+                # Relayed broadcast from another worker: hq/{hq_id}/bridge/{kind}
+                if len(topic_parts) < 4 or message_type != 'bridge':
+                    return
+                message_type = f"fanout_{topic_parts[3]}"
+            elif message_type == 'location' and not self.partitions.owns(patrol_id):
+                return  # Another worker holds this patrol
             
-            payload = json.loads(msg.payload.decode('utf-8'))
+            if message_type == 'location' and is_binary(msg.payload, msg.topic):
+                # Compact binary fixes (one or many) with device timestamps; a type of their own,
+                # so a JSON location is never mistaken for one by its keys
+                message_type = 'location_batch'
+                payload = {'points': decode_locations(msg.payload)}
+            else:
+                payload = json.loads(msg.payload.decode('utf-8'))
+                if message_type == 'sos' and isinstance(payload, dict) and not (payload.get('id') or payload.get('timestamp')):
+                    payload['received_id'] = uuid.uuid4().hex
             
-            # Process message in async context
-            if self.loop:
-                asyncio.run_coroutine_threadsafe(
-                    self.process_message(patrol_id, message_type, payload),
-                    self.loop
-                )
+            # Bounded handoff to the async consumers (never blocks the network thread)
+            if not self.handoff.put(patrol_id, message_type, payload):
+                if self.handoff.dropped % 1000 == 1:
+                    print(f"MQTT handoff full, dropped {self.handoff.dropped} location messages so far")
+        except PayloadError as e:
+            print(f"Invalid binary location payload on {msg.topic}: {e}")
         except Exception as e:
             print(f"Error processing MQTT message: {e}")
             
@@ -82,51 +161,27 @@ class MQTTBridge:
         """Process MQTT message and update database/broadcast to WebSocket"""
         try:
             timestamp = datetime.now(timezone.utc).isoformat()
+            now = format_timestamp(timestamp)
             
-            if message_type == 'location':
+            if message_type == 'location_batch':
+                # Binary batch: device timestamps are kept, but never later than now. Several
+                # points are fixes the device buffered: they extend the trail unfiltered
+                live = len(payload['points']) == 1
+                for point in payload['points']:
+                    if validate_coordinates(point['latitude'], point['longitude']):
+                        await self.ingest.submit(patrol_id, point['latitude'], point['longitude'],
+                                                 min(format_timestamp(point['timestamp']), now), point['accuracy'],
+                                                 filtered=live)
+                    
+            elif message_type == 'location':
                 # Update patrol location in database
                 latitude = payload.get('lat') or payload.get('latitude')
                 longitude = payload.get('lng') or payload.get('longitude')
                 
                 if latitude and longitude:
-                    # Calculate session date using Bangladesh timezone (UTC+6)
-                    now_utc = datetime.now(timezone.utc)
-                    BD_OFFSET = timedelta(hours=6)
-                    now_bd = now_utc + BD_OFFSET
-                    session_date = now_bd.strftime('%Y-%m-%d')
-                    
-                    # Get patrol's current session info
-                    patrol = await self.db.patrols.find_one({'id': patrol_id}, {'session_date': 1})
-                    patrol_session_date = patrol.get('session_date') if patrol else session_date
-                    
-                    await self.db.patrols.update_one(
-                        {'id': patrol_id},
-                        {
-                            '$set': {
-                                'latitude': float(latitude),
-                                'longitude': float(longitude),
-                                'last_update': timestamp,
-                                'last_location_time': timestamp,
-                                'is_tracking': True,
-                                'tracking_stopped': False,
-                                'session_date': patrol_session_date or session_date
-                            },
-                            '$push': {
-                                'trail': {
-                                    '$each': [{
-                                        'lat': float(latitude), 
-                                        'lng': float(longitude), 
-                                        'timestamp': timestamp, 
-                                        'session_date': patrol_session_date or session_date
-                                    }],
-                                    '$slice': -5000
-                                }
-                            }
-                        }
-                    )
-                    
-                    # Broadcast to WebSocket clients
-                    await self.broadcast_location_update(patrol_id, latitude, longitude, timestamp)
+                    # Buffered: the ingest pipeline batches the write and broadcasts after flush
+                    await self.ingest.submit(patrol_id, latitude, longitude, timestamp,
+                                             parse_accuracy(payload.get('accuracy')))
                     
             elif message_type == 'sos':
                 # Handle SOS alert
@@ -135,11 +190,22 @@ class MQTTBridge:
                 longitude = payload.get('lng') or payload.get('longitude')
                 
                 # Get patrol info for HQ ID
-                patrol = await self.db.patrols.find_one({'id': patrol_id})
+                patrol = await patrol_cache.get(self.db, patrol_id)
                 if patrol:
-                    # Create notification
+                    # Closest active patrols of the same HQ, so HQ can dispatch help straight from the alert
+                    nearest = []
+                    if latitude is not None and longitude is not None and validate_coordinates(latitude, longitude):
+                        try:
+                            nearest = await nearest_patrols(
+                                self.db, latitude, longitude, hq_id=patrol.get('hq_id'),
+                                max_distance_m=SOS_NEAREST_MAX_KM * 1000, limit=SOS_NEAREST_PATROLS, exclude=patrol_id
+                            )
+                        except Exception as e:
+                            print(f"Nearest patrol lookup failed for SOS from {patrol_id}: {e}")  # Never hold up the alert
+
+                    # Create notification (upsert on a deterministic id: a redelivered SOS is a no-op)
                     notification = {
-                        'id': f'SOS_{patrol_id}_{int(datetime.now().timestamp())}',
+                        'id': sos_notification_id(patrol_id, payload),
                         'hq_id': patrol.get('hq_id'),
                         'patrol_id': patrol_id,
                         'message': f"SOS from {patrol.get('name', patrol_id)}: {message}",
@@ -147,12 +213,18 @@ class MQTTBridge:
                         'latitude': latitude,
                         'longitude': longitude,
                         'timestamp': timestamp,
+                        'nearest_patrols': nearest,
                         'read': False
                     }
-                    await self.db.notifications.insert_one(notification)
+                    result = await self.db.notifications.update_one(
+                        {'id': notification['id']}, {'$setOnInsert': notification}, upsert=True
+                    )
+                    if result.upserted_id is None:
+                        return
                     
                     # Broadcast SOS alert
-                    await self.broadcast_sos_alert(patrol.get('hq_id'), patrol_id, message, latitude, longitude, timestamp)
+                    await self.broadcast_sos_alert(patrol.get('hq_id'), patrol_id, message, latitude, longitude, timestamp,
+                                                   nearest_patrols=nearest)
                     
             elif message_type == 'status':
                 # Update patrol status
@@ -161,55 +233,142 @@ class MQTTBridge:
                     {'id': patrol_id},
                     {'$set': {'status': status, 'last_update': timestamp}}
                 )
+                patrol_cache.update(patrol_id, status=status)
+                if status == 'finished':
+                    self.ingest.forget(patrol_id)
+                    inactivity_monitor.forget(patrol_id)
+                    geofence_engine.forget(patrol_id)
+                    trail_stats.forget(patrol_id)
+                
+            elif message_type == 'fanout_locations':
+                # patrol_id is the hq_id for relayed broadcasts
+                for update in payload.get('updates', []):
+                    location_coalescer.add(patrol_id, update)
+                    
+            elif message_type == 'fanout_sos':
+                await self.broadcast_sos_alert(patrol_id, relay=False, **payload)
+
+            elif message_type == 'fanout_geofence':
+                self.broadcast_geofence_events(payload.get('events', []), relay=False)
                 
         except Exception as e:
             print(f"Error processing {message_type} message for {patrol_id}: {e}")
             
-    async def broadcast_location_update(self, patrol_id: str, latitude: float, longitude: float, timestamp: str):
+    def forward_location(self, patrol_id: str, payload: dict):
+        """Publish a fix received over REST so the worker holding the patrol handles it"""
+        self.client.publish(f"patrol/{patrol_id}/location", json.dumps(payload), qos=1)
+
+    def relay(self, hq_id: str, kind: str, payload: dict, qos: int = 0):
+        """Publish a broadcast for the other workers' WebSocket clients"""
+        if MQTT_SHARED_GROUP and hq_id:
+            self.client.publish(f"hq/{hq_id}/bridge/{kind}", encode_message(payload), qos=qos)
+            
+    async def broadcast_location_batch(self, updates: list):
+        """Broadcast the latest point of each patrol written by an ingest flush"""
+        by_hq: Dict[str, list] = {}
+        for update in updates:
+            await self.broadcast_location_update(
+                update['patrol_id'], update['latitude'], update['longitude'],
+                update['timestamp'], hq_id=update.get('hq_id')
+            )
+            by_hq.setdefault(update.get('hq_id'), []).append({
+                'patrol_id': update['patrol_id'],
+                'latitude': update['latitude'],
+                'longitude': update['longitude'],
+                'timestamp': update['timestamp']
+            })
+        for hq_id, hq_updates in by_hq.items():
+            self.relay(hq_id, 'locations', {'updates': hq_updates})
+
+        try:
+            events = await geofence_engine.process(self.db, updates)
+            if events:
+                await self.publish_geofence_events(events)
+        except Exception as e:
+            print(f"Geofence check failed: {e}")
+
+    async def publish_geofence_events(self, events: list):
+        """Store geofence transitions as notifications and push them to the HQs"""
+        notifications = [{
+            'id': geofence_notification_id(event),
+            'hq_id': event['hq_id'],
+            'patrol_id': event['patrol_id'],
+            'type': 'geofence',
+            'event': event['event'],
+            'fence_name': event['fence_name'],
+            'message': event_message(event),
+            'level': 'warning' if event['event'] in ('exit', 'out_of_area') else 'info',
+            'latitude': event['latitude'],
+            'longitude': event['longitude'],
+            'timestamp': event['timestamp'],
+            'read': False
+        } for event in events]
+        try:
+            await self.db.notifications.insert_many(notifications, ordered=False)
+        except Exception as e:
+            print(f"Failed to store geofence notifications: {e}")
+        self.broadcast_geofence_events(events)
+
+    def broadcast_geofence_events(self, events: list, relay: bool = True):
+        """One geofence_event frame per transition; not coalesced or dropped"""
+        by_hq: Dict[str, list] = {}
+        for event in events:
+            if not event.get('hq_id'):
+                continue
+            by_hq.setdefault(event['hq_id'], []).append(event)
+            connection_registry.broadcast(event['hq_id'], encode_message({
+                'type': 'geofence_event', 'message': event_message(event), **event
+            }), critical=True)
+        if relay:
+            for hq_id, hq_events in by_hq.items():
+                self.relay(hq_id, 'geofence', {'events': hq_events}, qos=1)
+            
+    async def broadcast_location_update(self, patrol_id: str, latitude: float, longitude: float, timestamp: str, hq_id: str = None):
         """Broadcast location update to all connected WebSocket clients"""
-        # Get patrol to find HQ ID
-        patrol = await self.db.patrols.find_one({'id': patrol_id})
-        if not patrol:
+        if not hq_id:
+            # Get patrol to find HQ ID
+            patrol = await patrol_cache.get(self.db, patrol_id)
+            if not patrol:
+                return
+            hq_id = patrol.get('hq_id')
+        if not hq_id:
             return
             
-        hq_id = patrol.get('hq_id')
-        message = json.dumps({
-            'type': 'patrol_location',
+        # Coalesced into one patrol_locations frame per HQ per tick
+        location_coalescer.add(hq_id, {
             'patrol_id': patrol_id,
             'latitude': latitude,
             'longitude': longitude,
             'timestamp': timestamp
         })
-        
-        # Broadcast to HQ WebSocket clients (if connected)
-        from server import connected_clients
-        for client_id, client_data in list(connected_clients.items()):
-            if client_id.startswith(hq_id):
-                try:
-                    ws = client_data['ws'] if isinstance(client_data, dict) else client_data
-                    await ws.send_text(message)
-                except Exception as e:
-                    print(f"WebSocket broadcast error to {client_id}: {e}")
                     
-    async def broadcast_sos_alert(self, hq_id: str, patrol_id: str, message: str, latitude: float, longitude: float, timestamp: str):
+    async def broadcast_sos_alert(self, hq_id: str, patrol_id: str, message: str, latitude: float, longitude: float, timestamp: str,
+                                  relay: bool = True, auto_triggered: bool = False, nearest_patrols: Optional[list] = None):
         """Broadcast SOS alert to all connected WebSocket clients for the HQ"""
-        alert_message = json.dumps({
+        if relay:
+            self.relay(hq_id, 'sos', {
+                'patrol_id': patrol_id,
+                'message': message,
+                'latitude': latitude,
+                'longitude': longitude,
+                'timestamp': timestamp,
+                'auto_triggered': auto_triggered,
+                'nearest_patrols': nearest_patrols or []
+            }, qos=1)
+
+        alert_message = encode_message({
             'type': 'sos_alert',
             'patrol_id': patrol_id,
             'message': message,
             'latitude': latitude,
             'longitude': longitude,
-            'timestamp': timestamp
+            'timestamp': timestamp,
+            'auto_triggered': auto_triggered,
+            'nearest_patrols': nearest_patrols or []
         })
         
-        from server import connected_clients
-        for client_id, client_data in list(connected_clients.items()):
-            if client_id.startswith(hq_id):
-                try:
-                    ws = client_data['ws'] if isinstance(client_data, dict) else client_data
-                    await ws.send_text(alert_message)
-                except Exception as e:
-                    print(f"SOS broadcast error to {client_id}: {e}")
+        # Not coalesced, and never dropped for a slow client
+        connection_registry.broadcast(hq_id, alert_message, critical=True)
                     
     def start(self, loop):
         """Start MQTT client"""
@@ -222,11 +381,22 @@ class MQTTBridge:
             print(f"Failed to connect to MQTT broker: {e}")
             print("MQTT bridge will retry on next message")
             
-    def stop(self):
-        """Stop MQTT client"""
-        self.client.loop_stop()
+    async def stop(self):
+        """Stop MQTT client, then write out and broadcast everything still buffered"""
+        await self.partitions.drain()  # Other workers take our patrols before we stop listening
+        self.client.loop_stop()  # No new messages; what was handed off is drained below
+        await self.drain()
+        await geofence_engine.stop()
+        await self.partitions.stop()
         self.client.disconnect()
         print("MQTT Bridge stopped")
+        
+    async def drain(self):
+        """Handle queued messages, flush buffered points, then broadcast the locations that flush produced"""
+        await self.handoff.stop()
+        await self.ingest.stop()
+        await inactivity_monitor.stop()
+        await location_coalescer.stop()
 
 # Global instance
 mqtt_bridge = MQTTBridge()
@@ -234,9 +404,28 @@ mqtt_bridge = MQTTBridge()
 async def start_mqtt_bridge():
     """Start the MQTT bridge service"""
     await mqtt_bridge.init_db()
+    await ensure_trail_collection(mqtt_bridge.db)
+    await ensure_stats_indexes(mqtt_bridge.db)
+    await ensure_bridge_indexes(mqtt_bridge.db)
+    await ensure_kml_layer_indexes(mqtt_bridge.db)
+    backfilled = await ensure_geo_indexes(mqtt_bridge.db)
+    if backfilled:
+        print(f"Added GeoJSON locations to {backfilled} patrols")
+    if MQTT_SHARED_GROUP:
+        await ensure_partition_indexes(mqtt_bridge.db)
+        await partition_leases.start(mqtt_bridge.db, MQTT_CLIENT_ID)
+        print(f"Bridge worker {MQTT_CLIENT_ID} holds partitions {partition_leases.stats()['owned']}")
+    warmed = await patrol_cache.warm(mqtt_bridge.db)
+    print(f"Patrol cache warmed with {warmed} patrols")
+    fences = await geofence_engine.start(mqtt_bridge.db)
+    print(f"Geofence engine loaded {fences} areas")
+    mqtt_bridge.ingest.start(mqtt_bridge.db, on_flush=mqtt_bridge.broadcast_location_batch)
+    location_coalescer.start()
+    await inactivity_monitor.start(mqtt_bridge.db, on_alert=mqtt_bridge.broadcast_sos_alert)
     loop = asyncio.get_event_loop()
+    mqtt_bridge.handoff.start(loop)
     mqtt_bridge.start(loop)
     
-def stop_mqtt_bridge():
-    """Stop the MQTT bridge service"""
-    mqtt_bridge.stop()
+async def stop_mqtt_bridge():
+    """Stop the MQTT bridge service (await from the app's shutdown handler)"""
+    await mqtt_bridge.stop()
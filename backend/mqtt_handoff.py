@@ -0,0 +1,135 @@
+"""
+MQTT Message Handoff
+Bounded, thread-safe queue between paho's network thread and the asyncio
+loop. Messages are sharded by patrol_id over a fixed pool of async consumers,
+so each patrol's messages are handled in arrival order and a reconnect storm
+costs at most MQTT_HANDOFF_MAX_PENDING queued messages instead of one pending
+coroutine per message.
+"""
+import asyncio
+import os
+import threading
+import zlib
+from collections import deque
+from typing import Awaitable, Callable, List, Optional
+
+MQTT_CONSUMERS = int(os.environ.get('MQTT_CONSUMERS', '4'))
+MQTT_HANDOFF_MAX_PENDING = int(os.environ.get('MQTT_HANDOFF_MAX_PENDING', '20000'))
+
+# Never dropped at the handoff; they may push the queue past its bound (counted as overflow)
+CRITICAL_MESSAGE_TYPES = {'sos', 'status', 'fanout_sos'}
+
+Handler = Callable[[str, str, dict], Awaitable[None]]
+
+
+class MessageHandoff:
+    """
+    put() is called from the paho thread and never blocks; consumers run on the loop.
+    When the bound is reached location messages are dropped, critical ones are still accepted.
+    """
+
+    def __init__(self, handler: Handler, consumers: int = MQTT_CONSUMERS, max_pending: int = MQTT_HANDOFF_MAX_PENDING):
+        self.handler = handler
+        self.max_pending = max_pending
+        self._shards: List[deque] = [deque() for _ in range(max(1, consumers))]
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeups: List[asyncio.Event] = []
+        self._tasks: List[asyncio.Task] = []
+
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.overflow = 0
+        self.errors = 0
+        self.max_pending_seen = 0
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Start the consumer pool (call from the event loop)"""
+        if self._tasks:
+            return
+        self._loop = loop
+        self._wakeups = [asyncio.Event() for _ in self._shards]
+        self._tasks = [loop.create_task(self._consume(i)) for i in range(len(self._shards))]
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Let consumers drain what is queued (up to timeout), then cancel them"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self._pending and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def put(self, patrol_id: str, message_type: str, payload: dict) -> bool:
+        """Hand a message to the loop (thread-safe). Returns False if it was dropped."""
+        if self._loop is None:
+            return False
+
+        index = zlib.crc32(patrol_id.encode('utf-8')) % len(self._shards)
+        shard = self._shards[index]
+        with self._lock:
+            self.received += 1
+            if self._pending >= self.max_pending:
+                if message_type not in CRITICAL_MESSAGE_TYPES:
+                    self.dropped += 1
+                    return False
+                self.overflow += 1
+            was_empty = not shard
+            shard.append((patrol_id, message_type, payload))
+            self._pending += 1
+            self.max_pending_seen = max(self.max_pending_seen, self._pending)
+
+        # One wakeup per empty -> non-empty transition keeps loop callbacks bounded too
+        if was_empty:
+            try:
+                self._loop.call_soon_threadsafe(self._wakeups[index].set)
+            except RuntimeError:
+                pass  # Loop closed during shutdown
+        return True
+
+    def _next(self, index: int):
+        with self._lock:
+            shard = self._shards[index]
+            if not shard:
+                return None
+            self._pending -= 1
+            return shard.popleft()
+
+    async def _consume(self, index: int) -> None:
+        wakeup = self._wakeups[index]
+        while True:
+            await wakeup.wait()
+            wakeup.clear()
+            while True:
+                item = self._next(index)
+                if item is None:
+                    break
+                try:
+                    await self.handler(*item)
+                    self.processed += 1
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error handling MQTT {item[1]} message for {item[0]}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            depths = [len(shard) for shard in self._shards]
+        return {
+            'consumers': len(self._shards),
+            'pending': sum(depths),
+            'max_pending': self.max_pending,
+            'max_pending_seen': self.max_pending_seen,
+            'shard_depths': depths,
+            'received': self.received,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'overflow': self.overflow,
+            'errors': self.errors,
+        }
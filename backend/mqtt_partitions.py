@@ -0,0 +1,296 @@
+"""
+MQTT Bridge Partitions
+With several bridge workers, every patrol must be handled by one worker at a
+time: the jitter filter, the latest-position guard, trail stats tails,
+inactivity watches and geofence state all live in process memory and assume
+they see each of the patrol's fixes in order.
+
+Patrols are hashed into MQTT_PARTITIONS partitions. Workers take leases on
+partitions in the bridge_partitions collection, renew them every
+MQTT_PARTITION_RENEW_SECONDS and aim for an even share of the workers that
+sent a heartbeat recently. A worker only handles location and status
+messages for patrols in partitions it holds; a lease that is not renewed
+(a crashed worker) expires after MQTT_PARTITION_LEASE_SECONDS and is taken
+over by the others.
+
+Every worker receives every fix, so a partition must never be without a
+handler while it moves. A worker short of its share posts how many it
+`wants` in its heartbeat; a worker over its share hands surplus partitions
+only to such a waiting worker, stamping a `starts_at` MQTT_PARTITION_HANDOVER_SECONDS
+ahead. The old owner keeps handling the partition until that moment and the
+new one starts at it, so there is neither a gap nor an overlap (up to clock
+skew between workers). A stopping worker drains its partitions the same way.
+"""
+import asyncio
+import math
+import os
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Dict, FrozenSet, Optional
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+MQTT_PARTITIONS = int(os.environ.get('MQTT_PARTITIONS', '16'))
+MQTT_PARTITION_LEASE_SECONDS = float(os.environ.get('MQTT_PARTITION_LEASE_SECONDS', '15'))
+MQTT_PARTITION_RENEW_SECONDS = float(os.environ.get('MQTT_PARTITION_RENEW_SECONDS', '5'))
+# Lead time of a handover: the claimant must renew (and learn of it) within this
+MQTT_PARTITION_HANDOVER_SECONDS = float(os.environ.get('MQTT_PARTITION_HANDOVER_SECONDS',
+                                                       str(MQTT_PARTITION_RENEW_SECONDS * 2)))
+# Longest a stopping worker waits for others to take its partitions before releasing them
+MQTT_PARTITION_DRAIN_SECONDS = float(os.environ.get('MQTT_PARTITION_DRAIN_SECONDS',
+                                                    str(MQTT_PARTITION_RENEW_SECONDS * 2 + MQTT_PARTITION_HANDOVER_SECONDS)))
+
+BRIDGE_PARTITIONS_COLLECTION = 'bridge_partitions'
+BRIDGE_WORKERS_COLLECTION = 'bridge_workers'
+
+
+async def ensure_partition_indexes(db) -> None:
+    await db[BRIDGE_PARTITIONS_COLLECTION].create_index([('owner', ASCENDING)], name='partition_owner')
+    await db[BRIDGE_WORKERS_COLLECTION].create_index([('expires_at', ASCENDING)], name='worker_expiry')
+
+
+def partition_of(patrol_id: str, partitions: int = MQTT_PARTITIONS) -> int:
+    return zlib.crc32(patrol_id.encode('utf-8')) % partitions
+
+
+class PartitionLeases:
+    """
+    Partitions held by this worker. owns() is called from the paho thread; it
+    reads a frozenset and dicts that the renew task replaces whole.
+    """
+
+    def __init__(self, partitions: int = MQTT_PARTITIONS, lease_seconds: float = MQTT_PARTITION_LEASE_SECONDS,
+                 renew_seconds: float = MQTT_PARTITION_RENEW_SECONDS,
+                 handover_seconds: float = MQTT_PARTITION_HANDOVER_SECONDS,
+                 drain_seconds: float = MQTT_PARTITION_DRAIN_SECONDS):
+        self.partitions = partitions
+        self.lease_seconds = lease_seconds
+        self.renew_seconds = renew_seconds
+        self.handover_seconds = handover_seconds
+        self.drain_seconds = drain_seconds
+        self.worker_id: Optional[str] = None
+        self.enabled = False  # Single worker: every patrol is ours
+        self.db = None
+        self._owned: FrozenSet[int] = frozenset()
+        self._valid_until = 0.0  # Monotonic time our leases are known to last until
+        self._starts: Dict[int, float] = {}    # Handed to us: monotonic time we take over
+        self._handing: Dict[int, float] = {}   # Handed away: monotonic time we keep them until
+        self._wants = 0
+        self._leaving = False
+        self._task: Optional[asyncio.Task] = None
+
+        self.claims = 0
+        self.releases = 0
+        self.errors = 0
+
+    def owns(self, patrol_id: str) -> bool:
+        if not self.enabled:
+            return True
+        now = time.monotonic()
+        partition = partition_of(patrol_id, self.partitions)
+        if now < self._handing.get(partition, 0.0):
+            return True
+        if now >= self._valid_until or partition not in self._owned:
+            return False
+        return now >= self._starts.get(partition, 0.0)
+
+    async def start(self, db, worker_id: str) -> None:
+        self.db = db
+        self.worker_id = worker_id
+        self.enabled = True
+        self._leaving = False
+        collection = db[BRIDGE_PARTITIONS_COLLECTION]
+        for partition in range(self.partitions):
+            try:
+                await collection.update_one(
+                    {'_id': partition},
+                    {'$setOnInsert': {'owner': None, 'expires_at': datetime.fromtimestamp(0, tz=timezone.utc)}},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass  # Another worker created it at the same time
+        await self.renew()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _cancel_task(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def drain(self) -> None:
+        """
+        Hand our partitions to the other workers while we still handle their fixes.
+        Call before the MQTT client stops; whatever nobody took is released by stop().
+        """
+        if not self.enabled or self.db is None:
+            return
+        await self._cancel_task()
+        self._leaving = True
+        deadline = time.monotonic() + self.drain_seconds
+        try:
+            # Out of the worker count, so the others' share grows and they start waiting for ours
+            await self.db[BRIDGE_WORKERS_COLLECTION].delete_one({'_id': self.worker_id})
+            while self._owned and time.monotonic() < deadline:
+                now = datetime.now(timezone.utc)
+                others = await self.db[BRIDGE_WORKERS_COLLECTION].count_documents(
+                    {'_id': {'$ne': self.worker_id}, 'expires_at': {'$gt': now}}
+                )
+                if not others:
+                    break
+                await self.renew()
+                if self._owned:
+                    await asyncio.sleep(min(self.renew_seconds, max(0.0, deadline - time.monotonic())))
+        except Exception as e:
+            self.errors += 1
+            print(f"Could not hand over bridge partitions: {e}")
+        # Keep handling what we handed over until the new owners take it
+        last = max(self._handing.values(), default=0.0)
+        if last > time.monotonic():
+            await asyncio.sleep(last - time.monotonic())
+
+    async def stop(self) -> None:
+        """Give back whatever drain() could not hand over right away instead of letting it expire"""
+        await self._cancel_task()
+        if not self.enabled or self.db is None:
+            return
+        self._handing = {}
+        self._owned = frozenset()
+        try:
+            await self.db[BRIDGE_PARTITIONS_COLLECTION].update_many(
+                {'owner': self.worker_id}, {'$set': {'owner': None}}
+            )
+            await self.db[BRIDGE_WORKERS_COLLECTION].delete_one({'_id': self.worker_id})
+        except Exception as e:
+            print(f"Could not release bridge partitions: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.renew_seconds)
+            try:
+                await self.renew()
+            except Exception as e:
+                self.errors += 1
+                print(f"Bridge partition renewal failed: {e}")  # Leases lapse at _valid_until
+
+    async def renew(self) -> None:
+        """Heartbeat, extend our leases, then hand over or take partitions towards an even share"""
+        started = time.monotonic()
+        now = datetime.now(timezone.utc)
+        clock = time.monotonic()  # Paired with `now` to turn handover moments into monotonic time
+        expires_at = now + timedelta(seconds=self.lease_seconds)
+        partitions = self.db[BRIDGE_PARTITIONS_COLLECTION]
+        workers = self.db[BRIDGE_WORKERS_COLLECTION]
+
+        if self._leaving:
+            target = 0
+        else:
+            await workers.update_one(
+                {'_id': self.worker_id}, {'$set': {'expires_at': expires_at}, '$setOnInsert': {'wants': 0}},
+                upsert=True
+            )
+            live = await workers.count_documents({'expires_at': {'$gt': now}})
+            target = math.ceil(self.partitions / max(1, live))
+
+        await partitions.update_many(
+            {'owner': self.worker_id, 'expires_at': {'$gt': now}}, {'$set': {'expires_at': expires_at}}
+        )
+        starts = {}
+        owned = []
+        async for doc in partitions.find({'owner': self.worker_id, 'expires_at': {'$gt': now}},
+                                         {'_id': 1, 'starts_at': 1}):
+            owned.append(doc['_id'])
+            starts_at = doc.get('starts_at')
+            if starts_at is not None:
+                if starts_at.tzinfo is None:
+                    starts_at = starts_at.replace(tzinfo=timezone.utc)
+                if starts_at > now:
+                    starts[doc['_id']] = clock + (starts_at - now).total_seconds()
+        # Partitions still waiting for their handover moment go last, so they are not passed on again
+        owned.sort(key=lambda partition: (partition in starts, partition))
+        handing = {p: until for p, until in self._handing.items() if until > started}
+
+        if len(owned) > target:
+            handed = await self._hand_over(owned[target:], now, clock)
+            handing.update(handed)
+            owned = [partition for partition in owned if partition not in handed]
+        elif len(owned) < target:
+            free = [doc['_id'] async for doc in partitions.find(
+                {'$or': [{'owner': None}, {'expires_at': {'$lte': now}}]}, {'_id': 1}
+            )]
+            for partition in free[:target - len(owned)]:
+                claimed = await partitions.find_one_and_update(
+                    {'_id': partition, '$or': [{'owner': None}, {'expires_at': {'$lte': now}}]},
+                    {'$set': {'owner': self.worker_id, 'expires_at': expires_at, 'starts_at': None}}
+                )
+                if claimed is not None:
+                    owned.append(partition)
+                    self.claims += 1
+
+        wants = 0 if self._leaving else max(0, target - len(owned))
+        if wants or self._wants:
+            # Surplus holders hand partitions only to workers that are waiting for them (and count
+            # down what they hand over, so this is rewritten from what we actually hold)
+            await workers.update_one({'_id': self.worker_id}, {'$set': {'wants': wants}})
+        self._wants = wants
+
+        # Handed-away and pending partitions are published before the owned set changes
+        self._handing = handing
+        self._starts = starts
+        self._owned = frozenset(owned)
+        self._valid_until = started + self.lease_seconds
+
+    async def _hand_over(self, surplus: list, now: datetime, clock: float) -> Dict[int, float]:
+        """Give surplus partitions to waiting workers; returns {partition: keep handling until}"""
+        partitions = self.db[BRIDGE_PARTITIONS_COLLECTION]
+        workers = self.db[BRIDGE_WORKERS_COLLECTION]
+        starts_at = now + timedelta(seconds=self.handover_seconds)
+        surplus = list(surplus)
+        handed = {}
+
+        waiting = [doc['_id'] async for doc in workers.find(
+            {'_id': {'$ne': self.worker_id}, 'expires_at': {'$gt': now}, 'wants': {'$gt': 0}}, {'_id': 1}
+        )]
+        for worker_id in waiting:
+            while surplus:
+                taken = await workers.find_one_and_update(
+                    {'_id': worker_id, 'expires_at': {'$gt': now}, 'wants': {'$gt': 0}}, {'$inc': {'wants': -1}}
+                )
+                if taken is None:
+                    break
+                partition = surplus.pop()
+                moved = await partitions.find_one_and_update(
+                    {'_id': partition, 'owner': self.worker_id},
+                    {'$set': {'owner': worker_id, 'starts_at': starts_at,
+                              'expires_at': starts_at + timedelta(seconds=self.lease_seconds)}}
+                )
+                if moved is None:
+                    await workers.update_one({'_id': worker_id}, {'$inc': {'wants': 1}})
+                    continue
+                handed[partition] = clock + self.handover_seconds
+                self.releases += 1
+        return handed
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'worker_id': self.worker_id,
+            'partitions': self.partitions,
+            'owned': sorted(self._owned),
+            'starting': sorted(self._starts),
+            'handing_over': sorted(self._handing),
+            'wants': self._wants,
+            'claims': self.claims,
+            'releases': self.releases,
+            'errors': self.errors,
+        }
+
+
+# Global instance, started by the MQTT bridge when MQTT_SHARED_GROUP is set
+partition_leases = PartitionLeases()
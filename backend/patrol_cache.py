@@ -0,0 +1,156 @@
+"""
+In-process Patrol Metadata Cache
+Keeps patrol_id -> (hq_id, name, status, assigned_area, camp_name) in memory
+so the MQTT ingest, broadcast and geofence path does not read the patrol
+document per message.
+
+Entries expire after PATROL_CACHE_TTL_SECONDS. Handlers that change a
+patrol's HQ/name/status should call patrol_cache.refresh(db, patrol_id) or
+patrol_cache.invalidate(patrol_id). The session date is deliberately not
+cached: /api/verify-code and session resets change it on whichever worker
+serves them, so readers use ingest.stored_session_dates instead.
+
+Unknown patrol ids are cached only for PATROL_CACHE_MISS_TTL_SECONDS, so a
+patrol that reports before it is provisioned is picked up within seconds;
+handlers that create patrols call patrol_cache.drop_misses(). The cache holds
+at most PATROL_CACHE_MAX_ENTRIES ids (least recently used go first), however
+many topic ids devices make up.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+PATROL_CACHE_TTL_SECONDS = int(os.environ.get('PATROL_CACHE_TTL_SECONDS', '600'))
+PATROL_CACHE_MISS_TTL_SECONDS = float(os.environ.get('PATROL_CACHE_MISS_TTL_SECONDS', '5'))
+PATROL_CACHE_MAX_ENTRIES = int(os.environ.get('PATROL_CACHE_MAX_ENTRIES', '20000'))
+
+# Fields kept per patrol
+PATROL_META_PROJECTION = {'_id': 0, 'id': 1, 'hq_id': 1, 'name': 1, 'status': 1,
+                          'assigned_area': 1, 'camp_name': 1}
+
+
+def _to_meta(doc: dict) -> dict:
+    return {
+        'hq_id': doc.get('hq_id'),
+        'name': doc.get('name'),
+        'status': doc.get('status'),
+        'assigned_area': doc.get('assigned_area'),
+        'camp_name': doc.get('camp_name'),
+    }
+
+
+class PatrolMetaCache:
+    """Bounded TTL cache of patrol metadata; unknown patrols are cached briefly as misses"""
+
+    def __init__(self, ttl_seconds: int = PATROL_CACHE_TTL_SECONDS,
+                 miss_ttl_seconds: float = PATROL_CACHE_MISS_TTL_SECONDS,
+                 max_entries: int = PATROL_CACHE_MAX_ENTRIES):
+        self.ttl = ttl_seconds
+        self.miss_ttl = miss_ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Optional[dict]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _store(self, patrol_id: str, meta: Optional[dict]) -> None:
+        ttl = self.ttl if meta is not None else self.miss_ttl
+        self._entries[patrol_id] = (time.monotonic() + ttl, meta)
+        self._entries.move_to_end(patrol_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, patrol_id: str) -> Tuple[bool, Optional[dict]]:
+        entry = self._entries.get(patrol_id)
+        if entry is None:
+            return False, None
+        expires_at, meta = entry
+        if expires_at < time.monotonic():
+            del self._entries[patrol_id]
+            return False, None
+        self._entries.move_to_end(patrol_id)
+        return True, meta
+
+    async def warm(self, db, query: Optional[dict] = None) -> int:
+        """Load all patrols (or those matching query) in one read"""
+        count = 0
+        async for doc in db.patrols.find(query or {}, PATROL_META_PROJECTION):
+            self._store(doc['id'], _to_meta(doc))
+            count += 1
+        return count
+
+    async def get(self, db, patrol_id: str) -> Optional[dict]:
+        """Metadata for one patrol, loading it on a miss; None if the patrol does not exist"""
+        found, meta = self._lookup(patrol_id)
+        if found:
+            self.hits += 1
+            return meta
+        self.misses += 1
+        doc = await db.patrols.find_one({'id': patrol_id}, PATROL_META_PROJECTION)
+        meta = _to_meta(doc) if doc else None
+        self._store(patrol_id, meta)
+        return meta
+
+    async def get_many(self, db, patrol_ids: Iterable[str]) -> Dict[str, dict]:
+        """Metadata for several patrols, loading all misses with a single $in read"""
+        result = {}
+        missing = []
+        for patrol_id in patrol_ids:
+            found, meta = self._lookup(patrol_id)
+            if found:
+                self.hits += 1
+                if meta:
+                    result[patrol_id] = meta
+            else:
+                self.misses += 1
+                missing.append(patrol_id)
+
+        if missing:
+            async for doc in db.patrols.find({'id': {'$in': missing}}, PATROL_META_PROJECTION):
+                meta = _to_meta(doc)
+                self._store(doc['id'], meta)
+                result[doc['id']] = meta
+            for patrol_id in missing:
+                if patrol_id not in result:
+                    self._store(patrol_id, None)
+        return result
+
+    def update(self, patrol_id: str, **fields) -> None:
+        """Patch cached fields after a write this process made itself"""
+        found, meta = self._lookup(patrol_id)
+        if found and meta is not None:
+            meta.update(fields)
+
+    async def refresh(self, db, patrol_id: str) -> Optional[dict]:
+        """Reload one patrol, e.g. after its session was started or ended"""
+        self.invalidate(patrol_id)
+        return await self.get(db, patrol_id)
+
+    def invalidate(self, patrol_id: Optional[str] = None) -> None:
+        """Drop one patrol, or everything when patrol_id is None"""
+        if patrol_id is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(patrol_id, None)
+
+    def drop_misses(self) -> None:
+        """Forget cached unknown ids, e.g. after patrols were created"""
+        for patrol_id in [k for k, (_, meta) in self._entries.items() if meta is None]:
+            del self._entries[patrol_id]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0,
+            'evictions': self.evictions,
+        }
+
+
+# Global instance shared by the MQTT bridge and API handlers
+patrol_cache = PatrolMetaCache()
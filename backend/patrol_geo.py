@@ -0,0 +1,86 @@
+"""
+Patrol Geospatial Queries
+Patrols carry a GeoJSON `location` point next to their latitude/longitude
+floats, kept current by the ingest pipeline and indexed 2dsphere, so
+"who is nearest to this SOS" and "who is inside this area" are index
+lookups instead of scans over every patrol.
+"""
+import os
+from typing import List, Optional, Sequence, Tuple
+
+GEO_FIELD = 'location'
+SOS_NEAREST_PATROLS = int(os.environ.get('SOS_NEAREST_PATROLS', '3'))
+SOS_NEAREST_MAX_KM = float(os.environ.get('SOS_NEAREST_MAX_KM', '25'))
+
+NEARBY_PROJECTION = {'_id': 0, 'id': 1, 'name': 1, 'hq_id': 1, 'status': 1, 'unit': 1, 'camp_name': 1,
+                     'latitude': 1, 'longitude': 1, 'is_tracking': 1, 'last_location_time': 1}
+
+
+def geo_point(latitude: float, longitude: float) -> dict:
+    """GeoJSON point (GeoJSON order is longitude, latitude)"""
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+async def ensure_geo_indexes(db) -> int:
+    """2dsphere index on patrols.location; backfills patrols that have a position but no point yet"""
+    result = await db.patrols.update_many(
+        {
+            GEO_FIELD: {'$exists': False},
+            'latitude': {'$gte': -90, '$lte': 90},
+            'longitude': {'$gte': -180, '$lte': 180},
+            '$or': [{'latitude': {'$ne': 0}}, {'longitude': {'$ne': 0}}],  # 0,0 means "no fix yet"
+        },
+        [{'$set': {GEO_FIELD: {'type': 'Point', 'coordinates': ['$longitude', '$latitude']}}}]
+    )
+    await db.patrols.create_index([(GEO_FIELD, '2dsphere')], name='patrol_location_2dsphere')
+    return result.modified_count
+
+
+def _patrol_filter(hq_id: Optional[str], active_only: bool, exclude: Optional[str] = None) -> dict:
+    query: dict = {}
+    if hq_id:
+        query['hq_id'] = hq_id
+    if active_only:
+        query['is_tracking'] = True
+    if exclude:
+        query['id'] = {'$ne': exclude}
+    return query
+
+
+async def nearest_patrols(db, latitude: float, longitude: float, hq_id: Optional[str] = None,
+                          max_distance_m: Optional[float] = None, limit: int = 10,
+                          active_only: bool = True, exclude: Optional[str] = None) -> List[dict]:
+    """Patrols ordered by distance from a point, each with `distance_m`"""
+    geo_near = {
+        'near': geo_point(latitude, longitude),
+        'distanceField': 'distance_m',
+        'spherical': True,
+        'key': GEO_FIELD,
+        'query': _patrol_filter(hq_id, active_only, exclude),
+    }
+    if max_distance_m is not None:
+        geo_near['maxDistance'] = max_distance_m
+    pipeline = [
+        {'$geoNear': geo_near},
+        {'$limit': limit},
+        {'$project': {**NEARBY_PROJECTION, 'distance_m': {'$round': ['$distance_m', 1]}}},
+    ]
+    return await db.patrols.aggregate(pipeline).to_list(limit)
+
+
+def bbox_polygon(min_lat: float, min_lng: float, max_lat: float, max_lng: float) -> List[Tuple[float, float]]:
+    """Box as a polygon; its edges are geodesics, which is close enough at map-view scale"""
+    return [(min_lat, min_lng), (min_lat, max_lng), (max_lat, max_lng), (max_lat, min_lng)]
+
+
+async def patrols_within(db, polygon: Sequence[Tuple[float, float]], hq_id: Optional[str] = None,
+                         active_only: bool = False, limit: int = 1000) -> List[dict]:
+    """Patrols inside a polygon given as (lat, lng) vertices (closed automatically)"""
+    ring = [[lng, lat] for lat, lng in polygon]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    query = {
+        **_patrol_filter(hq_id, active_only),
+        GEO_FIELD: {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [ring]}}},
+    }
+    return await db.patrols.find(query, NEARBY_PROJECTION).limit(limit).to_list(limit)
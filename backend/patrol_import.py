@@ -0,0 +1,203 @@
+"""
+Bulk Patrol Import
+Streams a CSV or XLSX roster through pandas in chunks, validates each row as
+a PatrolCreate and upserts every chunk with one unordered bulk_write.
+Patrols are matched on (hq_id, name, leader_email), so re-importing an
+edited sheet updates patrols instead of duplicating them. The HQ's
+subscription is read once and its patrol limit is applied per chunk.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterator, List, Optional, Set, Tuple
+
+import pandas as pd
+from fastapi import HTTPException
+from pydantic import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+import trail_store
+from models import PatrolCreate
+from patrol_cache import patrol_cache
+from security import sanitize_model, validate_email
+
+IMPORT_CHUNK_SIZE = int(os.environ.get('PATROL_IMPORT_CHUNK_SIZE', '500'))
+IMPORT_MAX_ROWS = int(os.environ.get('PATROL_IMPORT_MAX_ROWS', '10000'))
+SUPER_ADMIN_HQ_ID = 'SUPER_ADMIN'
+
+# Spreadsheet header -> PatrolCreate field (headers are lower-cased, spaces -> underscores)
+COLUMN_ALIASES = {
+    'patrol_name': 'name',
+    'camp': 'camp_name',
+    'email': 'leader_email',
+    'leader': 'leader_email',
+    'mobile': 'phone_number',
+    'phone': 'phone_number',
+    'area': 'assigned_area',
+    'soldiers': 'soldier_ids',
+}
+REQUIRED_COLUMNS = {'name', 'camp_name', 'unit', 'leader_email'}
+
+
+def _normalize_columns(frame: pd.DataFrame) -> pd.DataFrame:
+    columns = [str(c).strip().lower().replace(' ', '_') for c in frame.columns]
+    return frame.set_axis([COLUMN_ALIASES.get(c, c) for c in columns], axis=1)
+
+
+def _read_chunks(source: BinaryIO, filename: str) -> Iterator[pd.DataFrame]:
+    """Chunked reader; CSV streams from the upload, XLSX has to be parsed whole"""
+    options = {'dtype': str, 'keep_default_na': False}
+    if filename.lower().endswith(('.xlsx', '.xlsm')):
+        frame = pd.read_excel(source, engine='openpyxl', **options)
+        for start in range(0, len(frame), IMPORT_CHUNK_SIZE):
+            yield frame.iloc[start:start + IMPORT_CHUNK_SIZE]
+    elif filename.lower().endswith('.csv'):
+        # Blank lines stay rows (skipped below) so row numbers match the file's lines
+        yield from pd.read_csv(source, chunksize=IMPORT_CHUNK_SIZE, skipinitialspace=True,
+                               skip_blank_lines=False, **options)
+    else:
+        raise HTTPException(status_code=400, detail="Upload a .csv or .xlsx file")
+
+
+def _row_to_patrol(row: dict, hq_id: str) -> PatrolCreate:
+    data = {key: value.strip() for key, value in row.items() if isinstance(value, str)}
+    data['soldier_ids'] = [s.strip() for s in data.get('soldier_ids', '').replace(',', ';').split(';') if s.strip()]
+    data['phone_number'] = data.get('phone_number') or None
+    data['assigned_area'] = data.get('assigned_area') or data.get('camp_name', '')
+    data['hq_id'] = hq_id
+    return sanitize_model(PatrolCreate(**data))
+
+
+def _row_errors(exc: ValidationError) -> List[str]:
+    return [f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in exc.errors()]
+
+
+async def _patrol_capacity(db, hq_id: str) -> Tuple[Optional[int], Optional[int]]:
+    """(max_patrols, remaining) for the HQ; None means unlimited. Raises 403/404 like patrol creation."""
+    if hq_id == SUPER_ADMIN_HQ_ID:
+        return None, None
+    hq = await db.hq_users.find_one({'hq_id': hq_id}, {'_id': 0, 'is_super_admin': 1, 'subscription': 1})
+    if not hq:
+        raise HTTPException(status_code=404, detail="HQ not found")
+    subscription = hq.get('subscription')
+    if hq.get('is_super_admin') or not subscription:
+        return None, None  # Legacy HQs without a subscription record are not limited
+
+    expires_at = subscription.get('expires_at')
+    expired = expires_at and trail_store.parse_timestamp(expires_at) < datetime.now(timezone.utc)
+    if subscription.get('status') != 'active' or expired:
+        raise HTTPException(status_code=403, detail="Subscription expired. Renew to add patrols.")
+
+    max_patrols = subscription.get('max_patrols')
+    if max_patrols is None:
+        return None, None
+    existing = await db.patrols.count_documents({'hq_id': hq_id})
+    return max_patrols, max(0, max_patrols - existing)
+
+
+async def import_patrols(db, hq_id: str, source: BinaryIO, filename: str) -> dict:
+    """Validate and upsert every row; returns counts plus a per-row error report"""
+    max_patrols, remaining = await _patrol_capacity(db, hq_id)
+
+    # One query up front tells insert from update for every row of the file
+    known: Set[Tuple[str, str]] = {
+        (p['name'], p['leader_email'])
+        async for p in db.patrols.find({'hq_id': hq_id}, {'_id': 0, 'name': 1, 'leader_email': 1})
+    }
+
+    seen = {}  # key -> first row in this file; unordered upserts of one key could race
+    report = {'received': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0, 'rejected': 0, 'errors': []}
+
+    def reject(row_number: int, errors: List[str]) -> None:
+        report['rejected'] += 1
+        report['errors'].append({'row': row_number, 'errors': errors})
+
+    chunks = _read_chunks(source, filename)
+    row_number = 1  # Header is row 1, so data rows match the spreadsheet's numbering
+    while report['received'] < IMPORT_MAX_ROWS:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        chunk = _normalize_columns(chunk)
+        missing = REQUIRED_COLUMNS - set(chunk.columns)
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Missing columns: {', '.join(sorted(missing))}")
+
+        now = datetime.now(timezone.utc).isoformat()
+        operations, op_rows, new_keys = [], [], set()  # new_keys: rows of this chunk that will insert
+        for row in chunk.to_dict('records'):
+            row_number += 1
+            if not any(v.strip() for v in row.values() if isinstance(v, str)):
+                continue  # Blank spreadsheet row
+            if report['received'] >= IMPORT_MAX_ROWS:
+                report['errors'].append({'row': row_number, 'errors': [
+                    f"Row limit of {IMPORT_MAX_ROWS} reached; this and later rows were not imported"
+                ]})
+                break
+            report['received'] += 1
+            try:
+                patrol = _row_to_patrol(row, hq_id)
+            except ValidationError as e:
+                reject(row_number, _row_errors(e))
+                continue
+            if not validate_email(patrol.leader_email):
+                reject(row_number, ["leader_email: invalid email address"])
+                continue
+
+            key = (patrol.name, patrol.leader_email)
+            if key in seen:
+                reject(row_number, [f"Duplicate of row {seen[key]} (same name and leader_email)"])
+                continue
+            seen[key] = row_number
+            if key not in known:
+                if remaining is not None and len(new_keys) >= remaining:
+                    reject(row_number, [f"Patrol limit reached ({max_patrols} on current plan)"])
+                    continue
+                new_keys.add(key)
+
+            fields = patrol.model_dump(exclude={'name', 'leader_email', 'hq_id'})
+            fields['soldier_count'] = len(patrol.soldier_ids)
+            operations.append(UpdateOne(
+                {'hq_id': hq_id, 'name': patrol.name, 'leader_email': patrol.leader_email},
+                {
+                    '$set': fields,
+                    '$setOnInsert': {
+                        'id': str(uuid.uuid4())[:8].upper(),
+                        'status': 'assigned',
+                        'latitude': 0.0,
+                        'longitude': 0.0,
+                        'is_tracking': False,
+                        'is_approved': False,
+                        'code_verified': False,
+                        'last_update': now,
+                        'created_at': now,
+                    },
+                },
+                upsert=True
+            ))
+            op_rows.append(row_number)
+
+        if not operations:
+            continue
+        try:
+            result = await db.patrols.bulk_write(operations, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for error in details.get('writeErrors', []):
+                reject(op_rows[error['index']], [error.get('errmsg', 'Write failed')])
+
+        inserted = details.get('nUpserted', 0)
+        updated = details.get('nModified', 0)
+        report['inserted'] += inserted
+        report['updated'] += updated
+        report['unchanged'] += details.get('nMatched', 0) - updated
+        if remaining is not None:
+            remaining -= inserted
+        if inserted:
+            patrol_cache.drop_misses()  # New ids may have reported before they existed
+
+    report['limit'] = {'max_patrols': max_patrols, 'remaining': remaining}
+    return report
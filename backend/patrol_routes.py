@@ -0,0 +1,87 @@
+"""
+Patrol API Routes
+Patrol provisioning and geospatial query endpoints. Mount on the main app
+with app.include_router(router).
+"""
+from typing import List, Optional, Tuple
+
+from fastapi import APIRouter, File, HTTPException, Query, UploadFile
+
+from database import get_db
+from patrol_geo import bbox_polygon, nearest_patrols, patrols_within
+from patrol_import import SUPER_ADMIN_HQ_ID, import_patrols
+from security import validate_coordinates, validate_patrol_id
+
+router = APIRouter(prefix="/api")
+
+MAX_POLYGON_VERTICES = 500
+
+
+def _scope(hq_id: str) -> Optional[str]:
+    """Super admin queries every HQ"""
+    return None if hq_id == SUPER_ADMIN_HQ_ID else hq_id
+
+
+def _parse_points(value: str) -> List[Tuple[float, float]]:
+    """'lat,lng;lat,lng;...' -> [(lat, lng), ...]"""
+    try:
+        points = [tuple(float(c) for c in pair.split(',')) for pair in value.split(';') if pair.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Coordinates must be numbers")
+    if any(len(p) != 2 or not validate_coordinates(*p) for p in points):
+        raise HTTPException(status_code=400, detail="Invalid coordinates")
+    return points
+
+
+@router.post("/patrols/import")
+async def import_patrol_roster(hq_id: str, file: UploadFile = File(...)):
+    """
+    Create or update an HQ's patrols from a CSV/XLSX roster.
+    Columns: name, camp_name (or camp), unit, leader_email (or email), and optionally
+    phone_number (or mobile), assigned_area (defaults to the camp) and soldier_ids
+    (separated by ';'). Valid rows are imported even when others fail; the report
+    lists every rejected row by its spreadsheet row number.
+    """
+    if not validate_patrol_id(hq_id):
+        raise HTTPException(status_code=400, detail="Invalid HQ ID format")
+    try:
+        return await import_patrols(get_db(), hq_id, file.file, file.filename or '')
+    finally:
+        await file.close()
+
+
+@router.get("/patrols/nearby")
+async def get_nearby_patrols(hq_id: str, lat: float, lng: float,
+                             radius_km: Optional[float] = Query(None, gt=0, le=500),
+                             limit: int = Query(10, ge=1, le=100), active_only: bool = True):
+    """Patrols nearest to a point (closest first), each with `distance_m`"""
+    if not validate_coordinates(lat, lng):
+        raise HTTPException(status_code=400, detail="Invalid coordinates")
+    return await nearest_patrols(
+        get_db(), lat, lng, hq_id=_scope(hq_id),
+        max_distance_m=radius_km * 1000 if radius_km else None, limit=limit, active_only=active_only
+    )
+
+
+@router.get("/patrols/within")
+async def get_patrols_within(hq_id: str, bbox: Optional[str] = None, polygon: Optional[str] = None,
+                             active_only: bool = False):
+    """
+    Patrols inside an area: `bbox=min_lat,min_lng,max_lat,max_lng` or
+    `polygon=lat,lng;lat,lng;lat,lng;...` (at least three vertices).
+    """
+    if bbox:
+        parts = bbox.split(',')
+        if len(parts) != 4:
+            raise HTTPException(status_code=400, detail="bbox must be min_lat,min_lng,max_lat,max_lng")
+        (min_lat, min_lng), (max_lat, max_lng) = _parse_points(f"{parts[0]},{parts[1]};{parts[2]},{parts[3]}")
+        if min_lat >= max_lat or min_lng >= max_lng:
+            raise HTTPException(status_code=400, detail="bbox must be min_lat,min_lng,max_lat,max_lng")
+        vertices = bbox_polygon(min_lat, min_lng, max_lat, max_lng)
+    elif polygon:
+        vertices = _parse_points(polygon)
+        if not 3 <= len(vertices) <= MAX_POLYGON_VERTICES:
+            raise HTTPException(status_code=400, detail=f"Polygon needs 3 to {MAX_POLYGON_VERTICES} vertices")
+    else:
+        raise HTTPException(status_code=400, detail="Pass bbox or polygon")
+    return await patrols_within(get_db(), vertices, hq_id=_scope(hq_id), active_only=active_only)
@@ -4,18 +4,28 @@ Implements authentication, authorization, and protection against common attacks
 """
 import os
 import re
+import math
 import hashlib
 import secrets
+import asyncio
 import bleach
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Tuple
 from functools import wraps
 
 import bcrypt
+import numpy as np
 from jose import JWTError, jwt
 from fastapi import HTTPException, Request, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
+from security_audit import security_audit
+from security_store import LoginGuard, create_counter_store, rate_limit_storage_uri
+
 # =============================================================================
 # CONFIGURATION
 # =============================================================================
@@ -25,15 +35,21 @@ JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', secrets.token_urlsafe(32))
 JWT_ALGORITHM = "HS256"
 JWT_ACCESS_TOKEN_EXPIRE_HOURS = 24
 JWT_REFRESH_TOKEN_EXPIRE_DAYS = 7
+JWT_CACHE_SIZE = int(os.environ.get('JWT_CACHE_SIZE', '4096'))  # 0 disables the decoded-claims cache
+# How long a "not revoked" answer from the shared store is trusted by this worker
+JWT_REVOCATION_CHECK_SECONDS = float(os.environ.get('JWT_REVOCATION_CHECK_SECONDS', '5'))
 
 # Password Configuration
+BCRYPT_ROUNDS = 12
+BCRYPT_POOL_SIZE = int(os.environ.get('BCRYPT_POOL_SIZE', str(min(4, os.cpu_count() or 1))))
+BCRYPT_MAX_PENDING = int(os.environ.get('BCRYPT_MAX_PENDING', '32'))  # running + queued before 503
 PASSWORD_MIN_LENGTH = 8
 PASSWORD_REQUIRE_UPPERCASE = True
 PASSWORD_REQUIRE_LOWERCASE = True
 PASSWORD_REQUIRE_DIGIT = True
 PASSWORD_REQUIRE_SPECIAL = False
 
-# Rate Limiting (handled by slowapi in server.py)
+# Rate Limiting (handled by slowapi in server.py; create_rate_limiter() shares counters across workers)
 LOGIN_RATE_LIMIT = "5/minute"
 API_RATE_LIMIT = "100/minute"
 SOS_RATE_LIMIT = "10/minute"
@@ -63,20 +79,119 @@ SECURITY_HEADERS = {
 
 def hash_password(password: str) -> str:
     """Hash password using bcrypt with salt"""
-    salt = bcrypt.gensalt(rounds=12)
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     hashed = bcrypt.hashpw(password.encode('utf-8'), salt)
     return hashed.decode('utf-8')
 
+def _is_legacy_sha256(hashed_password: str) -> bool:
+    return len(hashed_password) == 64 and all(c in '0123456789abcdef' for c in hashed_password.lower())
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify password against bcrypt hash"""
     try:
-        # Handle legacy plain text passwords (for migration)
+        # Handle legacy plain text and unsalted sha256 (add_10div_patrols.py) hashes for migration
         if not hashed_password.startswith('$2'):
-            return plain_password == hashed_password
+            if _is_legacy_sha256(hashed_password):
+                digest = hashlib.sha256(plain_password.encode('utf-8')).hexdigest()
+                return secrets.compare_digest(digest, hashed_password.lower())
+            return secrets.compare_digest(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
         return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
     except Exception:
         return False
 
+def needs_rehash(hashed_password: str) -> bool:
+    """True for legacy (plain/sha256) hashes and bcrypt hashes below the current cost"""
+    if not hashed_password.startswith('$2'):
+        return True
+    try:
+        return int(hashed_password.split('$')[2]) < BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+class PasswordHasherPool:
+    """
+    Runs bcrypt (~250 ms per call at 12 rounds) in a bounded thread pool so
+    logins do not block the event loop. bcrypt releases the GIL, so threads
+    run in parallel. Once BCRYPT_MAX_PENDING calls are running or queued,
+    new ones fail fast with 503 instead of queueing without bound.
+    """
+    
+    def __init__(self, workers: int = BCRYPT_POOL_SIZE, max_pending: int = BCRYPT_MAX_PENDING):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_pending_seen = 0
+    
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Authentication service busy, please retry",
+                headers={"Retry-After": "2"}
+            )
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        self.pending += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+    
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+    
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        if not hashed_password.startswith('$2'):
+            return verify_password(plain_password, hashed_password)  # Legacy checks are cheap
+        return await self._run(verify_password, plain_password, hashed_password)
+    
+    def stats(self) -> dict:
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'max_pending_seen': self.max_pending_seen,
+            'completed': self.completed,
+            'rejected': self.rejected,
+        }
+
+password_pool = PasswordHasherPool()
+
+async def hash_password_async(password: str) -> str:
+    """hash_password without blocking the event loop (503 when the pool is saturated)"""
+    return await password_pool.hash(password)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """verify_password without blocking the event loop (503 when the pool is saturated)"""
+    return await password_pool.verify(plain_password, hashed_password)
+
+async def verify_and_upgrade_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """
+    Verify a password; on success with a legacy or weak hash also return a fresh
+    bcrypt hash the caller should store (None when no upgrade is needed)
+    """
+    if not await verify_password_async(plain_password, hashed_password):
+        return False, None
+    if needs_rehash(hashed_password):
+        return True, await hash_password_async(plain_password)
+    return True, None
+
+async def authenticate_password(collection, query: dict, plain_password: str, hashed_password: str,
+                                field: str = "password_hash") -> bool:
+    """Login check that transparently rewrites legacy hashes in `collection` on success"""
+    verified, upgraded = await verify_and_upgrade_password(plain_password, hashed_password)
+    if upgraded:
+        # Guarded on the old value so a concurrent password change is never overwritten
+        await collection.update_one({**query, field: hashed_password}, {'$set': {field: upgraded}})
+        log_security_event("PASSWORD_HASH_UPGRADED", {"query": {k: str(v) for k, v in query.items()}})
+    return verified
+
 def validate_password_strength(password: str) -> tuple[bool, str]:
     """Validate password meets security requirements"""
     if len(password) < PASSWORD_MIN_LENGTH:
@@ -112,6 +227,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     to_encode.update({
         "exp": expire,
         "iat": datetime.now(timezone.utc),
+        "jti": secrets.token_urlsafe(12),
         "type": "access"
     })
     return jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
@@ -123,6 +239,7 @@ def create_refresh_token(data: dict) -> str:
     to_encode.update({
         "exp": expire,
         "iat": datetime.now(timezone.utc),
+        "jti": secrets.token_urlsafe(12),
         "type": "refresh"
     })
     return jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
@@ -135,30 +252,234 @@ def decode_token(token: str) -> Optional[dict]:
     except JWTError:
         return None
 
-def verify_token(token: str, token_type: str = "access") -> Optional[dict]:
-    """Verify token and check type"""
-    payload = decode_token(token)
+def _token_id(token: str, payload: Optional[dict] = None) -> str:
+    """Revocation key: the jti claim, or a digest of the token for tokens issued without one"""
+    if payload and payload.get("jti"):
+        return payload["jti"]
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+class TokenClaimsCache:
+    """
+    Bounded LRU of token -> decoded claims, so repeat requests with the same
+    token skip signature verification and claim parsing. Entries never outlive
+    the token's exp; callers get their own copy of the claims.
+
+    Revocations are written to the shared counter store (SECURITY_STORE_URL) so
+    every worker sees them; each worker also remembers the ones it has seen, and
+    trusts a "not revoked" answer for JWT_REVOCATION_CHECK_SECONDS.
+    """
+    
+    def __init__(self, max_size: int = JWT_CACHE_SIZE, store=None,
+                 check_seconds: float = JWT_REVOCATION_CHECK_SECONDS):
+        self.max_size = max_size
+        self.check_seconds = check_seconds
+        self._store = store
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # token -> (claims, exp, token_id)
+        self._revoked: Dict[str, float] = {}  # token_id -> exp (kept until the token would expire anyway)
+        self._checked: "OrderedDict[str, float]" = OrderedDict()  # token_id -> shared answer trusted until
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.revoked_rejections = 0
+    
+    def get(self, token: str) -> Optional[dict]:
+        if self.max_size <= 0:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            claims, exp, token_id = entry
+            if exp <= now:
+                del self._entries[token]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return dict(claims)
+    
+    def put(self, token: str, claims: dict) -> None:
+        exp = claims.get("exp")
+        if self.max_size <= 0 or not isinstance(exp, (int, float)):
+            return  # Tokens without exp are never cached
+        with self._lock:
+            self._entries[token] = (dict(claims), exp, _token_id(token, claims))
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = create_counter_store()
+        return self._store
+    
+    def _remember_revoked(self, token_id: str, exp: float) -> None:
+        now = time.time()
+        with self._lock:
+            # Ids of tokens that have expired anyway are no longer needed
+            for expired_id in [t for t, t_exp in self._revoked.items() if t_exp <= now]:
+                del self._revoked[expired_id]
+            self._revoked[token_id] = exp
+            self._checked.pop(token_id, None)
+    
+    async def revoke(self, token: str) -> None:
+        """Reject a token from now on, on every worker (logout, compromised session)"""
+        payload = decode_token(token)
+        exp = payload.get("exp") if payload else None
+        if not isinstance(exp, (int, float)):
+            exp = time.time() + 86400
+        token_id = _token_id(token, payload)
+        self._remember_revoked(token_id, exp)
+        with self._lock:
+            self._entries.pop(token, None)
+        await self.store.set(f"token_revoked:{token_id}", 1, max(1, int(exp - time.time()) + 1))
+    
+    def is_revoked(self, token: str, claims: dict) -> bool:
+        """Revoked as far as this worker knows (no store round trip)"""
+        if not self._revoked:
+            return False
+        revoked = _token_id(token, claims) in self._revoked
+        if revoked:
+            self.revoked_rejections += 1
+        return revoked
+    
+    async def is_revoked_shared(self, token: str, claims: dict) -> bool:
+        """Revoked on any worker; the store is asked at most every check_seconds per token"""
+        if self.is_revoked(token, claims):
+            return True
+        token_id = _token_id(token, claims)
+        now = time.monotonic()
+        with self._lock:
+            trusted_until = self._checked.get(token_id)
+        if trusted_until is not None and trusted_until > now:
+            return False
+        if await self.store.get(f"token_revoked:{token_id}"):
+            exp = claims.get("exp")
+            self._remember_revoked(token_id, exp if isinstance(exp, (int, float)) else time.time() + 86400)
+            self.revoked_rejections += 1
+            return True
+        with self._lock:
+            self._checked[token_id] = now + self.check_seconds
+            self._checked.move_to_end(token_id)
+            while len(self._checked) > max(self.max_size, 1):
+                self._checked.popitem(last=False)
+        return False
+    
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+            'expired': self.expired,
+            'evictions': self.evictions,
+            'revoked': len(self._revoked),
+            'revoked_rejections': self.revoked_rejections,
+        }
+
+token_cache = TokenClaimsCache()
+
+# Loop the shared store's clients belong to; sync wrappers schedule their work on it
+_store_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def _bind_store_loop() -> None:
+    global _store_loop
+    _store_loop = asyncio.get_running_loop()
+
+def _run_sync(func, *args):
+    """
+    Run a shared-store coroutine function from sync code: from a threadpool worker it
+    runs on the app's loop, from a script on a loop of its own
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError(f"Blocking call inside the event loop; await {func.__name__}() instead")
+    loop = _store_loop
+    if loop is not None and loop.is_running():
+        return asyncio.run_coroutine_threadsafe(func(*args), loop).result()
+    return asyncio.run(func(*args))
+
+async def revoke_token_async(token: str) -> None:
+    """Revoke a token (e.g. on logout) on every worker; it fails verification even while cached"""
+    _bind_store_loop()
+    await token_cache.revoke(token)
+
+def revoke_token(token: str) -> None:
+    """Blocking revoke_token_async for sync callers"""
+    _run_sync(revoke_token_async, token)
+
+def _verified_claims(token: str, token_type: str) -> Optional[dict]:
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = decode_token(token)
+        if payload:
+            token_cache.put(token, payload)
     if payload and payload.get("type") == token_type:
         return payload
     return None
 
+def verify_token(token: str, token_type: str = "access") -> Optional[dict]:
+    """
+    Verify token and check type (decoded claims are cached until exp). Only sees
+    revocations this worker knows of; request handlers use verify_token_async.
+    """
+    payload = _verified_claims(token, token_type)
+    if payload and not token_cache.is_revoked(token, payload):
+        return payload
+    return None
+
+async def verify_token_async(token: str, token_type: str = "access") -> Optional[dict]:
+    """verify_token that also honours revocations made on other workers"""
+    _bind_store_loop()
+    payload = _verified_claims(token, token_type)
+    if payload and not await token_cache.is_revoked_shared(token, payload):
+        return payload
+    return None
+
 # =============================================================================
 # INPUT SANITIZATION
 # =============================================================================
 
+MAX_INPUT_LENGTH = 10000
+
+# Only strings containing one of these can be changed by bleach or the NoSQL
+# strip below ('>' because bleach escapes it); anything else is returned as is
+_SANITIZE_TRIGGER = re.compile(r'[<>&\$\{\}]')
+_NOSQL_CHARS = re.compile(r'[\$\{\}]')
+
 def sanitize_input(text: str) -> str:
     """Sanitize user input to prevent XSS and injection attacks"""
     if not text:
         return text
     
+    # Fast path: plain text skips the HTML parser entirely
+    if not _SANITIZE_TRIGGER.search(text):
+        return text[:MAX_INPUT_LENGTH]
+    
     # Remove HTML tags
     cleaned = bleach.clean(text, tags=ALLOWED_HTML_TAGS, attributes=ALLOWED_HTML_ATTRS, strip=True)
     
     # Remove potential NoSQL injection patterns
-    cleaned = re.sub(r'[\$\{\}]', '', cleaned)
+    cleaned = _NOSQL_CHARS.sub('', cleaned)
     
     # Limit length to prevent DoS
-    return cleaned[:10000]
+    return cleaned[:MAX_INPUT_LENGTH]
 
 def sanitize_dict(data: dict) -> dict:
     """Sanitize all string values in a dictionary"""
@@ -174,6 +495,34 @@ def sanitize_dict(data: dict) -> dict:
             sanitized[key] = value
     return sanitized
 
+_free_text_fields: Dict[type, Tuple[str, ...]] = {}
+
+def free_text_fields(model_cls) -> Tuple[str, ...]:
+    """Names of the fields a pydantic model marks with models.FREE_TEXT (cached per class)"""
+    fields = _free_text_fields.get(model_cls)
+    if fields is None:
+        fields = tuple(
+            name for name, info in model_cls.model_fields.items()
+            if isinstance(info.json_schema_extra, dict) and info.json_schema_extra.get('free_text')
+        )
+        _free_text_fields[model_cls] = fields
+    return fields
+
+def sanitize_model(model):
+    """
+    Schema-driven sanitization: clean only the declared free-text fields of a
+    validated model. Identifiers, emails, phone numbers, enums and numbers are left
+    alone: their model fields constrain them to characters that cannot form markup.
+    """
+    updates = {}
+    for name in free_text_fields(type(model)):
+        value = getattr(model, name)
+        if isinstance(value, str):
+            cleaned = sanitize_input(value)
+            if cleaned is not value:
+                updates[name] = cleaned
+    return model.model_copy(update=updates) if updates else model
+
 def validate_email(email: str) -> bool:
     """Validate email format"""
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -187,59 +536,80 @@ def validate_coordinates(lat: float, lng: float) -> bool:
     """Validate GPS coordinates"""
     return -90 <= lat <= 90 and -180 <= lng <= 180
 
+def validate_coordinates_array(lats, lngs) -> np.ndarray:
+    """Vectorized validate_coordinates: boolean mask of valid (lat, lng) pairs"""
+    lats = np.asarray(lats, dtype=np.float64)
+    lngs = np.asarray(lngs, dtype=np.float64)
+    return (np.isfinite(lats) & np.isfinite(lngs)
+            & (lats >= -90) & (lats <= 90) & (lngs >= -180) & (lngs <= 180))
+
+MAX_ACCURACY_METERS = 100000.0
+
+def parse_accuracy(value) -> Optional[float]:
+    """Device-reported accuracy in metres; None when missing, not a number, or not in (0, MAX_ACCURACY_METERS]"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        accuracy = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(accuracy) or not 0 < accuracy <= MAX_ACCURACY_METERS:
+        return None
+    return accuracy
+
 # =============================================================================
 # ACCOUNT LOCKOUT
 # =============================================================================
 
-# In-memory storage for failed login attempts (use Redis in production)
-_failed_attempts: Dict[str, Dict[str, Any]] = {}
+# Shared (multi-worker) lockout, stored according to SECURITY_STORE_URL
+# (memory, Mongo TTL collection or Redis)
+login_guard = LoginGuard(MAX_FAILED_LOGIN_ATTEMPTS, LOCKOUT_DURATION_MINUTES)
 
-def record_failed_login(username: str) -> None:
+async def record_failed_login_async(username: str) -> None:
     """Record a failed login attempt"""
-    now = datetime.now(timezone.utc)
-    if username not in _failed_attempts:
-        _failed_attempts[username] = {"count": 0, "first_attempt": now, "locked_until": None}
-    
-    _failed_attempts[username]["count"] += 1
-    _failed_attempts[username]["last_attempt"] = now
-    
-    if _failed_attempts[username]["count"] >= MAX_FAILED_LOGIN_ATTEMPTS:
-        _failed_attempts[username]["locked_until"] = now + timedelta(minutes=LOCKOUT_DURATION_MINUTES)
+    _bind_store_loop()
+    await login_guard.record_failure(username)
 
-def clear_failed_attempts(username: str) -> None:
+async def clear_failed_attempts_async(username: str) -> None:
     """Clear failed login attempts after successful login"""
-    if username in _failed_attempts:
-        del _failed_attempts[username]
+    _bind_store_loop()
+    await login_guard.clear(username)
 
-def is_account_locked(username: str) -> tuple[bool, Optional[int]]:
+async def is_account_locked_async(username: str) -> tuple[bool, Optional[int]]:
     """Check if account is locked due to failed attempts"""
-    if username not in _failed_attempts:
-        return False, None
-    
-    record = _failed_attempts[username]
-    if record.get("locked_until"):
-        now = datetime.now(timezone.utc)
-        if now < record["locked_until"]:
-            remaining = int((record["locked_until"] - now).total_seconds() / 60)
-            return True, remaining
-        else:
-            # Lockout expired, clear record
-            del _failed_attempts[username]
-    
-    return False, None
+    _bind_store_loop()
+    return await login_guard.is_locked(username)
 
-def get_remaining_attempts(username: str) -> int:
+async def get_remaining_attempts_async(username: str) -> int:
     """Get remaining login attempts before lockout"""
-    if username not in _failed_attempts:
-        return MAX_FAILED_LOGIN_ATTEMPTS
-    return max(0, MAX_FAILED_LOGIN_ATTEMPTS - _failed_attempts[username]["count"])
+    _bind_store_loop()
+    return await login_guard.remaining_attempts(username)
+
+# Blocking forms of the above for sync callers (threadpool handlers, scripts)
+def record_failed_login(username: str) -> None:
+    _run_sync(record_failed_login_async, username)
+
+def clear_failed_attempts(username: str) -> None:
+    _run_sync(clear_failed_attempts_async, username)
+
+def is_account_locked(username: str) -> tuple[bool, Optional[int]]:
+    return _run_sync(is_account_locked_async, username)
+
+def get_remaining_attempts(username: str) -> int:
+    return _run_sync(get_remaining_attempts_async, username)
+
+def create_rate_limiter():
+    """slowapi Limiter whose counters live in the same shared store as lockouts"""
+    from slowapi import Limiter
+    from slowapi.util import get_remote_address
+    return Limiter(key_func=get_remote_address, storage_uri=rate_limit_storage_uri())
 
 # =============================================================================
 # SECURITY LOGGING
 # =============================================================================
 
 def log_security_event(event_type: str, details: dict, request: Optional[Request] = None) -> None:
-    """Log security-related events"""
+    """Log security-related events (see security_audit for storage and aggregation)"""
     log_entry = {
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "event_type": event_type,
@@ -251,8 +621,8 @@ def log_security_event(event_type: str, details: dict, request: Optional[Request
         log_entry["user_agent"] = request.headers.get("user-agent", "unknown")
         log_entry["path"] = str(request.url.path)
     
-    # In production, send to proper logging service
-    print(f"[SECURITY] {log_entry}")
+    # Queued for the batched audit writer; never blocks the request
+    security_audit.record(log_entry)
 
 # =============================================================================
 # AUTHORIZATION HELPERS
@@ -270,7 +640,7 @@ class JWTBearer(HTTPBearer):
             if credentials.scheme != "Bearer":
                 raise HTTPException(status_code=403, detail="Invalid authentication scheme")
             
-            payload = verify_token(credentials.credentials)
+            payload = await verify_token_async(credentials.credentials)
             if not payload:
                 raise HTTPException(status_code=403, detail="Invalid or expired token")
             
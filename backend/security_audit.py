@@ -0,0 +1,244 @@
+"""
+Security Audit Log
+Non-blocking pipeline behind log_security_event. Events are queued from the
+request path (thread-safe, never awaits) and a background task writes them in
+batches to a capped Mongo collection and/or a rotating JSON-lines file.
+
+Repeats of an identical event (same type, IP and details) within
+SECURITY_LOG_AGGREGATE_SECONDS are counted instead of written; when the window
+closes one summary event records how many there were, e.g. 120 failed logins
+for one username from one IP in 60s.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+
+import orjson
+from pymongo import DESCENDING
+
+SECURITY_LOG_COLLECTION = 'security_events'
+SECURITY_LOG_MONGO = os.environ.get('SECURITY_LOG_MONGO', '1') == '1'
+SECURITY_LOG_CAPPED_BYTES = int(os.environ.get('SECURITY_LOG_CAPPED_BYTES', str(64 * 1024 * 1024)))
+SECURITY_LOG_FILE = os.environ.get('SECURITY_LOG_FILE', '')  # e.g. /var/log/patrol/security.jsonl
+SECURITY_LOG_FILE_MAX_BYTES = int(os.environ.get('SECURITY_LOG_FILE_MAX_BYTES', str(10 * 1024 * 1024)))
+SECURITY_LOG_FILE_BACKUPS = int(os.environ.get('SECURITY_LOG_FILE_BACKUPS', '5'))
+SECURITY_LOG_FLUSH_SECONDS = float(os.environ.get('SECURITY_LOG_FLUSH_SECONDS', '1.0'))
+SECURITY_LOG_BATCH_SIZE = int(os.environ.get('SECURITY_LOG_BATCH_SIZE', '500'))
+SECURITY_LOG_MAX_PENDING = int(os.environ.get('SECURITY_LOG_MAX_PENDING', '10000'))
+SECURITY_LOG_AGGREGATE_SECONDS = float(os.environ.get('SECURITY_LOG_AGGREGATE_SECONDS', '60'))
+SECURITY_LOG_MAX_AGGREGATES = int(os.environ.get('SECURITY_LOG_MAX_AGGREGATES', '10000'))
+
+
+async def ensure_security_log_collection(db) -> None:
+    """Create the capped events collection and its query index if missing"""
+    existing = await db.list_collection_names(filter={'name': SECURITY_LOG_COLLECTION})
+    if not existing:
+        await db.create_collection(SECURITY_LOG_COLLECTION, capped=True, size=SECURITY_LOG_CAPPED_BYTES)
+    await db[SECURITY_LOG_COLLECTION].create_index([('event_type', 1), ('ts', DESCENDING)], name='type_ts')
+
+
+class _Aggregate:
+    __slots__ = ('entry', 'started', 'repeats', 'last_seen')
+
+    def __init__(self, entry: dict, started: float):
+        self.entry = entry
+        self.started = started
+        self.repeats = 0
+        self.last_seen = entry['timestamp']
+
+
+class SecurityAuditLog:
+    """Bounded event queue plus batch writer; record() is safe from any thread"""
+
+    def __init__(self, max_pending: int = SECURITY_LOG_MAX_PENDING,
+                 aggregate_seconds: float = SECURITY_LOG_AGGREGATE_SECONDS):
+        self.max_pending = max_pending
+        self.aggregate_seconds = aggregate_seconds
+        self._queue: deque = deque()
+        self._aggregates: Dict[bytes, _Aggregate] = {}
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._db = None
+        self._file_logger: Optional[logging.Logger] = None
+
+        self.received = 0
+        self.aggregated = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @staticmethod
+    def _signature(entry: dict) -> bytes:
+        return orjson.dumps(
+            [entry.get('event_type'), entry.get('ip'), entry.get('details')],
+            option=orjson.OPT_SORT_KEYS, default=str
+        )
+
+    def _append(self, entry: dict) -> None:
+        if len(self._queue) >= self.max_pending:
+            self.dropped += 1
+        else:
+            self._queue.append(entry)
+
+    def _summary(self, aggregate: _Aggregate) -> dict:
+        return {
+            **aggregate.entry,
+            'timestamp': aggregate.last_seen,
+            'first_seen': aggregate.entry['timestamp'],
+            'repeats': aggregate.repeats,
+            'window_seconds': self.aggregate_seconds,
+            'aggregated': True,
+        }
+
+    def record(self, entry: dict) -> None:
+        """Queue an event; identical repeats inside the window only bump a counter"""
+        if self._task is None:
+            # Writer not running (scripts, tests): keep the old stdout behaviour
+            print(f"[SECURITY] {entry}")
+            return
+
+        signature = self._signature(entry)
+        now = time.monotonic()
+        with self._lock:
+            self.received += 1
+            aggregate = self._aggregates.get(signature)
+            if aggregate is not None:
+                if now - aggregate.started < self.aggregate_seconds:
+                    aggregate.repeats += 1
+                    aggregate.last_seen = entry['timestamp']
+                    self.aggregated += 1
+                    return
+                del self._aggregates[signature]
+                if aggregate.repeats:
+                    self._append(self._summary(aggregate))
+            if len(self._aggregates) < SECURITY_LOG_MAX_AGGREGATES:
+                self._aggregates[signature] = _Aggregate(entry, now)
+            self._append(entry)
+
+    def _close_windows(self, force: bool = False) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                signature for signature, aggregate in self._aggregates.items()
+                if force or now - aggregate.started >= self.aggregate_seconds
+            ]
+            for signature in expired:
+                aggregate = self._aggregates.pop(signature)
+                if aggregate.repeats:
+                    self._append(self._summary(aggregate))
+
+    def _take(self, limit: int) -> List[dict]:
+        with self._lock:
+            count = min(limit, len(self._queue))
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _write_file(self, batch: List[dict]) -> None:
+        for entry in batch:
+            self._file_logger.info(orjson.dumps(entry, default=str).decode())
+
+    async def _write(self, batch: List[dict]) -> None:
+        if self._db is not None:
+            docs = [{**entry, 'ts': datetime.fromisoformat(entry['timestamp'])} for entry in batch]
+            await self._db[SECURITY_LOG_COLLECTION].insert_many(docs, ordered=False)
+        if self._file_logger is not None:
+            await asyncio.to_thread(self._write_file, batch)
+
+    async def flush(self, force: bool = False) -> int:
+        """Write everything queued (closing finished aggregation windows first)"""
+        self._close_windows(force)
+        written = 0
+        while True:
+            batch = self._take(SECURITY_LOG_BATCH_SIZE)
+            if not batch:
+                return written
+            try:
+                await self._write(batch)
+                written += len(batch)
+                self.written += len(batch)
+            except Exception as e:
+                self.errors += 1
+                print(f"Security audit write failed, {len(batch)} events lost: {e}")
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(SECURITY_LOG_FLUSH_SECONDS)
+            await self.flush()
+
+    async def start(self, db=None) -> None:
+        """Start the writer (call from the event loop at app startup)"""
+        if self._task is not None:
+            return
+        if db is not None and SECURITY_LOG_MONGO:
+            await ensure_security_log_collection(db)
+            self._db = db
+        if SECURITY_LOG_FILE:
+            handler = RotatingFileHandler(
+                SECURITY_LOG_FILE, maxBytes=SECURITY_LOG_FILE_MAX_BYTES, backupCount=SECURITY_LOG_FILE_BACKUPS
+            )
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._file_logger = logging.getLogger('security_audit')
+            self._file_logger.setLevel(logging.INFO)
+            self._file_logger.propagate = False
+            self._file_logger.addHandler(handler)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        print("✓ Security audit log started")
+
+    async def stop(self) -> None:
+        """Stop the writer and flush pending events, including open aggregates"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.flush(force=True)
+        self._task = None
+        if self._file_logger is not None:
+            for handler in list(self._file_logger.handlers):
+                handler.close()
+                self._file_logger.removeHandler(handler)
+            self._file_logger = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._queue)
+            windows = len(self._aggregates)
+        return {
+            'running': self._task is not None,
+            'pending': pending,
+            'open_aggregates': windows,
+            'received': self.received,
+            'aggregated': self.aggregated,
+            'written': self.written,
+            'dropped': self.dropped,
+            'errors': self.errors,
+        }
+
+
+async def query_events(db, event_type: Optional[str] = None, ip: Optional[str] = None,
+                       since: Optional[datetime] = None, until: Optional[datetime] = None,
+                       limit: int = 100) -> List[dict]:
+    """Most recent events first, optionally filtered by type, IP and time range"""
+    query: dict = {}
+    if event_type:
+        query['event_type'] = event_type
+    if ip:
+        query['ip'] = ip
+    if since or until:
+        query['ts'] = {}
+        if since:
+            query['ts']['$gte'] = since
+        if until:
+            query['ts']['$lt'] = until
+    cursor = db[SECURITY_LOG_COLLECTION].find(query, {'_id': 0, 'ts': 0}).sort('ts', DESCENDING).limit(limit)
+    return await cursor.to_list(limit)
+
+
+security_audit = SecurityAuditLog()
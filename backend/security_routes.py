@@ -0,0 +1,35 @@
+"""
+Security API Routes
+Audit event queries for the super-admin dashboard. Mount on the main app
+with app.include_router(router).
+"""
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from database import get_db
+from security import JWTBearer, require_super_admin
+from security_audit import query_events, security_audit
+
+router = APIRouter(prefix="/api/security")
+
+
+@router.get("/events")
+async def get_security_events(event_type: Optional[str] = None, ip: Optional[str] = None,
+                              since: Optional[datetime] = None, until: Optional[datetime] = None,
+                              limit: int = Query(100, ge=1, le=1000),
+                              payload: dict = Depends(JWTBearer())):
+    """
+    Recent security events, newest first. Aggregated entries carry `repeats`,
+    `first_seen` and `window_seconds` for identical events collapsed into one.
+    """
+    if not require_super_admin(payload):
+        raise HTTPException(status_code=403, detail="Super admin access required")
+
+    await security_audit.flush()  # Include events still waiting for the writer
+    events = await query_events(get_db(), event_type, ip, since, until, limit)
+    return {
+        'events': events,
+        'pipeline': security_audit.stats()
+    }
@@ -0,0 +1,270 @@
+"""
+Shared Security State
+Expiring counters for account lockout and rate limiting, behind one small
+interface so several uvicorn workers can share them:
+
+    memory://                       per-process, bounded (default, single worker)
+    mongodb://host:27017            TTL collection in the app database
+    redis://host:6379/0             any Redis-protocol server
+
+Select with SECURITY_STORE_URL. Every backend increments atomically and
+expires keys on its own, so nothing grows without bound under credential
+stuffing.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from typing import Optional, Tuple
+
+from pymongo import ReturnDocument
+
+SECURITY_STORE_URL = os.environ.get('SECURITY_STORE_URL', 'memory://')
+SECURITY_STORE_COLLECTION = 'security_counters'
+MEMORY_STORE_MAX_KEYS = int(os.environ.get('MEMORY_STORE_MAX_KEYS', '100000'))
+
+# Never evicted while live: spraying attempts at other usernames must not lift a
+# lockout or un-revoke a token
+PROTECTED_KEY_PREFIXES = ('login_lock:', 'token_revoked:')
+
+
+class MemoryCounterStore:
+    """
+    Per-process store. Beyond max_keys, expired keys go first, then the least
+    recently written unprotected ones, down to 90% of max_keys so the scan is
+    not repeated on every write.
+    """
+
+    def __init__(self, max_keys: int = MEMORY_STORE_MAX_KEYS):
+        self.max_keys = max_keys
+        self._data: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _live(self, key: str, now: float) -> Optional[Tuple[int, float]]:
+        entry = self._data.get(key)
+        if entry and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def _shrink(self, now: float) -> None:
+        """Called with the lock held once the store is over max_keys"""
+        low_water = int(self.max_keys * 0.9)
+        for key in [k for k, (_, expires_at) in self._data.items() if expires_at <= now]:
+            del self._data[key]
+        if len(self._data) <= low_water:
+            return
+        excess = len(self._data) - low_water
+        victims = []
+        for key in self._data:
+            if not key.startswith(PROTECTED_KEY_PREFIXES):
+                victims.append(key)
+                if len(victims) == excess:
+                    break
+        for key in victims:
+            del self._data[key]
+        self.evictions += len(victims)
+
+    def _write(self, key: str, value: int, expires_at: float, now: float) -> None:
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        if len(self._data) > self.max_keys:
+            self._shrink(now)
+
+    # Synchronous core of the async interface below
+    def incr_now(self, key: str, ttl_seconds: int) -> int:
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            value, expires_at = (entry[0] + 1, entry[1]) if entry else (1, now + ttl_seconds)
+            self._write(key, value, expires_at, now)
+            return value
+
+    def set_now(self, key: str, value: int, ttl_seconds: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._write(key, value, now + ttl_seconds, now)
+
+    def get_now(self, key: str) -> int:
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry else 0
+
+    def ttl_now(self, key: str) -> Optional[float]:
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            return entry[1] - now if entry else None
+
+    def delete_now(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    async def incr(self, key: str, ttl_seconds: int) -> int:
+        return self.incr_now(key, ttl_seconds)
+
+    async def set(self, key: str, value: int, ttl_seconds: int) -> None:
+        self.set_now(key, value, ttl_seconds)
+
+    async def get(self, key: str) -> int:
+        return self.get_now(key)
+
+    async def ttl(self, key: str) -> Optional[float]:
+        return self.ttl_now(key)
+
+    async def delete(self, key: str) -> None:
+        self.delete_now(key)
+
+
+class MongoCounterStore:
+    """
+    Counters in a TTL-indexed collection. Increments are single pipeline
+    updates, so concurrent workers never lose a count; a document whose
+    expiry passed but that the TTL monitor has not reaped yet restarts at 1.
+    """
+
+    def __init__(self, db, collection: str = SECURITY_STORE_COLLECTION):
+        self.db = db
+        self.collection = db[collection]
+        self._indexed = False
+
+    async def _ensure_index(self) -> None:
+        if not self._indexed:
+            await self.collection.create_index('expires_at', expireAfterSeconds=0, name='expires_at_ttl')
+            self._indexed = True
+
+    async def incr(self, key: str, ttl_seconds: int) -> int:
+        await self._ensure_index()
+        now = datetime.now(timezone.utc)
+        alive = {'$gt': ['$expires_at', now]}
+        doc = await self.collection.find_one_and_update(
+            {'_id': key},
+            [{'$set': {
+                'value': {'$cond': [alive, {'$add': ['$value', 1]}, 1]},
+                'expires_at': {'$cond': [alive, '$expires_at', now + timedelta(seconds=ttl_seconds)]},
+            }}],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return doc['value']
+
+    async def set(self, key: str, value: int, ttl_seconds: int) -> None:
+        await self._ensure_index()
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        await self.collection.update_one(
+            {'_id': key}, {'$set': {'value': value, 'expires_at': expires_at}}, upsert=True
+        )
+
+    async def _live(self, key: str) -> Optional[dict]:
+        return await self.collection.find_one({'_id': key, 'expires_at': {'$gt': datetime.now(timezone.utc)}})
+
+    async def get(self, key: str) -> int:
+        doc = await self._live(key)
+        return doc['value'] if doc else 0
+
+    async def ttl(self, key: str) -> Optional[float]:
+        doc = await self._live(key)
+        if not doc:
+            return None
+        expires_at = doc['expires_at']
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return (expires_at - datetime.now(timezone.utc)).total_seconds()
+
+    async def delete(self, key: str) -> None:
+        await self.collection.delete_one({'_id': key})
+
+
+class RedisCounterStore:
+    """
+    Counters on any Redis-protocol server. INCR and TTL run in one MULTI; the
+    window's EXPIRE follows as a separate command when the key has none, so a key
+    left without expiry by a crash in between gets it on its next increment.
+    """
+
+    def __init__(self, url: Optional[str] = None, client=None):
+        if client is None:
+            import redis.asyncio as redis  # Only needed when this backend is selected
+            client = redis.from_url(url)
+        self.redis = client
+
+    async def incr(self, key: str, ttl_seconds: int) -> int:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            value, ttl = await pipe.incr(key).ttl(key).execute()
+        if ttl is None or ttl < 0:
+            # First increment of the window (or a key left without expiry)
+            await self.redis.expire(key, ttl_seconds)
+        return int(value)
+
+    async def set(self, key: str, value: int, ttl_seconds: int) -> None:
+        await self.redis.set(key, value, ex=ttl_seconds)
+
+    async def get(self, key: str) -> int:
+        value = await self.redis.get(key)
+        return int(value) if value is not None else 0
+
+    async def ttl(self, key: str) -> Optional[float]:
+        ttl = await self.redis.ttl(key)
+        return float(ttl) if ttl is not None and ttl >= 0 else None
+
+    async def delete(self, key: str) -> None:
+        await self.redis.delete(key)
+
+
+def create_counter_store(url: str = SECURITY_STORE_URL, db=None):
+    """Build the store for SECURITY_STORE_URL (mongodb uses the app database)"""
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisCounterStore(url)
+    if url.startswith('mongodb'):
+        if db is None:
+            from database import get_db
+            db = get_db()
+        return MongoCounterStore(db)
+    return MemoryCounterStore()
+
+
+def rate_limit_storage_uri() -> str:
+    """storage_uri for slowapi/limits, so request rate limits are shared the same way"""
+    if os.environ.get('RATE_LIMIT_STORAGE_URI'):
+        return os.environ['RATE_LIMIT_STORAGE_URI']
+    if SECURITY_STORE_URL.startswith(('redis://', 'rediss://', 'mongodb://', 'mongodb+srv://')):
+        return SECURITY_STORE_URL
+    return 'memory://'
+
+
+class LoginGuard:
+    """Account lockout on top of a counter store (created on first use)"""
+
+    def __init__(self, max_attempts: int, lockout_minutes: int, store=None):
+        self._store = store
+        self.max_attempts = max_attempts
+        self.lockout_seconds = lockout_minutes * 60
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = create_counter_store()
+        return self._store
+
+    async def record_failure(self, username: str) -> int:
+        """Count a failed login; locks the account once max_attempts is reached"""
+        count = await self.store.incr(f"login_fail:{username}", self.lockout_seconds)
+        if count >= self.max_attempts:
+            await self.store.set(f"login_lock:{username}", 1, self.lockout_seconds)
+        return count
+
+    async def clear(self, username: str) -> None:
+        await self.store.delete(f"login_fail:{username}")
+        await self.store.delete(f"login_lock:{username}")
+
+    async def is_locked(self, username: str) -> Tuple[bool, Optional[int]]:
+        """(locked, minutes remaining)"""
+        remaining = await self.store.ttl(f"login_lock:{username}")
+        if remaining is None or remaining <= 0:
+            return False, None
+        return True, int(remaining // 60)
+
+    async def remaining_attempts(self, username: str) -> int:
+        return max(0, self.max_attempts - await self.store.get(f"login_fail:{username}"))
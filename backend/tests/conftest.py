@@ -0,0 +1,9 @@
+"""
+Unit tests import backend modules directly (the API tests only need BASE_URL)
+"""
+import os
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
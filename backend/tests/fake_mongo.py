@@ -0,0 +1,339 @@
+"""
+In-memory stand-in for the motor collections used by the unit tests.
+Covers the query and update operators the backend modules use; anything else
+raises NotImplementedError so a test never passes on an unsupported query.
+"""
+import copy
+import math
+from typing import Any, Dict, List, Optional
+
+from pymongo.errors import DuplicateKeyError
+
+_MISSING = object()
+EARTH_RADIUS_M = 6378100.0  # What MongoDB uses for spherical distances
+
+
+def _get(doc: dict, path: str):
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _set(doc: dict, path: str, value) -> None:
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def _compare(value, op: str, operand) -> bool:
+    if op == '$eq':
+        return (None if value is _MISSING else value) == operand
+    if op == '$ne':
+        return not _compare(value, '$eq', operand)
+    if op == '$in':
+        return (None if value is _MISSING else value) in operand
+    if op == '$nin':
+        return not _compare(value, '$in', operand)
+    if op == '$exists':
+        return (value is not _MISSING) == bool(operand)
+    if op == '$not':
+        return not _matches_operators(value, operand)
+    if value is _MISSING or value is None:
+        return False
+    if op == '$gt':
+        return value > operand
+    if op == '$gte':
+        return value >= operand
+    if op == '$lt':
+        return value < operand
+    if op == '$lte':
+        return value <= operand
+    if op == '$geoWithin':
+        geometry = operand['$geometry']
+        if geometry['type'] != 'Polygon' or value.get('type') != 'Point':
+            raise NotImplementedError(geometry['type'])
+        return _in_ring(value['coordinates'], geometry['coordinates'][0])
+    raise NotImplementedError(op)
+
+
+def _in_ring(point, ring) -> bool:
+    """Even-odd rule on lng/lat (planar; fine for the small areas tests use)"""
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(ring, ring[1:]):
+        if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+            inside = not inside
+    return inside
+
+
+def _distance_m(a, b) -> float:
+    (lng1, lat1), (lng2, lat2) = a, b
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    h = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+
+def _project_stage(doc: dict, projection: dict) -> dict:
+    """$project with inclusions, _id: 0 and {'$round': ['$field', places]}"""
+    out = {}
+    for field, spec in projection.items():
+        if isinstance(spec, dict):
+            (op, (ref, places)), = spec.items()
+            if op != '$round':
+                raise NotImplementedError(op)
+            value = _get(doc, ref[1:])
+            if value is not _MISSING:
+                out[field] = round(value, places)
+        elif spec and _get(doc, field) is not _MISSING:
+            out[field] = copy.deepcopy(_get(doc, field))
+    if projection.get('_id', 1) and '_id' in doc:
+        out['_id'] = doc['_id']
+    return out
+
+
+def _matches_operators(value, condition) -> bool:
+    if isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition):
+        return all(_compare(value, op, operand) for op, operand in condition.items())
+    return _compare(value, '$eq', condition)
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == '$or':
+            if not any(matches(doc, q) for q in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, q) for q in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(doc, q) for q in condition):
+                return False
+        elif not _matches_operators(_get(doc, key), condition):
+            return False
+    return True
+
+
+def _apply_update(doc: dict, update: dict, inserting: bool) -> None:
+    if isinstance(update, list):
+        raise NotImplementedError('pipeline updates')
+    for op, fields in update.items():
+        for path, value in fields.items():
+            if op == '$set':
+                _set(doc, path, copy.deepcopy(value))
+            elif op == '$setOnInsert':
+                if inserting:
+                    _set(doc, path, copy.deepcopy(value))
+            elif op == '$inc':
+                current = _get(doc, path)
+                _set(doc, path, (0 if current is _MISSING else current) + value)
+            elif op == '$max':
+                current = _get(doc, path)
+                _set(doc, path, value if current is _MISSING else max(current, value))
+            elif op == '$unset':
+                parts = path.split('.')
+                target = _get(doc, '.'.join(parts[:-1])) if len(parts) > 1 else doc
+                if isinstance(target, dict):
+                    target.pop(parts[-1], None)
+            else:
+                raise NotImplementedError(op)
+
+
+class UpdateResult:
+    def __init__(self, matched_count: int, modified_count: int, upserted_id=None):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+        self.upserted_id = upserted_id
+
+
+class BulkWriteResult:
+    def __init__(self, results: List[UpdateResult]):
+        self.bulk_api_result = {
+            'nMatched': sum(r.matched_count for r in results),
+            'nModified': sum(r.modified_count for r in results),
+            'nUpserted': sum(r.upserted_id is not None for r in results),
+        }
+
+
+class DeleteResult:
+    def __init__(self, deleted_count: int):
+        self.deleted_count = deleted_count
+
+
+class FakeCursor:
+    def __init__(self, docs: List[dict]):
+        self._docs = docs
+
+    def sort(self, key, direction=1):
+        keys = key if isinstance(key, list) else [(key, direction)]
+        for field, order in reversed(keys):
+            self._docs.sort(key=lambda d: _get(d, field), reverse=order < 0)
+        return self
+
+    def limit(self, n: int):
+        if n:
+            self._docs = self._docs[:n]
+        return self
+
+    async def to_list(self, length=None):
+        return self._docs if length is None else self._docs[:length]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for doc in self._docs:
+            yield doc
+
+
+class FakeCollection:
+    def __init__(self, unique: Optional[str] = None):
+        self.docs: List[dict] = []
+        self.unique = unique  # Field with a unique index besides _id
+
+    def _check_unique(self, doc: dict, ignore: Optional[dict] = None) -> None:
+        for field in ('_id', self.unique):
+            if field and field in doc and any(d is not ignore and d.get(field) == doc[field] for d in self.docs):
+                raise DuplicateKeyError(f"duplicate {field}: {doc[field]}")
+
+    @staticmethod
+    def _project(doc: dict, projection: Optional[dict]) -> dict:
+        doc = copy.deepcopy(doc)
+        if projection and projection.get('_id') == 0:
+            doc.pop('_id', None)
+        return doc
+
+    def aggregate(self, pipeline: List[dict]) -> FakeCursor:
+        """$geoNear (first stage), $match, $limit and $project"""
+        docs = [copy.deepcopy(d) for d in self.docs]
+        for stage in pipeline:
+            (name, spec), = stage.items()
+            if name == '$geoNear':
+                near = spec['near']['coordinates']
+                found = []
+                for doc in docs:
+                    point = _get(doc, spec['key'])
+                    if point is _MISSING or not matches(doc, spec.get('query', {})):
+                        continue
+                    doc[spec['distanceField']] = _distance_m(near, point['coordinates'])
+                    if spec.get('maxDistance') is None or doc[spec['distanceField']] <= spec['maxDistance']:
+                        found.append(doc)
+                docs = sorted(found, key=lambda d: d[spec['distanceField']])
+            elif name == '$match':
+                docs = [d for d in docs if matches(d, spec)]
+            elif name == '$limit':
+                docs = docs[:spec]
+            elif name == '$project':
+                docs = [_project_stage(d, spec) for d in docs]
+            else:
+                raise NotImplementedError(name)
+        return FakeCursor(docs)
+
+    async def create_index(self, *args, **kwargs):
+        return kwargs.get('name')
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None) -> FakeCursor:
+        return FakeCursor([self._project(d, projection) for d in self.docs if matches(d, query or {})])
+
+    async def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None):
+        for doc in self.docs:
+            if matches(doc, query or {}):
+                return self._project(doc, projection)
+        return None
+
+    async def count_documents(self, query: dict) -> int:
+        return sum(1 for d in self.docs if matches(d, query))
+
+    async def insert_one(self, doc: dict):
+        self._check_unique(doc)
+        self.docs.append(copy.deepcopy(doc))
+
+    async def insert_many(self, docs: List[dict], ordered: bool = True):
+        for doc in docs:
+            await self.insert_one(doc)
+
+    def _upsert_doc(self, query: dict) -> dict:
+        return {k: v for k, v in query.items() if not k.startswith('$') and not isinstance(v, dict)}
+
+    async def update_one(self, query: dict, update: Any, upsert: bool = False) -> UpdateResult:
+        for doc in self.docs:
+            if matches(doc, query):
+                before = copy.deepcopy(doc)
+                _apply_update(doc, update, inserting=False)
+                self._check_unique(doc, ignore=doc)
+                return UpdateResult(1, int(before != doc))
+        if not upsert:
+            return UpdateResult(0, 0)
+        doc = self._upsert_doc(query)
+        _apply_update(doc, update, inserting=True)
+        self._check_unique(doc)
+        self.docs.append(doc)
+        return UpdateResult(0, 0, upserted_id=doc.get('_id', len(self.docs)))
+
+    async def update_many(self, query: dict, update: dict) -> UpdateResult:
+        matched = [d for d in self.docs if matches(d, query)]
+        for doc in matched:
+            _apply_update(doc, update, inserting=False)
+        return UpdateResult(len(matched), len(matched))
+
+    async def find_one_and_update(self, query: dict, update: dict, projection: Optional[dict] = None,
+                                  upsert: bool = False, return_document: bool = False):
+        for doc in self.docs:
+            if matches(doc, query):
+                before = self._project(doc, projection)
+                _apply_update(doc, update, inserting=False)
+                return self._project(doc, projection) if return_document else before
+        if upsert:
+            await self.update_one(query, update, upsert=True)
+            return self._project(self.docs[-1], projection) if return_document else None
+        return None
+
+    async def bulk_write(self, operations: List[Any], ordered: bool = True) -> BulkWriteResult:
+        """UpdateOne operations only"""
+        return BulkWriteResult([await self.update_one(op._filter, op._doc, upsert=op._upsert) for op in operations])
+
+    async def find_one_and_delete(self, query: dict, projection: Optional[dict] = None):
+        for i, doc in enumerate(self.docs):
+            if matches(doc, query):
+                del self.docs[i]
+                return self._project(doc, projection)
+        return None
+
+    async def delete_one(self, query: dict) -> DeleteResult:
+        for i, doc in enumerate(self.docs):
+            if matches(doc, query):
+                del self.docs[i]
+                return DeleteResult(1)
+        return DeleteResult(0)
+
+    async def delete_many(self, query: dict) -> DeleteResult:
+        before = len(self.docs)
+        self.docs = [d for d in self.docs if not matches(d, query)]
+        return DeleteResult(before - len(self.docs))
+
+
+class FakeDB:
+    """db['name'] and db.name both return the same FakeCollection"""
+
+    def __init__(self, unique: Optional[Dict[str, str]] = None):
+        self._collections: Dict[str, FakeCollection] = {}
+        self._unique = unique or {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self._unique.get(name))
+        return self._collections[name]
+
+    def __getattr__(self, name: str) -> FakeCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def list_collection_names(self, filter: Optional[dict] = None) -> List[str]:
+        return [name for name in self._collections if matches({'name': name}, filter or {})]
+
+    async def create_collection(self, name: str, **options) -> FakeCollection:
+        return self[name]  # Capped/time-series options are not modelled
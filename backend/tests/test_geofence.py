@@ -0,0 +1,174 @@
+"""
+Unit tests for the geofence engine (geofence.py) and the KML parser errors it
+relies on, on an in-memory database
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('shapely')
+pytest.importorskip('orjson')
+pytest.importorskip('brotli')
+pytest.importorskip('httpx')
+
+import kml_layers
+from fake_mongo import FakeDB
+from geofence import GeofenceEngine
+from kml_parser import KMLError, parse_kml
+from patrol_cache import patrol_cache
+
+CAMP = (90.0, 23.0, 90.1, 23.1)     # min_lng, min_lat, max_lng, max_lat
+OUTPOST = (90.2, 23.0, 90.3, 23.1)
+INSIDE_CAMP = (23.05, 90.05)         # lat, lng
+INSIDE_OUTPOST = (23.05, 90.25)
+NOWHERE = (24.0, 91.0)
+
+
+def square(name, box) -> dict:
+    west, south, east, north = box
+    ring = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+    return {'type': 'Feature', 'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+            'properties': {'name': name, 'folder': None}}
+
+
+def kml(*placemarks) -> bytes:
+    body = ''.join(
+        f"<Placemark><name>{name}</name><Polygon><outerBoundaryIs><LinearRing>"
+        f"<coordinates>{coordinates}</coordinates></LinearRing></outerBoundaryIs></Polygon></Placemark>"
+        for name, coordinates in placemarks
+    )
+    return f'<kml xmlns="http://www.opengis.net/kml/2.2"><Document>{body}</Document></kml>'.encode()
+
+
+def fix(patrol_id, point, timestamp, hq_id='HQ1') -> dict:
+    return {'patrol_id': patrol_id, 'hq_id': hq_id, 'latitude': point[0], 'longitude': point[1],
+            'timestamp': timestamp}
+
+
+@pytest.fixture(autouse=True)
+def fresh_patrol_cache():
+    patrol_cache.invalidate()
+    yield
+    patrol_cache.invalidate()
+
+
+@pytest.fixture
+def db():
+    db = FakeDB()
+    db.patrols.docs.append({'id': 'P1', 'hq_id': 'HQ1', 'name': 'Alpha', 'assigned_area': 'Patiya'})
+    return db
+
+
+def engine_with_fences() -> GeofenceEngine:
+    engine = GeofenceEngine()
+    engine.load_features('camp.kml', [square('Patiya Army Camp', CAMP), square('Outpost', OUTPOST)], 'HQ1')
+    return engine
+
+
+def kinds(events) -> list:
+    return [(e['event'], e['fence_name']) for e in events]
+
+
+class TestTransitions:
+    def test_enter_exit_and_out_of_area(self, db):
+        engine = engine_with_fences()
+
+        async def scenario():
+            first = await engine.process(db, [fix('P1', INSIDE_CAMP, '2026-01-01T00:00:00+00:00')])
+            moved = await engine.process(db, [fix('P1', INSIDE_OUTPOST, '2026-01-01T00:01:00+00:00')])
+            back = await engine.process(db, [fix('P1', INSIDE_CAMP, '2026-01-01T00:02:00+00:00')])
+            return first, moved, back
+        first, moved, back = asyncio.run(scenario())
+
+        assert first == []  # Baseline inside the assigned area
+        assert kinds(moved) == [('enter', 'Outpost'), ('exit', 'Patiya Army Camp'), ('out_of_area', 'Patiya')]
+        assert kinds(back) == [('enter', 'Patiya Army Camp'), ('exit', 'Outpost'), ('back_in_area', 'Patiya')]
+
+    def test_first_fix_outside_assigned_area_is_reported(self, db):
+        engine = engine_with_fences()
+        events = asyncio.run(engine.process(db, [fix('P1', NOWHERE, '2026-01-01T00:00:00+00:00')]))
+        assert kinds(events) == [('out_of_area', 'Patiya')]
+
+    def test_delayed_fix_on_another_worker_does_not_undo_a_transition(self, db):
+        first, second = engine_with_fences(), engine_with_fences()
+
+        async def scenario():
+            await first.process(db, [fix('P1', INSIDE_CAMP, '2026-01-01T00:00:00+00:00')])
+            left = await first.process(db, [fix('P1', INSIDE_OUTPOST, '2026-01-01T00:02:00+00:00')])
+            stale = await second.process(db, [fix('P1', INSIDE_CAMP, '2026-01-01T00:01:00+00:00')])
+            return left, stale
+        left, stale = asyncio.run(scenario())
+
+        assert kinds(left)[0] == ('enter', 'Outpost')
+        assert stale == []
+        assert second.conflicts == 1
+        stored = db.patrols.docs[0]['geofence']
+        assert stored['inside'] == ['camp.kml:1'] and stored['out_of_area'] is True
+        assert second._state['P1'].inside == ['camp.kml:1']  # Adopted the stored state
+
+    def test_each_transition_is_raised_once_across_workers(self, db):
+        first, second = engine_with_fences(), engine_with_fences()
+
+        async def scenario():
+            await first.process(db, [fix('P1', INSIDE_CAMP, '2026-01-01T00:00:00+00:00')])
+            update = [fix('P1', INSIDE_OUTPOST, '2026-01-01T00:01:00+00:00')]
+            return await first.process(db, update), await second.process(db, update)  # Redelivered
+        once, again = asyncio.run(scenario())
+        assert len(once) == 3 and again == []
+
+    def test_fences_of_other_hqs_are_ignored(self, db):
+        engine = GeofenceEngine()
+        engine.load_features('hq2.kml', [square('Patiya Army Camp', CAMP)], 'HQ2')
+        events = asyncio.run(engine.process(db, [fix('P1', INSIDE_CAMP, '2026-01-01T00:00:00+00:00')]))
+        assert events == []
+        assert db.patrols.docs[0]['geofence']['inside'] == []
+
+
+class TestLoadSources:
+    @pytest.fixture(autouse=True)
+    def layer_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(kml_layers, 'KML_LAYER_DIR', tmp_path)
+
+    def test_sources_keep_their_hq_and_bad_ones_are_skipped(self, db):
+        engine = GeofenceEngine()
+        camp = '90.0,23.0 90.1,23.0 90.1,23.1 90.0,23.1'
+
+        async def scenario():
+            await kml_layers.store_source(db, 'hq1.kml', kml(('Camp', camp)), hq_id='HQ1')
+            await kml_layers.store_source(db, 'hq2.kml', kml(('Depot', camp)), hq_id='HQ2')
+            await kml_layers.store_source(db, 'url:abc', kml(('Overlay', camp)), url='http://example.com/a.kml')
+            await db[kml_layers.KML_LAYER_SOURCES].insert_one(
+                {'source_id': 'broken.kml', 'hq_id': 'HQ1', 'manifest': {'layers': [{'id': '0' * 32}]}}
+            )
+            loaded = await engine.load_sources(db)
+            events = await engine.process(db, [fix('P1', INSIDE_CAMP, '2026-01-01T00:00:00+00:00')])
+            return loaded, events
+        loaded, events = asyncio.run(scenario())
+
+        assert loaded == 2
+        assert {(f.source_id, f.hq_id) for f in engine._fences} == {('hq1.kml', 'HQ1'), ('hq2.kml', 'HQ2')}
+        assert engine.errors == 1
+        assert events == [] and db.patrols.docs[0]['geofence']['inside'] == ['hq1.kml:0']
+
+    def test_deleted_sources_are_dropped(self, db):
+        engine = GeofenceEngine()
+        camp = '90.0,23.0 90.1,23.0 90.1,23.1 90.0,23.1'
+
+        async def scenario():
+            await kml_layers.store_source(db, 'hq1.kml', kml(('Camp', camp)), hq_id='HQ1')
+            await engine.load_sources(db)
+            await kml_layers.remove_source(db, 'hq1.kml')
+            return await engine.load_sources(db)
+        assert asyncio.run(scenario()) == 0
+        assert engine.stats()['sources'] == 0
+
+
+class TestParserErrors:
+    def test_bad_coordinate_is_a_kml_error(self):
+        with pytest.raises(KMLError):
+            parse_kml(kml(('Camp', '90.0,23.0 90.1,abc 90.1,23.1')))
+
+    def test_degenerate_ring_is_dropped(self):
+        # Already closed with only two distinct corners: not a polygon
+        assert parse_kml(kml(('Sliver', '90.0,23.0 90.1,23.0 90.0,23.0')))['features'] == []
@@ -0,0 +1,192 @@
+"""
+Unit tests for the inactivity SOS monitor (inactivity_monitor.py) on an in-memory database
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('pydantic')
+
+from fake_mongo import FakeDB
+from inactivity_monitor import InactivityMonitor, auto_sos_id
+
+
+def minutes_ago(minutes: float) -> str:
+    return (datetime.now(timezone.utc) - timedelta(minutes=minutes)).isoformat()
+
+
+def tracking_patrol(patrol_id: str, last_location_time: str, **fields) -> dict:
+    return {'id': patrol_id, 'hq_id': 'HQ1', 'name': f"Patrol {patrol_id}", 'latitude': 23.8,
+            'longitude': 90.4, 'is_tracking': True, 'last_location_time': last_location_time, **fields}
+
+
+class Alerts:
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, hq_id, patrol_id, message, latitude, longitude, timestamp, auto_triggered=False):
+        self.calls.append((hq_id, patrol_id, message))
+
+
+def monitor_for(db: FakeDB, alerts=None) -> InactivityMonitor:
+    monitor = InactivityMonitor()
+    monitor.db = db
+    monitor.on_alert = alerts
+    return monitor
+
+
+def test_silent_patrol_raises_one_alert():
+    db, alerts = FakeDB(), Alerts()
+    seen = minutes_ago(45)
+    db.patrols.docs.append(tracking_patrol('P1', seen))
+    monitor = monitor_for(db, alerts)
+
+    async def scenario():
+        monitor.touch('P1', 'HQ1', seen)  # Default threshold is 30 minutes: already due
+        await monitor._process_due()
+    asyncio.run(scenario())
+
+    assert [call[1] for call in alerts.calls] == ['P1']
+    alert = db.sos_alerts.docs[0]
+    assert alert['auto_triggered'] and alert['hq_id'] == 'HQ1' and alert['inactive_minutes'] >= 45
+    assert alert['id'] == auto_sos_id('P1', datetime.fromisoformat(seen).timestamp())
+    assert monitor.stats()['watched'] == 0  # Re-armed by the next fix
+
+
+def test_recent_fix_reschedules_instead_of_firing():
+    db, alerts = FakeDB(), Alerts()
+    db.patrols.docs.append(tracking_patrol('P1', minutes_ago(45)))
+    monitor = monitor_for(db, alerts)
+
+    async def scenario():
+        monitor.touch('P1', 'HQ1', minutes_ago(45))
+        monitor.touch('P1', 'HQ1', minutes_ago(1))  # Reported since the entry was pushed
+        await monitor._process_due()
+    asyncio.run(scenario())
+
+    assert alerts.calls == []
+    assert monitor.reschedules == 1
+    assert monitor._watches['P1'].scheduled > datetime.now(timezone.utc).timestamp()
+
+
+def test_newer_fix_stored_by_another_worker_reschedules():
+    db, alerts = FakeDB(), Alerts()
+    db.patrols.docs.append(tracking_patrol('P1', minutes_ago(2)))
+    monitor = monitor_for(db, alerts)
+
+    async def scenario():
+        monitor.touch('P1', 'HQ1', minutes_ago(45))
+        await monitor._process_due()
+    asyncio.run(scenario())
+
+    assert alerts.calls == []
+    assert db.sos_alerts.docs == []
+    assert monitor.reschedules == 1
+
+
+def test_alert_raised_by_another_worker_is_not_repeated():
+    db = FakeDB()
+    seen = minutes_ago(45)
+    db.patrols.docs.append(tracking_patrol('P1', seen))
+    first_alerts, second_alerts = Alerts(), Alerts()
+    first, second = monitor_for(db, first_alerts), monitor_for(db, second_alerts)
+
+    async def scenario():
+        for monitor in (first, second):
+            monitor.touch('P1', 'HQ1', seen)
+        await first._process_due()
+        db.sos_alerts.docs[0]['resolved'] = True  # Resolved already: only the unique id stops a repeat
+        await second._process_due()
+    asyncio.run(scenario())
+
+    assert len(first_alerts.calls) == 1 and second_alerts.calls == []
+    assert len(db.sos_alerts.docs) == 1
+    assert second.duplicates == 1
+
+
+def test_stopped_or_disabled_patrols_are_skipped():
+    db, alerts = FakeDB(), Alerts()
+    db.patrols.docs.append(tracking_patrol('P1', minutes_ago(45), is_tracking=False))
+    db.patrols.docs.append(tracking_patrol('P2', minutes_ago(45), hq_id='HQ2'))
+    monitor = monitor_for(db, alerts)
+    monitor.set_config('HQ2', enabled=False, threshold_minutes=30)
+
+    async def scenario():
+        monitor.touch('P1', 'HQ1', minutes_ago(45))
+        monitor.touch('P2', 'HQ2', minutes_ago(45))
+        await monitor._process_due()
+    asyncio.run(scenario())
+
+    assert alerts.calls == []
+    assert monitor.skipped == 1
+    assert monitor.stats()['watched'] == 0
+
+
+def test_start_watches_patrols_that_were_already_tracking():
+    db, alerts = FakeDB(), Alerts()
+    db.patrols.docs.extend([
+        tracking_patrol('SILENT', minutes_ago(45)),
+        tracking_patrol('ACTIVE', minutes_ago(1)),
+        tracking_patrol('STOPPED', minutes_ago(45), is_tracking=False),
+        tracking_patrol('NEVER', None),
+    ])
+    db.inactivity_config.docs.append({'hq_id': 'HQ1', 'enabled': True, 'threshold_minutes': 30})
+    monitor = InactivityMonitor()
+
+    async def scenario():
+        await monitor.start(db, on_alert=alerts)
+        await asyncio.sleep(0.05)  # The deadline task handles what is already due
+        await monitor.stop()
+    asyncio.run(scenario())
+
+    assert [call[1] for call in alerts.calls] == ['SILENT']
+    assert set(monitor._watches) == {'ACTIVE'}
+
+
+def test_failed_alert_write_is_retried(monkeypatch):
+    db, alerts = FakeDB(), Alerts()
+    seen = minutes_ago(45)
+    db.patrols.docs.append(tracking_patrol('P1', seen))
+    monitor = monitor_for(db, alerts)
+    update_one = db.sos_alerts.update_one
+
+    async def timeout(*args, **kwargs):
+        raise TimeoutError('server selection timed out')
+
+    async def scenario():
+        monitor.touch('P1', 'HQ1', seen)
+        monkeypatch.setattr(db.sos_alerts, 'update_one', timeout)
+        await monitor._process_due()
+        assert monitor.errors == 1 and 'P1' in monitor._watches  # Kept for a retry after the backoff
+        assert monitor._watches['P1'].scheduled > datetime.now(timezone.utc).timestamp()
+
+        monkeypatch.setattr(db.sos_alerts, 'update_one', update_one)
+        monitor._push('P1', monitor._watches['P1'], 0.0)  # Backoff elapsed
+        await monitor._process_due()
+    asyncio.run(scenario())
+
+    assert [call[1] for call in alerts.calls] == ['P1']
+    assert monitor.stats()['watched'] == 0
+
+
+def test_fix_during_the_check_keeps_the_patrol_watched():
+    db, alerts = FakeDB(), Alerts()
+    seen = minutes_ago(45)
+    db.patrols.docs.append(tracking_patrol('P1', seen))
+    monitor = monitor_for(db, alerts)
+    find_one = db.sos_alerts.find_one
+
+    async def fix_arrives(*args, **kwargs):
+        monitor.touch('P1', 'HQ1', minutes_ago(0))  # Ingest flushed while the check awaited
+        return await find_one(*args, **kwargs)
+    db.sos_alerts.find_one = fix_arrives
+
+    async def scenario():
+        monitor.touch('P1', 'HQ1', seen)
+        await monitor._process_due()
+    asyncio.run(scenario())
+
+    assert len(alerts.calls) == 1  # The silence before the fix still happened
+    assert monitor._watches['P1'].scheduled > datetime.now(timezone.utc).timestamp()
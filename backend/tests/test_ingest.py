@@ -0,0 +1,122 @@
+"""
+Unit tests for the batched location ingest (ingest.py) on an in-memory database
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('motor')
+
+import ingest
+import trail_store
+from fake_mongo import FakeDB
+from ingest import LocationIngestPipeline
+from patrol_cache import PatrolMetaCache
+from trail_store import TRAIL_COLLECTION
+
+
+class _NoStats:
+    """trail_sessions upserts are pipeline updates, which the fake database does not run"""
+
+    async def prepare(self, db, sessions):
+        return [], {}
+
+    def commit(self, tails):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_session_stats(monkeypatch):
+    monkeypatch.setattr(ingest, 'trail_stats', _NoStats())
+
+
+def fix(timestamp: str, latitude: float = 23.8) -> dict:
+    return {'patrol_id': 'P1', 'latitude': latitude, 'longitude': 90.4, 'timestamp': timestamp}
+
+
+def pipeline(db: FakeDB) -> LocationIngestPipeline:
+    pipeline = LocationIngestPipeline(cache=PatrolMetaCache())
+    pipeline.db = db
+    return pipeline
+
+
+def patrol_db(**fields) -> FakeDB:
+    db = FakeDB()
+    db.patrols.docs.append({'id': 'P1', 'hq_id': 'HQ1', 'name': 'Alpha', **fields})
+    return db
+
+
+class TestSessionDate:
+    def test_new_session_is_not_overwritten_by_a_cached_one(self):
+        db = patrol_db(session_date='2026-01-01')
+        ingest_pipeline = pipeline(db)
+
+        async def scenario():
+            await ingest_pipeline.flush([fix('2026-01-01T10:00:00+00:00')])  # Caches the patrol
+            db.patrols.docs[0]['session_date'] = '2026-01-02'                # verify-code on another worker
+            await ingest_pipeline.flush([fix('2026-01-02T10:00:00+00:00')])
+        asyncio.run(scenario())
+
+        assert db.patrols.docs[0]['session_date'] == '2026-01-02'
+        sessions = [d['meta']['session_date'] for d in db[TRAIL_COLLECTION].docs]
+        assert sessions == ['2026-01-01', '2026-01-02']
+
+    def test_missing_session_is_filled_with_today(self):
+        db = patrol_db()
+        asyncio.run(pipeline(db).flush([fix('2026-01-01T10:00:00+00:00')]))
+        assert db.patrols.docs[0]['session_date'] == ingest.current_session_date()
+        assert db[TRAIL_COLLECTION].docs[0]['meta']['session_date'] == ingest.current_session_date()
+
+
+class TestFailedWrite:
+    def test_failed_batch_does_not_block_the_next_position(self, monkeypatch):
+        db = patrol_db(session_date='2026-01-01')
+        ingest_pipeline = pipeline(db)
+        bulk_write = db.patrols.bulk_write
+
+        async def unavailable(*args, **kwargs):
+            raise ConnectionError('primary stepped down')
+
+        async def scenario():
+            monkeypatch.setattr(db.patrols, 'bulk_write', unavailable)
+            assert not await ingest_pipeline.flush([fix('2026-01-01T10:05:00+00:00', latitude=23.95)])
+            monkeypatch.setattr(db.patrols, 'bulk_write', bulk_write)
+            # Older than the fix that was never written, so it is still the newest stored position
+            assert await ingest_pipeline.flush([fix('2026-01-01T10:00:00+00:00', latitude=23.9)])
+        asyncio.run(scenario())
+
+        patrol = db.patrols.docs[0]
+        assert patrol['latitude'] == 23.9 and patrol['last_location_time'] == '2026-01-01T10:00:00+00:00'
+
+
+class TestDeltaCursor:
+    def test_points_of_a_flush_held_open_past_the_lag_are_not_skipped(self, monkeypatch):
+        monkeypatch.setattr(trail_store, 'CURSOR_VISIBILITY_LAG_SECONDS', 0.05)
+        db = patrol_db(session_date='2026-01-01')
+        ingest_pipeline = pipeline(db)
+
+        class SlowStats(_NoStats):
+            async def prepare(self, db, sessions):
+                await asyncio.sleep(0.3)  # The flush is built, but its insert has not started
+                return [], {}
+        monkeypatch.setattr(ingest, 'trail_stats', SlowStats())
+
+        async def poll(after):
+            until = trail_store.cursor_upper_bound()
+            updates = await trail_store.get_trail_updates(db, ['P1'], '2026-01-01', after, until)
+            return updates.get('P1', []), until
+
+        async def scenario():
+            flushing = asyncio.ensure_future(ingest_pipeline.flush([fix('2026-01-01T10:00:00+00:00')]))
+            await asyncio.sleep(0.15)  # Past the lag while the flush is still open
+            first, cursor = await poll(datetime.fromtimestamp(0, tz=timezone.utc))
+            await flushing
+            await asyncio.sleep(0.1)
+            second, _ = await poll(cursor)
+            return first, second
+        first, second = asyncio.run(scenario())
+
+        assert first == []
+        assert len(second) == 1
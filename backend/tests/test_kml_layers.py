@@ -0,0 +1,178 @@
+"""
+Unit tests for the KML layer store's limits (kml_layers.py, kml_parser.py):
+fetch and KMZ size caps, the URL source bound and artifact cleanup, also
+through the routes (kml_routes.py)
+"""
+import asyncio
+import io
+import zipfile
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('orjson')
+pytest.importorskip('brotli')
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('motor')
+fastapi = pytest.importorskip('fastapi')
+
+from fastapi.testclient import TestClient
+
+import kml_layers
+import kml_parser
+import kml_routes
+from fake_mongo import FakeDB
+from kml_parser import KMLError, read_kml_bytes
+
+
+def kml(name: str) -> bytes:
+    return (f'<kml xmlns="http://www.opengis.net/kml/2.2"><Document><Placemark><name>{name}</name>'
+            f'<Point><coordinates>90.0,23.0</coordinates></Point></Placemark></Document></kml>').encode()
+
+
+def kmz(document: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('doc.kml', document)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def limit(monkeypatch):
+    def set_limit(max_bytes: int):
+        monkeypatch.setattr(kml_parser, 'KML_MAX_BYTES', max_bytes)
+        monkeypatch.setattr(kml_layers, 'KML_MAX_BYTES', max_bytes)
+    return set_limit
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    """Route the store's HTTP client to a handler instead of the network"""
+    def use(handler):
+        client = httpx.AsyncClient
+
+        def with_transport(**kwargs):
+            return client(transport=httpx.MockTransport(handler), **kwargs)
+        monkeypatch.setattr(kml_layers.httpx, 'AsyncClient', with_transport)
+    return use
+
+
+class TestSizeLimits:
+    def test_kmz_is_unpacked_up_to_the_limit(self, limit):
+        limit(10_000)
+        assert read_kml_bytes(kmz(kml('small'))) == kml('small')
+        bomb = kmz(b'<kml>' + b' ' * 1_000_000 + b'</kml>')  # ~1 KB compressed
+        assert len(bomb) < 10_000
+        with pytest.raises(KMLError, match='larger than'):
+            read_kml_bytes(bomb)
+
+    def test_fetch_stops_past_the_limit(self, limit, serve):
+        limit(1000)
+
+        async def body():
+            for _ in range(2):
+                yield b'x' * 600
+        serve(lambda request: httpx.Response(200, content=body()))  # Chunked: no Content-Length
+        with pytest.raises(ValueError, match='larger than'):
+            asyncio.run(kml_layers._fetch('http://example.com/big.kml', {}))
+
+    def test_declared_length_is_rejected_before_reading(self, limit, serve):
+        limit(1000)
+        serve(lambda request: httpx.Response(200, content=b'x' * 2000))
+        with pytest.raises(ValueError, match='larger than'):
+            asyncio.run(kml_layers._fetch('http://example.com/big.kml', {}))
+
+
+class TestURLSources:
+    @pytest.fixture(autouse=True)
+    def layer_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(kml_layers, 'KML_LAYER_DIR', tmp_path)
+        self.layer_dir = tmp_path
+
+    def artifacts(self) -> set:
+        return {p.name for p in self.layer_dir.iterdir()}
+
+    def test_oldest_url_sources_and_their_artifacts_are_dropped(self, monkeypatch, serve):
+        monkeypatch.setattr(kml_layers, 'KML_URL_MAX_SOURCES', 2)
+        serve(lambda request: httpx.Response(200, content=kml(request.url.path.strip('/'))))
+        db = FakeDB()
+
+        async def scenario():
+            await kml_layers.store_source(db, 'upload.kml', kml('a'), hq_id='HQ1')  # Shares a's content
+            for name in ('a', 'b', 'c'):
+                await kml_layers.url_source(db, f"http://example.com/{name}")
+        asyncio.run(scenario())
+
+        urls = {d.get('url') for d in db[kml_layers.KML_LAYER_SOURCES].docs}
+        assert urls == {None, 'http://example.com/b', 'http://example.com/c'}
+        assert len(self.artifacts()) == 3 * 4  # a (kept by the upload), b and c: manifest + 3 encodings each
+
+    def test_removed_upload_keeps_shared_artifacts(self):
+        db = FakeDB()
+
+        async def scenario():
+            await kml_layers.store_source(db, 'one.kml', kml('a'), hq_id='HQ1')
+            await kml_layers.store_source(db, 'two.kml', kml('a'), hq_id='HQ2')
+            await kml_layers.remove_source(db, 'one.kml')
+            shared = self.artifacts()
+            await kml_layers.remove_source(db, 'two.kml')
+            return shared
+        assert len(asyncio.run(scenario())) == 4
+        assert self.artifacts() == set()
+
+    def test_allowed_hosts(self, monkeypatch):
+        assert kml_layers.url_allowed('https://www.google.com/maps/d/kml?mid=1')
+        assert not kml_layers.url_allowed('file:///etc/passwd')
+        monkeypatch.setattr(kml_layers, 'KML_URL_ALLOWED_HOSTS', {'www.google.com'})
+        assert kml_layers.url_allowed('https://WWW.google.com/maps/d/kml?mid=1')
+        assert not kml_layers.url_allowed('http://169.254.169.254/latest')
+
+
+class TestRoutes:
+    @pytest.fixture(autouse=True)
+    def client(self, tmp_path, monkeypatch, serve):
+        monkeypatch.setattr(kml_layers, 'KML_LAYER_DIR', tmp_path)
+        monkeypatch.setattr(kml_layers, 'KML_URL_ALLOWED_HOSTS', {'example.com'})
+        db = FakeDB()
+        monkeypatch.setattr(kml_routes, 'get_db', lambda: db)
+        self.fetched = []
+
+        def handler(request):
+            self.fetched.append(str(request.url))
+            if request.url.path == '/big.kml':
+                return httpx.Response(200, content=b'x' * (kml_layers.KML_MAX_BYTES + 1))
+            return httpx.Response(200, content=kml(request.url.path.strip('/')))
+        serve(handler)
+        app = fastapi.FastAPI()
+        app.include_router(kml_routes.router)
+        self.client = TestClient(app)
+
+    def manifest(self, url: str):
+        return self.client.get('/api/kml/manifest', params={'url': url})
+
+    def test_manifest_and_immutable_layer(self):
+        response = self.manifest('http://example.com/camp.kml')
+        assert response.status_code == 200
+        layer_id = response.json()['layers'][0]['id']
+
+        layer = self.client.get(f"/api/kml/layers/{layer_id}", headers={'Accept-Encoding': 'br'})
+        assert layer.status_code == 200 and layer.headers['content-encoding'] == 'br'
+        assert layer.json()['features'][0]['properties']['name'] == 'camp.kml'
+        assert layer.headers['etag'] == f'"{layer_id}"' and 'immutable' in layer.headers['cache-control']
+        cached = self.client.get(f"/api/kml/layers/{layer_id}", headers={'If-None-Match': f'"{layer_id}"'})
+        assert cached.status_code == 304
+
+    def test_oversized_remote_file_is_a_bad_gateway(self, limit):
+        limit(1000)
+        response = self.manifest('http://example.com/big.kml')
+        assert response.status_code == 502 and 'larger than' in response.json()['detail']
+
+    def test_hosts_outside_the_allowlist_are_never_fetched(self):
+        assert self.manifest('http://169.254.169.254/latest').status_code == 403
+        assert self.manifest('file:///etc/passwd').status_code == 400
+        assert self.fetched == []
+
+    def test_unknown_ids_are_not_found(self):
+        assert self.client.get('/api/kml/files/missing.kml/layers').status_code == 404
+        assert self.client.get('/api/kml/layers/../../etc/passwd').status_code == 404
+        assert self.client.get(f"/api/kml/layers/{'0' * 32}").status_code == 404
@@ -0,0 +1,115 @@
+"""
+Unit tests for the GPS jitter filter (location_filter.py)
+"""
+import pytest
+
+from location_filter import DUPLICATE, JITTER, KEEP, SPEED, LocationFilter
+
+T0 = '2026-01-01T00:00:00+00:00'
+LAT, LNG = 23.8103, 90.4125
+METRE = 1 / 111320.0  # Degrees of latitude per metre
+
+
+def at(seconds: int) -> str:
+    return f"2026-01-01T00:{seconds // 60:02d}:{seconds % 60:02d}+00:00"
+
+
+def kept_fix(location_filter: LocationFilter, patrol_id: str = 'P1') -> None:
+    assert location_filter.check(patrol_id, LAT, LNG, T0) == KEEP
+    location_filter.commit(patrol_id, T0)
+
+
+def test_first_fix_is_kept():
+    assert LocationFilter().check('P1', LAT, LNG, T0) == KEEP
+
+
+def test_same_or_older_timestamp_is_duplicate():
+    f = LocationFilter()
+    kept_fix(f)
+    assert f.check('P1', LAT + 100 * METRE, LNG, T0) == DUPLICATE
+    assert f.check('P1', LAT + 100 * METRE, LNG, '2025-12-31T23:59:59+00:00') == DUPLICATE
+
+
+def test_small_move_is_jitter_until_heartbeat():
+    f = LocationFilter()
+    kept_fix(f)
+    assert f.check('P1', LAT + 3 * METRE, LNG, at(10)) == JITTER
+    assert f.check('P1', LAT + 3 * METRE, LNG, at(61)) == KEEP  # LOCATION_HEARTBEAT_SECONDS passed
+
+
+def test_accuracy_widens_radius_up_to_cap():
+    f = LocationFilter()
+    kept_fix(f)
+    assert f.check('P1', LAT + 20 * METRE, LNG, at(10), accuracy=30) == JITTER
+    assert f.check('P1', LAT + 60 * METRE, LNG, at(20), accuracy=500) == KEEP  # Capped at JITTER_MAX_RADIUS_M
+
+
+def test_implausible_jump_is_rejected_until_it_repeats():
+    f = LocationFilter()
+    kept_fix(f)
+    far = LAT + 0.5  # ~55 km in 10 s
+    assert [f.check('P1', far, LNG, at(10 + i)) for i in range(4)] == [SPEED, SPEED, SPEED, KEEP]
+
+
+def test_pending_fix_is_the_reference_until_discarded():
+    f = LocationFilter()
+    kept_fix(f)
+    moved = LAT + 100 * METRE
+    assert f.check('P1', moved, LNG, at(10)) == KEEP
+    # Compared against the pending fix, not the written one
+    assert f.check('P1', moved + 2 * METRE, LNG, at(15)) == JITTER
+
+    f.discard('P1', at(10))  # Its write failed: back to the written reference
+    assert f.check('P1', moved + 2 * METRE, LNG, at(16)) == KEEP
+
+
+def test_commit_makes_pending_fix_the_reference():
+    f = LocationFilter()
+    kept_fix(f)
+    moved = LAT + 100 * METRE
+    assert f.check('P1', moved, LNG, at(10)) == KEEP
+    f.commit('P1', at(10))
+    f.discard('P1', at(10))  # Nothing pending any more; the committed fix stays
+    assert f.check('P1', moved + 2 * METRE, LNG, at(15)) == JITTER
+
+
+def test_settling_an_older_flush_keeps_a_newer_pending_fix():
+    f = LocationFilter()
+    kept_fix(f)
+    assert f.check('P1', LAT + 100 * METRE, LNG, at(10)) == KEEP
+    assert f.check('P1', LAT + 200 * METRE, LNG, at(20)) == KEEP
+    f.discard('P1', at(10))  # The flush holding the first fix failed; the second is still queued
+    assert f.check('P1', LAT + 202 * METRE, LNG, at(25)) == JITTER
+
+
+def test_forget_and_lru_bound():
+    f = LocationFilter(max_patrols=2)
+    for patrol_id in ('P1', 'P2'):
+        kept_fix(f, patrol_id)
+    f.forget('P1')
+    assert f.check('P1', LAT, LNG, T0) == KEEP  # Fresh state
+    kept_fix(f, 'P3')
+    assert len(f._state) == 2 and 'P2' not in f._state  # Least recently checked evicted
+
+
+def test_stats():
+    f = LocationFilter()
+    kept_fix(f)
+    f.check('P1', LAT, LNG, T0)
+    f.check('P1', LAT + METRE, LNG, at(5))
+    stats = f.stats()
+    assert (stats['kept'], stats['duplicates'], stats['jitter'], stats['filtered']) == (1, 1, 1, 2)
+
+
+def test_device_accuracy_is_coerced_or_ignored():
+    for module in ('jose', 'fastapi', 'bleach'):
+        pytest.importorskip(module)
+    from security import parse_accuracy
+    assert parse_accuracy('12.5') == 12.5
+    for bad in (None, 'abc', -5, 0, float('nan'), float('inf'), True, [3], 1e9):
+        assert parse_accuracy(bad) is None
+
+    f = LocationFilter()
+    kept_fix(f)
+    # Ignored accuracy falls back to the minimum radius instead of raising or shrinking it
+    assert f.check('P1', LAT + 3 * METRE, LNG, at(10), accuracy=parse_accuracy('-100')) == JITTER
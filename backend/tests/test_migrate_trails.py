@@ -0,0 +1,49 @@
+"""
+Unit tests for the embedded-trail migration (migrate_trails.py) on an in-memory database
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('motor')
+
+from fake_mongo import FakeDB
+from trail_store import TRAIL_COLLECTION
+
+
+@pytest.fixture
+def migrate_trails(monkeypatch):
+    monkeypatch.setenv('MONGO_URL', 'mongodb://localhost:27017')
+    monkeypatch.setenv('DB_NAME', 'test')
+    import migrate_trails  # Reads MONGO_URL / DB_NAME on import
+
+    class NoStats:
+        """trail_sessions upserts are pipeline updates, which the fake database does not run"""
+        async def rebuild(self, db, patrol_id, session_date, hq_id):
+            pass
+    monkeypatch.setattr(migrate_trails, 'trail_stats', NoStats())
+    return migrate_trails
+
+
+def patrol(trail) -> dict:
+    return {'id': 'P1', 'hq_id': 'HQ1', 'session_date': '2026-01-01', 'trail': trail}
+
+
+def point(minute: int) -> dict:
+    return {'lat': 23.8, 'lng': 90.4, 'timestamp': f"2026-01-01T00:{minute:02d}:00+00:00"}
+
+
+def test_rerun_does_not_duplicate_copied_points(migrate_trails):
+    db = FakeDB()
+    trail = [point(0), point(1), point(1), point(2)]
+
+    async def scenario():
+        first = await migrate_trails.migrate_patrol(db, patrol(trail[:2]))  # Crashed before the $unset
+        second = await migrate_trails.migrate_patrol(db, patrol(trail))
+        return first, second
+    first, second = asyncio.run(scenario())
+
+    assert first == (2, 0)
+    assert second == (1, 3)
+    assert len(db[TRAIL_COLLECTION].docs) == 3
@@ -0,0 +1,32 @@
+"""
+Unit tests for the request models (models.py): fields that sanitize_model()
+skips must reject markup at validation time
+"""
+import pytest
+
+pytest.importorskip('pydantic')
+pytest.importorskip('bleach')
+
+from pydantic import ValidationError
+
+from models import HQCreate, MessageCreate, SOSAlert, Soldier
+from security import free_text_fields
+
+MARKUP = '<img src=x onerror=alert(1)>'
+
+
+@pytest.mark.parametrize('model, field, valid', [
+    (Soldier, 'id', {'id': 'S-12', 'name': 'Karim', 'email': 'karim@army.mil.bd'}),
+    (Soldier, 'email', {'id': 'S-12', 'name': 'Karim', 'email': 'karim@army.mil.bd'}),
+    (HQCreate, 'username', {'username': '10_DIV_HQ', 'password': 'x', 'hq_name': 'HQ', 'location': 'Chattogram'}),
+    (SOSAlert, 'patrol_id', {'patrol_id': 'PATROL_1', 'latitude': 23.0, 'longitude': 90.0}),
+    (MessageCreate, 'recipient_patrol_id', {'content': 'hi', 'recipient_patrol_id': 'PATROL_1'}),
+])
+def test_unsanitized_fields_reject_markup(model, field, valid):
+    assert field not in free_text_fields(model)
+    model(**valid)
+    with pytest.raises(ValidationError):
+        model(**{**valid, field: MARKUP})
+    with pytest.raises(ValidationError):
+        model(**{**valid, field: 'a' * 300})
+
@@ -0,0 +1,224 @@
+"""
+Unit tests for running several MQTT bridge workers: partition leases and SOS ids.
+The routing test needs a broker: run a local mosquitto with mosquitto.conf and
+set MQTT_TEST_BROKER=localhost (MQTT_TEST_BROKER_PORT defaults to 1883).
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from fake_mongo import FakeDB
+from mqtt_partitions import PartitionLeases, partition_of
+
+MQTT_TEST_BROKER = os.environ.get('MQTT_TEST_BROKER')
+MQTT_TEST_BROKER_PORT = int(os.environ.get('MQTT_TEST_BROKER_PORT', '1883'))
+
+
+def _owned_by(*leases):
+    return [set(lease._owned) for lease in leases]
+
+
+class TestPartitionLeases:
+    def test_single_worker_owns_everything(self):
+        lease = PartitionLeases(partitions=8)
+        assert lease.owns('10DIV0001')  # Not started: partitioning is off
+
+        async def run():
+            await lease.start(FakeDB(), 'w1')
+            await lease.stop()
+        asyncio.run(run())
+        assert lease.owns('10DIV0001') is False  # Released on stop
+
+    def test_surplus_is_handed_to_a_waiting_worker_without_a_gap(self):
+        db = FakeDB()
+        first, second = (PartitionLeases(partitions=8, handover_seconds=0.1) for _ in range(2))
+        patrols = [f"10DIV{i:04d}" for i in range(50)]
+
+        async def run():
+            await first.start(db, 'w1')
+            assert len(first._owned) == 8
+            await second.start(db, 'w2')  # Sees two workers, but w1 holds everything: waits for 4
+            assert second._wants == 4 and not second._owned
+            await first.renew()           # w1 hands 4 over, starting 0.1 s from now
+            await second.renew()          # w2 learns of them
+            during = [(first.owns(p), second.owns(p)) for p in patrols]
+            await asyncio.sleep(0.15)
+            after = [(first.owns(p), second.owns(p)) for p in patrols]
+            for lease in (first, second):
+                lease._task.cancel()
+            return during, after
+        during, after = asyncio.run(run())
+
+        assert during == [(True, False)] * len(patrols)  # w1 keeps handling them until the handover
+        assert all(mine != theirs for mine, theirs in after)
+        a, b = _owned_by(first, second)
+        assert len(a) == 4 and len(b) == 4
+        assert not a & b
+
+    def test_surplus_is_kept_while_nobody_waits(self):
+        db = FakeDB()
+        lease = PartitionLeases(partitions=8)
+
+        async def run():
+            await lease.start(db, 'w1')
+            await db.bridge_workers.insert_one(
+                {'_id': 'w2', 'expires_at': datetime.now(timezone.utc) + timedelta(minutes=1), 'wants': 0}
+            )
+            await lease.renew()
+            lease._task.cancel()
+        asyncio.run(run())
+        assert len(lease._owned) == 8 and lease.releases == 0
+
+    def test_stopping_worker_drains_without_a_gap(self):
+        db = FakeDB()
+        first, second = (PartitionLeases(partitions=8, renew_seconds=0.02, handover_seconds=0.05, drain_seconds=2)
+                         for _ in range(2))
+        patrols = [f"10DIV{i:04d}" for i in range(50)]
+        gaps = []
+
+        async def sample():
+            while True:
+                gaps.extend(p for p in patrols if not first.owns(p) and not second.owns(p))
+                await asyncio.sleep(0.002)
+
+        async def run():
+            await first.start(db, 'w1')
+            await second.start(db, 'w2')
+            await asyncio.sleep(0.2)  # Settled at 4 each
+            sampler = asyncio.create_task(sample())
+            await first.drain()
+            sampler.cancel()
+            await first.stop()
+            taken = set(second._owned)
+            await second.stop()
+            return taken
+        taken = asyncio.run(run())
+
+        assert gaps == []
+        assert len(taken) == 8 and first.releases == 8  # 4 to settle, 4 while draining
+
+    def test_expired_lease_is_taken_over(self):
+        db = FakeDB()
+        first, second = PartitionLeases(partitions=4, lease_seconds=0.05), PartitionLeases(partitions=4)
+
+        async def run():
+            await first.start(db, 'w1')
+            first._task.cancel()  # w1 dies without releasing
+            await asyncio.sleep(0.1)
+            await second.start(db, 'w2')
+            second._task.cancel()
+        asyncio.run(run())
+
+        assert len(second._owned) == 4
+        assert not first.owns('10DIV0001')  # Its own view lapsed with the lease
+
+    def test_partition_is_stable(self):
+        assert partition_of('10DIV0001', 16) == partition_of('10DIV0001', 16)
+        assert 0 <= partition_of('10DIV0001', 16) < 16
+
+
+class TestSOSNotificationId:
+    @pytest.fixture(autouse=True)
+    def bridge_module(self):
+        pytest.importorskip('paho.mqtt')
+        pytest.importorskip('motor')
+        import mqtt_bridge
+        self.mqtt_bridge = mqtt_bridge
+
+    def test_device_id_wins(self):
+        payload = {'id': 'abc', 'timestamp': '2026-01-01T00:00:00Z', 'received_id': 'x'}
+        assert self.mqtt_bridge.sos_notification_id('P1', payload) == 'SOS_P1_abc'
+
+    def test_repeats_without_device_id_stay_distinct(self):
+        """Two identical SOS presses in the same minute are two alerts"""
+        first = {'message': 'help', 'received_id': uuid.uuid4().hex}
+        second = {'message': 'help', 'received_id': uuid.uuid4().hex}
+        ids = {self.mqtt_bridge.sos_notification_id('P1', p) for p in (first, second)}
+        assert len(ids) == 2
+
+
+class _Recorder:
+    """Stands in for the bridge's handoff: records what on_message accepted"""
+
+    def __init__(self):
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def put(self, patrol_id, message_type, payload):
+        with self._lock:
+            self.messages.append((patrol_id, message_type, payload))
+        return True
+
+
+@pytest.mark.skipif(not MQTT_TEST_BROKER, reason="set MQTT_TEST_BROKER to run against a local mosquitto")
+class TestBrokerRouting:
+    @pytest.fixture(autouse=True)
+    def bridges(self, monkeypatch):
+        pytest.importorskip('paho.mqtt')
+        pytest.importorskip('motor')
+        import paho.mqtt.client as mqtt
+        import mqtt_bridge
+        monkeypatch.setattr(mqtt_bridge, 'MQTT_SHARED_GROUP', f"test{uuid.uuid4().hex[:8]}")
+
+        leases = [PartitionLeases(partitions=4), PartitionLeases(partitions=4)]
+        for lease, owned in zip(leases, ({0, 1}, {2, 3})):
+            lease.enabled = True
+            lease._owned = frozenset(owned)
+            lease._valid_until = time.monotonic() + 3600
+
+        self.bridges = []
+        for i, lease in enumerate(leases):
+            bridge = mqtt_bridge.MQTTBridge(client_id=f"test_bridge_{i}_{uuid.uuid4().hex[:6]}", partitions=lease)
+            bridge.handoff = _Recorder()
+            bridge.client.connect(MQTT_TEST_BROKER, MQTT_TEST_BROKER_PORT, 30)
+            bridge.client.loop_start()
+            self.bridges.append(bridge)
+
+        self.device = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"test_device_{uuid.uuid4().hex[:6]}",
+                                  protocol=mqtt.MQTTv5)
+        self.device.connect(MQTT_TEST_BROKER, MQTT_TEST_BROKER_PORT, 30)
+        self.device.loop_start()
+        time.sleep(1.0)  # Subscriptions in place
+        yield
+        for client in [self.device] + [b.client for b in self.bridges]:
+            client.loop_stop()
+            client.disconnect()
+
+    def _wait_for(self, count, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if sum(len(b.handoff.messages) for b in self.bridges) >= count:
+                return
+            time.sleep(0.05)
+
+    def test_each_patrol_goes_to_one_worker_in_order(self):
+        patrols = [f"TEST{uuid.uuid4().hex[:6]}" for _ in range(20)]
+        for seq in range(5):
+            for patrol_id in patrols:
+                self.device.publish(f"patrol/{patrol_id}/location",
+                                    json.dumps({'lat': 23.0, 'lng': 90.0, 'seq': seq}), qos=1)
+        self._wait_for(len(patrols) * 5)
+
+        for patrol_id in patrols:
+            received = [[p['seq'] for pid, kind, p in b.handoff.messages if pid == patrol_id and kind == 'location']
+                        for b in self.bridges]
+            assert sorted(received, key=len) == [[], [0, 1, 2, 3, 4]]
+
+    def test_sos_is_handled_by_exactly_one_worker(self):
+        patrol_id = f"TEST{uuid.uuid4().hex[:6]}"
+        for i in range(10):
+            self.device.publish(f"patrol/{patrol_id}/sos", json.dumps({'message': f"sos {i}"}), qos=2)
+        self._wait_for(10)
+        time.sleep(0.5)  # Any duplicate delivery would have arrived by now
+
+        received = [p for b in self.bridges for pid, kind, p in b.handoff.messages if kind == 'sos']
+        assert sorted(p['message'] for p in received) == [f"sos {i}" for i in range(10)]
+        assert len({p['received_id'] for p in received}) == 10
@@ -232,6 +232,159 @@ class TestPatrolsAPI:
         assert not any(p["id"] == patrol_id for p in patrols)
 
 
+class TestPatrolImport:
+    """Bulk CSV patrol import tests"""
+    
+    def test_import_patrols_csv(self):
+        """Test importing a roster with one invalid row, then re-importing it as updates"""
+        prefix = f"TEST_Import_{uuid.uuid4().hex[:6]}"
+        csv_body = (
+            "Name,Camp,Unit,Email,Mobile\n"
+            f"{prefix}_1,Import Camp,Import Unit,import1@army.mil,01700-000001\n"
+            f"{prefix}_2,Import Camp,Import Unit,import2@army.mil,\n"
+            f"{prefix}_3,Import Camp,Import Unit,not-an-email,\n"
+        )
+        files = {"file": ("roster.csv", csv_body, "text/csv")}
+        response = requests.post(f"{BASE_URL}/api/patrols/import?hq_id=SUPER_ADMIN", files=files)
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert data["received"] == 3
+        assert data["inserted"] == 2
+        assert data["rejected"] == 1
+        assert data["errors"][0]["row"] == 4
+        
+        # Same roster again updates instead of duplicating
+        response = requests.post(f"{BASE_URL}/api/patrols/import?hq_id=SUPER_ADMIN", files=files)
+        data = response.json()
+        assert data["inserted"] == 0
+        assert data["updated"] + data["unchanged"] == 2
+        
+        # Cleanup
+        patrols = requests.get(f"{BASE_URL}/api/patrols?hq_id=SUPER_ADMIN&search={prefix}").json()
+        assert len(patrols) == 2
+        for patrol in patrols:
+            requests.delete(f"{BASE_URL}/api/patrols/{patrol['id']}?hq_id=SUPER_ADMIN")
+    
+    def test_import_rejects_unknown_file_type(self):
+        """Test only CSV/XLSX uploads are accepted"""
+        files = {"file": ("roster.txt", "name\n", "text/plain")}
+        response = requests.post(f"{BASE_URL}/api/patrols/import?hq_id=SUPER_ADMIN", files=files)
+        assert response.status_code == 400
+
+
+class TestPatrolGeoQueries:
+    """Nearest-patrol and area query tests (2dsphere index on patrols.location)"""
+    
+    def test_nearby_patrols_sorted_by_distance(self):
+        """Test nearby patrols come back closest first"""
+        response = requests.get(f"{BASE_URL}/api/patrols/nearby?hq_id=SUPER_ADMIN&lat=21.4272&lng=92.0058&limit=5&active_only=false")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert isinstance(data, list)
+        assert len(data) <= 5
+        distances = [p["distance_m"] for p in data]
+        assert distances == sorted(distances)
+    
+    def test_nearby_patrols_radius(self):
+        """Test radius_km bounds the results"""
+        response = requests.get(f"{BASE_URL}/api/patrols/nearby?hq_id=SUPER_ADMIN&lat=21.4272&lng=92.0058&radius_km=5&active_only=false")
+        assert response.status_code == 200
+        assert all(p["distance_m"] <= 5000 for p in response.json())
+    
+    def test_nearby_patrols_invalid_coordinates(self):
+        """Test invalid coordinates are rejected"""
+        response = requests.get(f"{BASE_URL}/api/patrols/nearby?hq_id=SUPER_ADMIN&lat=95&lng=92.0")
+        assert response.status_code == 400
+    
+    def test_patrols_within_bbox(self):
+        """Test patrols inside a bounding box"""
+        response = requests.get(f"{BASE_URL}/api/patrols/within?hq_id=SUPER_ADMIN&bbox=21.0,91.7,21.8,92.3")
+        assert response.status_code == 200
+        
+        for patrol in response.json():
+            assert 21.0 <= patrol["latitude"] <= 21.8
+            assert 91.7 <= patrol["longitude"] <= 92.3
+    
+    def test_patrols_within_polygon(self):
+        """Test patrols inside a polygon"""
+        polygon = "21.0,91.7;21.0,92.3;21.8,92.3;21.8,91.7"
+        response = requests.get(f"{BASE_URL}/api/patrols/within?hq_id=SUPER_ADMIN&polygon={polygon}")
+        assert response.status_code == 200
+        assert isinstance(response.json(), list)
+    
+    def test_patrols_within_requires_area(self):
+        """Test bbox or polygon is required and validated"""
+        assert requests.get(f"{BASE_URL}/api/patrols/within?hq_id=SUPER_ADMIN").status_code == 400
+        assert requests.get(f"{BASE_URL}/api/patrols/within?hq_id=SUPER_ADMIN&bbox=21.8,91.7,21.0,92.3").status_code == 400
+
+
+class TestKMLLayers:
+    """Pre-converted KML layer store tests"""
+    
+    def test_manifest_rejects_non_http_url(self):
+        """Test only http(s) KML sources are fetched"""
+        response = requests.get(f"{BASE_URL}/api/kml/manifest?url=file:///etc/passwd")
+        assert response.status_code == 400
+    
+    def test_unknown_file_has_no_layers(self):
+        """Test files without converted layers return 404"""
+        response = requests.get(f"{BASE_URL}/api/kml/files/TEST_MISSING/layers")
+        assert response.status_code == 404
+    
+    def test_invalid_layer_id(self):
+        """Test layer ids must be content hashes"""
+        response = requests.get(f"{BASE_URL}/api/kml/layers/../../etc")
+        assert response.status_code == 404
+    
+    def test_layer_etag_and_revalidation(self):
+        """Test layers carry a strong ETag and answer 304 when it matches"""
+        manifests = [requests.get(f"{BASE_URL}/api/kml/files/{f['id']}/layers")
+                     for f in requests.get(f"{BASE_URL}/api/kml/files?hq_id=SUPER_ADMIN").json()]
+        layers = [layer for m in manifests if m.status_code == 200 for layer in m.json()["layers"]]
+        if not layers:
+            pytest.skip("No converted KML layers")
+        
+        response = requests.get(f"{BASE_URL}/api/kml/layers/{layers[0]['id']}", headers={"Accept-Encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["ETag"] == f'"{layers[0]["id"]}"'
+        assert response.json()["type"] == "FeatureCollection"
+        
+        cached = requests.get(f"{BASE_URL}/api/kml/layers/{layers[0]['id']}",
+                              headers={"If-None-Match": response.headers["ETag"]})
+        assert cached.status_code == 304
+
+
+class TestVectorTiles:
+    """Vector tile endpoint tests (KML layers and session trails)"""
+    
+    def test_trail_tile(self):
+        """Test trail tiles are MVT and revalidate with their ETag"""
+        response = requests.get(f"{BASE_URL}/api/tiles/trails/10/773/449.mvt?hq_id=SUPER_ADMIN")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("application/vnd.mapbox-vector-tile")
+        
+        cached = requests.get(f"{BASE_URL}/api/tiles/trails/10/773/449.mvt?hq_id=SUPER_ADMIN",
+                              headers={"If-None-Match": response.headers["ETag"]})
+        assert cached.status_code in [200, 304]  # 200 only if the trails grew in between
+    
+    def test_trail_tile_requires_hq(self):
+        """Test trail tiles are scoped to an HQ"""
+        response = requests.get(f"{BASE_URL}/api/tiles/trails/10/773/449.mvt")
+        assert response.status_code == 400
+    
+    def test_tile_out_of_range(self):
+        """Test tile coordinates outside the zoom level are rejected"""
+        response = requests.get(f"{BASE_URL}/api/tiles/trails/2/9/0.mvt?hq_id=SUPER_ADMIN")
+        assert response.status_code == 404
+    
+    def test_unknown_kml_layer(self):
+        """Test tiles of unknown KML layers return 404"""
+        response = requests.get(f"{BASE_URL}/api/tiles/{'0' * 32}/10/773/449.mvt")
+        assert response.status_code == 404
+
+
 class TestFilterOptions:
     """Filter options API tests"""
     
@@ -356,5 +509,31 @@ class TestPatrolHistory:
         assert isinstance(data, list)
 
 
+
+class TestSecurityEvents:
+    """Security audit event query tests"""
+    
+    def test_security_events_super_admin(self):
+        """Test super admin can query security events"""
+        login = requests.post(f"{BASE_URL}/api/hq/login", json={
+            "username": SUPER_ADMIN_USERNAME,
+            "password": SUPER_ADMIN_PASSWORD
+        })
+        token = login.json()["token"]
+        response = requests.get(f"{BASE_URL}/api/security/events?limit=10",
+                                headers={"Authorization": f"Bearer {token}"})
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert isinstance(data["events"], list)
+        assert len(data["events"]) <= 10
+        assert "pipeline" in data
+    
+    def test_security_events_requires_token(self):
+        """Test security events are not public"""
+        response = requests.get(f"{BASE_URL}/api/security/events")
+        assert response.status_code == 403
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v", "--tb=short"])
@@ -0,0 +1,95 @@
+"""
+Unit tests for the geospatial patrol queries (patrol_geo.py) behind the
+nearby/within routes, on an in-memory database
+"""
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('motor')
+pytest.importorskip('jose')
+pytest.importorskip('bleach')
+pytest.importorskip('httpx')
+pytest.importorskip('multipart')
+fastapi = pytest.importorskip('fastapi')
+
+from fastapi.testclient import TestClient
+
+import patrol_routes
+from fake_mongo import FakeDB
+from patrol_geo import geo_point
+
+SOS = (22.30, 91.90)  # lat, lng
+
+
+def patrol(patrol_id: str, lat: float, lng: float, hq_id: str = 'HQ1', tracking: bool = True) -> dict:
+    return {'id': patrol_id, 'name': f"Patrol {patrol_id}", 'hq_id': hq_id, 'latitude': lat, 'longitude': lng,
+            'is_tracking': tracking, 'location': geo_point(lat, lng)}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db = FakeDB()
+    db.patrols.docs.extend([
+        patrol('NEAR', 22.301, 91.901),               # ~150 m
+        patrol('MID', 22.32, 91.90),                  # ~2.2 km
+        patrol('FAR', 22.50, 91.90),                  # ~22 km
+        patrol('IDLE', 22.302, 91.90, tracking=False),
+        patrol('OTHER', 22.3005, 91.9005, hq_id='HQ2'),
+        {'id': 'NOFIX', 'hq_id': 'HQ1', 'latitude': 0.0, 'longitude': 0.0, 'is_tracking': True},
+    ])
+    monkeypatch.setattr(patrol_routes, 'get_db', lambda: db)
+    app = fastapi.FastAPI()
+    app.include_router(patrol_routes.router)
+    return TestClient(app)
+
+
+def ids(response) -> list:
+    assert response.status_code == 200, response.text
+    return [p['id'] for p in response.json()]
+
+
+class TestNearby:
+    def test_closest_first_within_the_hq(self, client):
+        response = client.get('/api/patrols/nearby', params={'hq_id': 'HQ1', 'lat': SOS[0], 'lng': SOS[1]})
+        assert ids(response) == ['NEAR', 'MID', 'FAR']
+        distances = [p['distance_m'] for p in response.json()]
+        assert 100 < distances[0] < 200 and distances == sorted(distances)
+
+    def test_radius_limit_and_inactive(self, client):
+        params = {'hq_id': 'HQ1', 'lat': SOS[0], 'lng': SOS[1], 'radius_km': 5}
+        assert ids(client.get('/api/patrols/nearby', params=params)) == ['NEAR', 'MID']
+        params.update(active_only=False, limit=2)
+        assert ids(client.get('/api/patrols/nearby', params=params)) == ['NEAR', 'IDLE']
+
+    def test_super_admin_sees_every_hq(self, client):
+        params = {'hq_id': 'SUPER_ADMIN', 'lat': SOS[0], 'lng': SOS[1], 'limit': 2}
+        assert ids(client.get('/api/patrols/nearby', params=params)) == ['OTHER', 'NEAR']
+
+    def test_bad_input_is_refused(self, client):
+        assert client.get('/api/patrols/nearby', params={'hq_id': 'HQ1', 'lat': 95, 'lng': 0}).status_code == 400
+        params = {'hq_id': 'HQ1', 'lat': SOS[0], 'lng': SOS[1], 'radius_km': 0}
+        assert client.get('/api/patrols/nearby', params=params).status_code == 422
+
+
+class TestWithin:
+    def test_bbox(self, client):
+        response = client.get('/api/patrols/within', params={'hq_id': 'HQ1', 'bbox': '22.29,91.89,22.35,91.95'})
+        assert sorted(ids(response)) == ['IDLE', 'MID', 'NEAR']
+        response = client.get('/api/patrols/within', params={'hq_id': 'HQ1', 'bbox': '22.29,91.89,22.35,91.95',
+                                                             'active_only': True})
+        assert sorted(ids(response)) == ['MID', 'NEAR']
+
+    def test_polygon(self, client):
+        triangle = '22.29,91.89;22.31,91.89;22.31,91.92'  # Holds NEAR and IDLE, not MID
+        response = client.get('/api/patrols/within', params={'hq_id': 'HQ1', 'polygon': triangle})
+        assert sorted(ids(response)) == ['IDLE', 'NEAR']
+
+    @pytest.mark.parametrize('params', [
+        {},
+        {'bbox': '22.35,91.89,22.29,91.95'},          # min above max
+        {'bbox': '22.29,91.89,22.35'},
+        {'polygon': '22.29,91.89;22.31,91.89'},       # Two vertices
+        {'polygon': '22.29,91.89;abc,91.89;22.31,91.91'},
+    ])
+    def test_bad_areas_are_refused(self, client, params):
+        assert client.get('/api/patrols/within', params={'hq_id': 'HQ1', **params}).status_code == 400
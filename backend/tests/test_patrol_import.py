@@ -0,0 +1,116 @@
+"""
+Unit tests for the CSV/XLSX roster import (patrol_import.py) through its
+route, on an in-memory database
+"""
+import io
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('motor')
+pytest.importorskip('pandas')
+pytest.importorskip('jose')
+pytest.importorskip('bleach')
+pytest.importorskip('httpx')
+pytest.importorskip('multipart')
+fastapi = pytest.importorskip('fastapi')
+
+from fastapi.testclient import TestClient
+
+import patrol_routes
+from fake_mongo import FakeDB
+
+HEADER = 'Patrol Name,Camp,Unit,Email,Mobile,Soldiers'
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDB()
+    db.hq_users.docs.append({'hq_id': 'HQ1', 'subscription': {'status': 'active', 'max_patrols': 10}})
+    monkeypatch.setattr(patrol_routes, 'get_db', lambda: db)
+    return db
+
+
+@pytest.fixture
+def client(db):
+    app = fastapi.FastAPI()
+    app.include_router(patrol_routes.router)
+    return TestClient(app)
+
+
+def upload(client, filename: str, content: bytes, hq_id: str = 'HQ1'):
+    return client.post('/api/patrols/import', params={'hq_id': hq_id}, files={'file': (filename, content)})
+
+
+def csv(*rows: str) -> bytes:
+    return '\n'.join((HEADER,) + rows).encode()
+
+
+class TestCSV:
+    def test_valid_rows_import_and_errors_keep_file_row_numbers(self, client, db):
+        response = upload(client, 'roster.csv', csv(
+            'Alpha,Patiya Camp,10 Div,alpha@army.mil.bd,01711000000,S1;S2',
+            '',
+            'Bravo,Patiya Camp,10 Div,not-an-email,,',
+            'Charlie,Patiya Camp,10 Div,charlie@army.mil.bd,,',
+        ))
+        assert response.status_code == 200
+        report = response.json()
+        assert (report['received'], report['inserted'], report['rejected']) == (3, 2, 1)
+        assert report['errors'][0]['row'] == 4  # The blank line still counts
+        alpha = next(p for p in db.patrols.docs if p['name'] == 'Alpha')
+        assert alpha['hq_id'] == 'HQ1' and alpha['soldier_ids'] == ['S1', 'S2'] and alpha['soldier_count'] == 2
+        assert alpha['assigned_area'] == 'Patiya Camp' and alpha['status'] == 'assigned'
+
+    def test_reimport_updates_instead_of_duplicating(self, client, db):
+        upload(client, 'roster.csv', csv('Alpha,Patiya Camp,10 Div,alpha@army.mil.bd,,',
+                                         'Bravo,Patiya Camp,10 Div,bravo@army.mil.bd,,'))
+        patrol_id = db.patrols.docs[0]['id']
+        report = upload(client, 'roster.csv', csv('Alpha,Patiya Camp,11 Div,alpha@army.mil.bd,,',
+                                                  'Bravo,Patiya Camp,10 Div,bravo@army.mil.bd,,')).json()
+        assert (report['inserted'], report['updated'], report['unchanged']) == (0, 1, 1)
+        assert len(db.patrols.docs) == 2
+        assert db.patrols.docs[0]['id'] == patrol_id and db.patrols.docs[0]['unit'] == '11 Div'
+
+    def test_duplicates_and_markup(self, client, db):
+        report = upload(client, 'roster.csv', csv(
+            'Alpha <script>x</script>,Patiya Camp,10 Div,alpha@army.mil.bd,,',
+            'Alpha <script>x</script>,Patiya Camp,10 Div,alpha@army.mil.bd,,',
+            'Bravo,Patiya Camp,10 Div,bravo@army.mil.bd,,<b>S1</b>',
+        )).json()
+        assert report['inserted'] == 1
+        assert [e['row'] for e in report['errors']] == [3, 4]  # Repeat of row 2; soldier id with markup
+        assert '<script>' not in db.patrols.docs[0]['name']
+
+    def test_patrol_limit_applies_to_new_patrols_only(self, client, db):
+        db.hq_users.docs[0]['subscription']['max_patrols'] = 2
+        db.patrols.docs.append({'id': 'OLD1', 'hq_id': 'HQ1', 'name': 'Alpha', 'leader_email': 'alpha@army.mil.bd'})
+        report = upload(client, 'roster.csv', csv('Alpha,Patiya Camp,10 Div,alpha@army.mil.bd,,',
+                                                  'Bravo,Patiya Camp,10 Div,bravo@army.mil.bd,,',
+                                                  'Charlie,Patiya Camp,10 Div,charlie@army.mil.bd,,')).json()
+        assert (report['inserted'], report['updated'], report['rejected']) == (1, 1, 1)
+        assert 'Patrol limit reached' in report['errors'][0]['errors'][0]
+        assert report['limit'] == {'max_patrols': 2, 'remaining': 0}
+
+    def test_bad_uploads_are_refused(self, client, db):
+        assert upload(client, 'roster.txt', csv()).status_code == 400
+        response = upload(client, 'roster.csv', b'name,unit\nAlpha,10 Div')
+        assert response.status_code == 400 and 'camp_name' in response.json()['detail']
+        assert upload(client, 'roster.csv', csv(), hq_id='HQ9').status_code == 404
+        db.hq_users.docs[0]['subscription']['status'] = 'expired'
+        assert upload(client, 'roster.csv', csv()).status_code == 403
+
+
+def test_xlsx_roster(client, db):
+    openpyxl = pytest.importorskip('openpyxl')
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(HEADER.split(','))
+    sheet.append(['Alpha', 'Patiya Camp', '10 Div', 'alpha@army.mil.bd', '01711000000', 'S1'])
+    sheet.append(['Bravo', 'Patiya Camp', '10 Div', 'bravo@army.mil.bd', None, None])
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+
+    report = upload(client, 'roster.xlsx', buffer.getvalue()).json()
+    assert (report['received'], report['inserted'], report['rejected']) == (2, 2, 0)
+    assert {p['name'] for p in db.patrols.docs} == {'Alpha', 'Bravo'}
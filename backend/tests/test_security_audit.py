@@ -0,0 +1,118 @@
+"""
+Unit tests for the security audit log (security_audit.py): aggregation of
+repeated events and the super-admin query route, on an in-memory database
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('orjson')
+pytest.importorskip('jose')
+pytest.importorskip('bleach')
+pytest.importorskip('httpx')
+pytest.importorskip('motor')
+fastapi = pytest.importorskip('fastapi')
+
+from fastapi.testclient import TestClient
+
+import security_routes
+from fake_mongo import FakeDB
+from security import create_access_token
+from security_audit import SECURITY_LOG_COLLECTION, SecurityAuditLog
+
+
+def event(event_type: str = 'login_failed', ip: str = '10.0.0.1', username: str = 'alice') -> dict:
+    return {'timestamp': datetime.now(timezone.utc).isoformat(), 'event_type': event_type, 'ip': ip,
+            'details': {'username': username}}
+
+
+def stored(db: FakeDB) -> list:
+    return db[SECURITY_LOG_COLLECTION].docs
+
+
+class TestAggregation:
+    def test_repeats_are_counted_into_one_summary(self):
+        db, audit = FakeDB(), SecurityAuditLog(aggregate_seconds=60)
+
+        async def scenario():
+            await audit.start(db)
+            for _ in range(5):
+                audit.record(event())
+            audit.record(event(username='bob'))
+            await audit.stop()  # Closes the open windows
+        asyncio.run(scenario())
+
+        docs = stored(db)
+        assert len(docs) == 3 and audit.aggregated == 4
+        summary = next(d for d in docs if d.get('aggregated'))
+        assert summary['repeats'] == 4 and summary['details'] == {'username': 'alice'}
+        assert summary['first_seen'] <= summary['timestamp']
+
+    def test_event_after_the_window_starts_a_new_one(self):
+        db, audit = FakeDB(), SecurityAuditLog(aggregate_seconds=0.05)
+
+        async def scenario():
+            await audit.start(db)
+            for _ in range(3):
+                audit.record(event())
+            time.sleep(0.06)
+            audit.record(event())  # Closes the first window and is written itself
+            await audit.flush()
+            written = [(d.get('aggregated', False), d.get('repeats')) for d in stored(db)]
+            await audit.stop()
+            return written
+        assert asyncio.run(scenario()) == [(False, None), (True, 2), (False, None)]
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        db, audit = FakeDB(), SecurityAuditLog(max_pending=2)
+
+        async def scenario():
+            await audit.start(db)
+            for i in range(4):
+                audit.record(event(username=f"user{i}"))
+            await audit.stop()
+        asyncio.run(scenario())
+        assert len(stored(db)) == 2 and audit.dropped == 2
+
+
+class TestEventsRoute:
+    @pytest.fixture
+    def client(self, monkeypatch):
+        db, audit = FakeDB(), SecurityAuditLog(aggregate_seconds=60)
+        monkeypatch.setattr(security_routes, 'get_db', lambda: db)
+        monkeypatch.setattr(security_routes, 'security_audit', audit)
+
+        @asynccontextmanager
+        async def lifespan(app):
+            await audit.start(db)
+            yield
+            await audit.stop()
+        app = fastapi.FastAPI(lifespan=lifespan)
+        app.include_router(security_routes.router)
+        with TestClient(app) as client:
+            self.audit = audit
+            yield client
+
+    def get(self, client, token_claims: dict, **params):
+        token = create_access_token(token_claims)
+        return client.get('/api/security/events', params=params, headers={'Authorization': f"Bearer {token}"})
+
+    def test_super_admin_sees_aggregated_events(self, client):
+        for _ in range(3):
+            self.audit.record(event())
+        self.audit.record(event('sos_rate_limited', ip='10.0.0.2'))
+        self.audit._close_windows(force=True)
+
+        response = self.get(client, {'sub': 'admin', 'is_super_admin': True}, event_type='login_failed')
+        assert response.status_code == 200
+        events = response.json()['events']
+        assert {e['event_type'] for e in events} == {'login_failed'}
+        assert sorted(e.get('repeats', 0) for e in events) == [0, 2]
+        assert response.json()['pipeline']['aggregated'] == 2
+
+    def test_other_hqs_are_refused(self, client):
+        assert self.get(client, {'sub': 'HQ1', 'hq_id': 'HQ1'}).status_code == 403
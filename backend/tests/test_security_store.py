@@ -0,0 +1,241 @@
+"""
+Unit tests for the shared security counters (security_store.py): the memory
+store's eviction, the Redis store against an in-process fake, and the lockout
+and token revocation built on them
+"""
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('pymongo')
+
+from security_store import LoginGuard, MemoryCounterStore, RedisCounterStore
+
+
+class FakeRedis:
+    """The slice of redis.asyncio.Redis that RedisCounterStore uses"""
+
+    def __init__(self):
+        self.data = {}     # key -> int
+        self.expiry = {}   # key -> expires_at (time.time())
+
+    def _purge(self, key):
+        if key in self.expiry and self.expiry[key] <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+
+    async def get(self, key):
+        self._purge(key)
+        value = self.data.get(key)
+        return str(value).encode() if value is not None else None
+
+    async def set(self, key, value, ex=None):
+        self.data[key] = int(value)
+        self.expiry.pop(key, None)
+        if ex is not None:
+            self.expiry[key] = time.time() + ex
+
+    async def incr(self, key):
+        self._purge(key)
+        self.data[key] = self.data.get(key, 0) + 1
+        return self.data[key]
+
+    async def ttl(self, key):
+        self._purge(key)
+        if key not in self.data:
+            return -2
+        if key not in self.expiry:
+            return -1
+        return int(self.expiry[key] - time.time())
+
+    async def expire(self, key, seconds):
+        if key in self.data:
+            self.expiry[key] = time.time() + seconds
+
+    async def delete(self, key):
+        self.data.pop(key, None)
+        self.expiry.pop(key, None)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def incr(self, key):
+        self.calls.append(('incr', key))
+        return self
+
+    def ttl(self, key):
+        self.calls.append(('ttl', key))
+        return self
+
+    async def execute(self):
+        return [await getattr(self.redis, name)(key) for name, key in self.calls]
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class TestMemoryCounterStore:
+    def test_counts_and_expires(self):
+        store = MemoryCounterStore()
+        assert [store.incr_now('k', 60) for _ in range(3)] == [1, 2, 3]
+        store.set_now('gone', 1, 0)
+        assert store.get_now('gone') == 0
+        assert store.ttl_now('gone') is None
+
+    def test_spray_does_not_evict_a_lockout(self):
+        store = MemoryCounterStore(max_keys=100)
+        store.set_now('login_lock:victim', 1, 900)
+        store.set_now('token_revoked:abc', 1, 900)
+        for i in range(1000):
+            store.incr_now(f"login_fail:spray{i}", 900)
+        assert store.ttl_now('login_lock:victim') is not None
+        assert store.get_now('token_revoked:abc') == 1
+        assert len(store._data) <= 100
+        assert store.evictions > 0
+
+    def test_expired_keys_go_before_live_ones(self):
+        store = MemoryCounterStore(max_keys=10)
+        store.incr_now('login_fail:oldest_live', 900)
+        for i in range(9):
+            store.set_now(f"stale{i}", 1, 0)
+        store.incr_now('login_fail:new', 900)  # Over max_keys: the stale entries make room
+        assert store.get_now('login_fail:oldest_live') == 1
+        assert store.evictions == 0
+
+
+class TestRedisCounterStore:
+    def test_incr_sets_expiry_once(self):
+        redis = FakeRedis()
+        store = RedisCounterStore(client=redis)
+
+        async def scenario():
+            assert await store.incr('k', 60) == 1
+            first_expiry = redis.expiry['k']
+            assert await store.incr('k', 60) == 2
+            assert redis.expiry['k'] == first_expiry  # The window is not extended
+            assert 0 < await store.ttl('k') <= 60
+        run(scenario())
+
+    def test_set_get_delete(self):
+        store = RedisCounterStore(client=FakeRedis())
+
+        async def scenario():
+            await store.set('k', 7, 60)
+            assert await store.get('k') == 7
+            await store.delete('k')
+            assert await store.get('k') == 0
+            assert await store.ttl('k') is None
+        run(scenario())
+
+
+@pytest.mark.parametrize('make_store', [MemoryCounterStore, lambda: RedisCounterStore(client=FakeRedis())],
+                         ids=['memory', 'redis'])
+class TestLoginGuard:
+    def test_locks_after_max_attempts(self, make_store):
+        guard = LoginGuard(max_attempts=3, lockout_minutes=15, store=make_store())
+
+        async def scenario():
+            for _ in range(2):
+                await guard.record_failure('alice')
+            assert await guard.is_locked('alice') == (False, None)
+            assert await guard.remaining_attempts('alice') == 1
+            await guard.record_failure('alice')
+            locked, minutes = await guard.is_locked('alice')
+            assert locked and minutes in (14, 15)
+            await guard.clear('alice')
+            assert await guard.is_locked('alice') == (False, None)
+            assert await guard.remaining_attempts('alice') == 3
+        run(scenario())
+
+    def test_workers_sharing_a_store_share_the_lockout(self, make_store):
+        store = make_store()
+        first = LoginGuard(max_attempts=2, lockout_minutes=15, store=store)
+        second = LoginGuard(max_attempts=2, lockout_minutes=15, store=store)
+
+        async def scenario():
+            await first.record_failure('bob')
+            await second.record_failure('bob')
+            assert (await first.is_locked('bob'))[0]
+        run(scenario())
+
+
+class TestTokenRevocation:
+    @pytest.fixture(autouse=True)
+    def security_module(self):
+        pytest.importorskip('jose')
+        pytest.importorskip('fastapi')
+        pytest.importorskip('bleach')
+        import security
+        self.security = security
+
+    def test_revocation_reaches_other_workers(self):
+        security = self.security
+        store = RedisCounterStore(client=FakeRedis())
+        worker_a = security.TokenClaimsCache(store=store)
+        worker_b = security.TokenClaimsCache(store=store, check_seconds=0)
+        token = security.create_access_token({'sub': 'HQ1'})
+
+        async def scenario():
+            claims = security.decode_token(token)
+            assert not await worker_b.is_revoked_shared(token, claims)
+            await worker_a.revoke(token)
+            assert await worker_b.is_revoked_shared(token, claims)
+            assert worker_b.is_revoked(token, claims)  # Remembered locally from now on
+        run(scenario())
+
+    def test_cached_claims_are_copies(self):
+        security = self.security
+        cache = security.TokenClaimsCache(store=MemoryCounterStore())
+        token = security.create_access_token({'sub': 'HQ1'})
+        claims = security.decode_token(token)
+        cache.put(token, claims)
+        claims['sub'] = 'changed'
+        cache.get(token)['is_super_admin'] = True
+        assert cache.get(token)['sub'] == 'HQ1'
+        assert 'is_super_admin' not in cache.get(token)
+
+
+class TestSyncLockout:
+    @pytest.fixture(autouse=True)
+    def guard(self, monkeypatch):
+        pytest.importorskip('jose')
+        pytest.importorskip('fastapi')
+        pytest.importorskip('bleach')
+        import security
+        monkeypatch.setattr(security, 'login_guard', LoginGuard(max_attempts=2, lockout_minutes=15,
+                                                                store=MemoryCounterStore()))
+        monkeypatch.setattr(security, '_store_loop', None)
+        self.security = security
+
+    def test_sync_names_work_outside_the_loop(self):
+        security = self.security
+        security.record_failed_login('alice')
+        assert security.get_remaining_attempts('alice') == 1
+        security.record_failed_login('alice')
+        assert security.is_account_locked('alice')[0]
+        security.clear_failed_attempts('alice')
+        assert security.is_account_locked('alice') == (False, None)
+
+    def test_threadpool_callers_run_on_the_app_loop(self):
+        security = self.security
+
+        async def scenario():
+            await security.record_failed_login_async('bob')  # Binds the app loop
+            with pytest.raises(RuntimeError, match='await is_account_locked_async'):
+                security.is_account_locked('bob')
+            return await asyncio.to_thread(security.get_remaining_attempts, 'bob')
+        assert run(scenario()) == 1
@@ -279,6 +279,19 @@ class TestTrailEndpointFiltering:
         
         print(f"Trail endpoint structure correct - {len(data['points'])} points, {data['total_distance']} km")
     
+    def test_trail_endpoint_compact_format(self):
+        """format=polyline returns an encoded trail instead of point dicts"""
+        response = self.session.get(f"{BASE_URL}/api/patrols/{PATROL_ID_TO_TEST}/trail?format=polyline")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert "points" not in data
+        assert data["encoded"]["encoding"] == "polyline"
+        assert "polyline" in data["encoded"]
+        assert "timestamps" in data["encoded"]
+        assert data["encoded"]["count"] >= 0
+        print(f"Compact trail: {data['encoded']['count']} points in {len(data['encoded']['polyline'])} chars")
+    
     def test_trail_endpoint_with_hours_param(self):
         """Test trail endpoint with hours parameter"""
         response = self.session.get(f"{BASE_URL}/api/patrols/{PATROL_ID_TO_TEST}/trail?hours=1")
@@ -347,6 +360,31 @@ class TestMQTTLocationEndpoint:
         assert response.status_code == 404
         print("Non-existent patrol correctly returns 404")
 
+    def test_mqtt_location_batch(self):
+        """Test offline queue replay: invalid points rejected, replays deduplicated"""
+        base = int(time.time()) - 600
+        points = [
+            {"latitude": 22.3575 + i * 0.0001, "longitude": 91.7840,
+             "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(base + i * 10))}
+            for i in range(5)
+        ]
+        points.append({"latitude": 999, "longitude": 999, "timestamp": points[0]["timestamp"]})
+        url = f"{BASE_URL}/api/mqtt/location/{PATROL_ID_TO_TEST}/batch"
+
+        response = self.session.post(url, json={"points": points})
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["received"] == 6
+        assert data["rejected"] == [5]
+        assert data["accepted"] + data["duplicates"] == 5
+
+        # Same points again are all duplicates
+        response = self.session.post(url, json={"points": points[:5]})
+        assert response.status_code == 200
+        assert response.json()["accepted"] == 0
+        print(f"Batch upload accepted {data['accepted']} points")
+
 
 class TestVerifyCodeEndpoint:
     """
@@ -446,6 +484,32 @@ class TestAllTrailsEndpoint:
             assert isinstance(trail["points"], list)
         
         print(f"All trails endpoint returned {len(data)} active patrol trails")
+    
+    def test_all_trails_delta_cursor(self):
+        """since=0 returns full trails plus a cursor; the cursor returns only newer points"""
+        response = self.session.get(f"{BASE_URL}/api/patrols/trails/all?hq_id=SUPER_ADMIN&since=0")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert "next_cursor" in data
+        assert "session_date" in data
+        assert isinstance(data["trails"], list)
+        
+        response = self.session.get(f"{BASE_URL}/api/patrols/trails/all?hq_id=SUPER_ADMIN&since={data['next_cursor']}")
+        assert response.status_code == 200
+        
+        delta = response.json()
+        assert int(delta["next_cursor"]) >= int(data["next_cursor"])
+        for trail in delta["trails"]:
+            assert "patrol_id" in trail
+            assert isinstance(trail["points"], list)
+        
+        print(f"Delta sync returned {len(delta['trails'])} patrols with new points")
+    
+    def test_all_trails_invalid_cursor(self):
+        """Garbage cursor is rejected"""
+        response = self.session.get(f"{BASE_URL}/api/patrols/trails/all?hq_id=SUPER_ADMIN&since=abc")
+        assert response.status_code == 400
 
 
 if __name__ == "__main__":
@@ -0,0 +1,134 @@
+"""
+Unit tests for the vector tile cache (vector_tiles.py): trail tiles raced by a
+refresh, the background disk sweep, and the tile route (tile_routes.py)
+"""
+import asyncio
+import threading
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('pymongo')
+pytest.importorskip('shapely')
+pytest.importorskip('mapbox_vector_tile')
+pytest.importorskip('orjson')
+pytest.importorskip('brotli')
+pytest.importorskip('httpx')
+pytest.importorskip('motor')
+fastapi = pytest.importorskip('fastapi')
+
+import mapbox_vector_tile
+from fastapi.testclient import TestClient
+
+import kml_layers
+import tile_routes
+import trail_store
+import vector_tiles
+from fake_mongo import FakeDB
+from vector_tiles import TRAILS_LAYER, VectorTileCache
+
+
+def trail_db() -> FakeDB:
+    db = FakeDB()
+    received = datetime.now(timezone.utc) - timedelta(minutes=5)
+    for i in range(3):
+        db[trail_store.TRAIL_COLLECTION].docs.append(trail_store.make_point(
+            'P1', 'HQ1', '2026-01-01', 23.0 + i * 0.001, 90.0, f"2026-01-01T00:0{i}:00+00:00", received
+        ))
+    return db
+
+
+def test_tile_encoded_across_a_refresh_is_not_cached(monkeypatch):
+    cache = VectorTileCache()
+    encode = vector_tiles._encode
+
+    async def scenario():
+        tile = await cache.trail_tile(trail_db(), 'HQ1', '2026-01-01', 0, 0, 0)
+        assert tile and cache._get((TRAILS_LAYER, 'HQ1', '2026-01-01', 0, 0, 0)) == tile  # Normal path caches
+        trails = cache._trails[('HQ1', '2026-01-01')]
+
+        def encode_during_refresh(*args):
+            trails.index = object()  # The refresh swaps in a new index while this tile is encoded
+            return encode(*args)
+        monkeypatch.setattr(vector_tiles, '_encode', encode_during_refresh)
+        return await cache.trail_tile(None, 'HQ1', '2026-01-01', 1, 1, 0)
+    assert asyncio.run(scenario())
+    assert cache._get((TRAILS_LAYER, 'HQ1', '2026-01-01', 1, 1, 0)) is None
+
+
+def test_disk_sweep_runs_off_the_request_thread(monkeypatch):
+    monkeypatch.setattr(vector_tiles, 'TILE_DISK_SWEEP_EVERY', 2)
+    cache = VectorTileCache()
+    swept = []
+    done = threading.Event()
+
+    def sweep():
+        swept.append(threading.current_thread())
+        done.set()
+    monkeypatch.setattr(cache, '_sweep_disk', sweep)
+
+    cache._count_disk_write()
+    assert cache._sweeper is None
+    cache._count_disk_write()
+    assert done.wait(5)
+    assert swept[0] is not threading.current_thread()
+
+
+TRAIL_TILE = 'trails/10/768/444.mvt'  # Holds the trail_db() points
+
+
+class TestTileRoute:
+    @pytest.fixture(autouse=True)
+    def client(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(kml_layers, 'KML_LAYER_DIR', tmp_path)
+        monkeypatch.setattr(vector_tiles, 'TILE_DISK_DIR', tmp_path / 'tiles')
+        monkeypatch.setattr(vector_tiles, 'TRAIL_TILE_REFRESH_SECONDS', 0)
+        monkeypatch.setattr(trail_store, 'CURSOR_VISIBILITY_LAG_SECONDS', 0)
+        monkeypatch.setattr(tile_routes, 'vector_tiles', VectorTileCache())
+        self.db = trail_db()
+        monkeypatch.setattr(tile_routes, 'get_db', lambda: self.db)
+        app = fastapi.FastAPI()
+        app.include_router(tile_routes.router)
+        self.client = TestClient(app)
+
+    def tile(self, path: str, etag: str = None, **params):
+        headers = {'If-None-Match': etag} if etag else {}
+        return self.client.get(f"/api/tiles/{path}", params=params, headers=headers)
+
+    def test_trail_tile_revalidates_until_the_trail_grows(self):
+        first = self.tile(TRAIL_TILE, hq_id='HQ1', session_date='2026-01-01')
+        assert first.status_code == 200 and first.headers['content-type'] == tile_routes.MVT_MEDIA_TYPE
+        assert first.headers['cache-control'] == 'no-cache'
+        features = mapbox_vector_tile.decode(first.content)[TRAILS_LAYER]['features']
+        assert [f['properties'] for f in features] == [{'patrol_id': 'P1', 'points': 3}]
+
+        etag = first.headers['etag']
+        assert self.tile(TRAIL_TILE, etag, hq_id='HQ1', session_date='2026-01-01').status_code == 304
+        self.db[trail_store.TRAIL_COLLECTION].docs.append(trail_store.make_point(
+            'P1', 'HQ1', '2026-01-01', 23.001, 90.001, '2026-01-01T00:05:00+00:00'
+        ))  # Stored after the cursor the first tile was drawn at
+        grown = self.tile(TRAIL_TILE, etag, hq_id='HQ1', session_date='2026-01-01')
+        assert grown.status_code == 200 and grown.headers['etag'] != etag
+
+    def test_trails_of_other_hqs_are_not_drawn(self):
+        response = self.tile(TRAIL_TILE, hq_id='HQ2', session_date='2026-01-01')
+        assert response.status_code == 200 and response.content == b''
+        assert self.tile(TRAIL_TILE).status_code == 400  # hq_id required
+
+    def test_kml_tile_is_immutable(self):
+        manifest = asyncio.run(kml_layers.store_source(self.db, 'camp.kml', (
+            b'<kml xmlns="http://www.opengis.net/kml/2.2"><Document><Placemark><name>Gate</name>'
+            b'<Point><coordinates>90.0,23.0</coordinates></Point></Placemark></Document></kml>'
+        ), hq_id='HQ1'))
+        layer_id = manifest['layers'][0]['id']
+
+        first = self.tile(f"{layer_id}/0/0/0.mvt")
+        assert first.status_code == 200 and 'immutable' in first.headers['cache-control']
+        features = mapbox_vector_tile.decode(first.content)[layer_id]['features']
+        assert features[0]['properties']['name'] == 'Gate'
+        assert self.tile(f"{layer_id}/0/0/0.mvt").content == first.content  # From the cache
+        assert self.tile(f"{layer_id}/0/0/0.mvt", first.headers['etag']).status_code == 304
+
+    @pytest.mark.parametrize('path', ['trails/1/2/0.mvt', f"{'0' * 32}/0/0/0.mvt", 'nope/0/0/0.mvt'])
+    def test_unknown_tiles_are_not_found(self, path):
+        assert self.tile(path, hq_id='HQ1').status_code == 404
@@ -0,0 +1,65 @@
+"""
+Vector Tile API Routes
+Mapbox Vector Tiles of KML layers and session trails. Mount on the main app
+with app.include_router(router).
+"""
+import asyncio
+import hashlib
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+
+from database import get_db
+from ingest import current_session_date
+from patrol_import import SUPER_ADMIN_HQ_ID
+from vector_tiles import TRAILS_LAYER, is_kml_layer, valid_tile, vector_tiles
+
+router = APIRouter(prefix="/api/tiles")
+
+MVT_MEDIA_TYPE = 'application/vnd.mapbox-vector-tile'
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+
+
+def _tile_response(tile: bytes, etag: str, cache_control: str, request: Request) -> Response:
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+    return Response(content=tile, media_type=MVT_MEDIA_TYPE, headers=headers)
+
+
+@router.get("/{layer}/{z}/{x}/{y}.mvt")
+async def get_tile(layer: str, z: int, x: int, y: int, request: Request,
+                   hq_id: Optional[str] = None, session_date: Optional[str] = None):
+    """
+    One vector tile. `layer` is a KML layer id from /api/kml/manifest or
+    /api/kml/files/{id}/layers, or `trails` with hq_id (and optionally
+    session_date, default today) for that HQ's patrol trails.
+    """
+    if not valid_tile(z, x, y):
+        raise HTTPException(status_code=404, detail="Tile out of range")
+
+    if layer == TRAILS_LAYER:
+        if not hq_id:
+            raise HTTPException(status_code=400, detail="hq_id is required for trail tiles")
+        scope = None if hq_id == SUPER_ADMIN_HQ_ID else hq_id
+        tile = await vector_tiles.trail_tile(get_db(), scope, session_date or current_session_date(), z, x, y)
+        # Trails grow: clients revalidate, unchanged tiles come back as 304
+        etag = f'"{hashlib.sha1(tile).hexdigest()[:16]}"'
+        return _tile_response(tile, etag, 'no-cache', request)
+
+    if not is_kml_layer(layer):
+        raise HTTPException(status_code=404, detail="Layer not found")
+    etag = f'"{layer}-{z}-{x}-{y}"'
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers={'ETag': etag, 'Cache-Control': IMMUTABLE_CACHE})
+    tile = await asyncio.to_thread(vector_tiles.kml_tile, layer, z, x, y)
+    if tile is None:
+        raise HTTPException(status_code=404, detail="Layer not found")
+    return _tile_response(tile, etag, IMMUTABLE_CACHE, request)
+
+
+@router.get("/stats")
+async def get_tile_stats():
+    """Tile cache counters"""
+    return vector_tiles.stats()
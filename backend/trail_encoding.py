@@ -0,0 +1,107 @@
+"""
+Compact Trail Encoding
+Google encoded-polyline coordinates (precision 1e6) with delta-encoded
+timestamps, as an alternative to per-point JSON dicts. Clients opt in with
+`format=polyline` or `Accept: application/vnd.patrol-trail.polyline+json`.
+The frontend decoder lives in frontend/src/utils/trailCodec.js.
+"""
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import trail_store
+
+COMPACT_FORMAT = 'polyline'
+COMPACT_MEDIA_TYPE = 'application/vnd.patrol-trail.polyline+json'
+POLYLINE_PRECISION = 6  # ~0.1 m, GPS fixes are not better than that
+
+
+def wants_compact(format: Optional[str] = None, accept: Optional[str] = None) -> bool:
+    """True when the client asked for the compact trail format"""
+    if format:
+        return format.lower() == COMPACT_FORMAT
+    return bool(accept) and COMPACT_MEDIA_TYPE in accept
+
+
+def _encode_signed(value: int, out: List[str]) -> None:
+    value = ~(value << 1) if value < 0 else value << 1
+    while value >= 0x20:
+        out.append(chr((0x20 | (value & 0x1f)) + 63))
+        value >>= 5
+    out.append(chr(value + 63))
+
+
+def encode_deltas(values: Iterable[int]) -> str:
+    """Encode integers as the first value followed by successive differences"""
+    out: List[str] = []
+    previous = 0
+    for value in values:
+        _encode_signed(value - previous, out)
+        previous = value
+    return ''.join(out)
+
+
+def _decode_signed(encoded: str) -> List[int]:
+    values = []
+    index = 0
+    while index < len(encoded):
+        result, shift = 0, 0
+        while True:
+            byte = ord(encoded[index]) - 63
+            index += 1
+            result |= (byte & 0x1f) << shift
+            shift += 5
+            if byte < 0x20:
+                break
+        values.append(~(result >> 1) if result & 1 else result >> 1)
+    return values
+
+
+def decode_deltas(encoded: str) -> List[int]:
+    """Inverse of encode_deltas"""
+    values = []
+    current = 0
+    for delta in _decode_signed(encoded):
+        current += delta
+        values.append(current)
+    return values
+
+
+def encode_polyline(coords: Sequence[Tuple[float, float]], precision: int = POLYLINE_PRECISION) -> str:
+    """Encode (lat, lng) pairs as a Google encoded polyline"""
+    factor = 10 ** precision
+    out: List[str] = []
+    prev_lat = prev_lng = 0
+    for lat, lng in coords:
+        ilat, ilng = int(round(lat * factor)), int(round(lng * factor))
+        _encode_signed(ilat - prev_lat, out)
+        _encode_signed(ilng - prev_lng, out)
+        prev_lat, prev_lng = ilat, ilng
+    return ''.join(out)
+
+
+def decode_polyline(encoded: str, precision: int = POLYLINE_PRECISION) -> List[Tuple[float, float]]:
+    """Inverse of encode_polyline"""
+    factor = 10 ** precision
+    deltas = _decode_signed(encoded)
+    coords = []
+    lat = lng = 0
+    for dlat, dlng in zip(deltas[0::2], deltas[1::2]):
+        lat += dlat
+        lng += dlng
+        coords.append((lat / factor, lng / factor))
+    return coords
+
+
+def encode_trail(points: List[dict], with_timestamps: bool = True) -> dict:
+    """Compact form of trail points ({'lat', 'lng', 'timestamp'})"""
+    encoded = {
+        'encoding': COMPACT_FORMAT,
+        'precision': POLYLINE_PRECISION,
+        'count': len(points),
+        'polyline': encode_polyline([(p['lat'], p['lng']) for p in points]),
+    }
+    if with_timestamps:
+        # Whole seconds since epoch: first absolute, then deltas
+        encoded['timestamps'] = encode_deltas(
+            int(trail_store.parse_timestamp(p['timestamp']).timestamp()) for p in points
+        )
+    return encoded
@@ -0,0 +1,282 @@
+"""
+Trail API Routes
+REST location ingest and trail read endpoints backed by the trail_points
+time-series collection. Mount on the main app with app.include_router(router).
+"""
+from datetime import datetime, timezone, timedelta
+from typing import Optional
+
+import numpy as np
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import JSONResponse
+
+import trail_store
+from database import get_db
+from ingest import current_session_date, stored_session_dates
+from models import LocationBatch, PatrolTrailResponse
+from mqtt_bridge import mqtt_bridge
+from mqtt_partitions import partition_leases
+from patrol_cache import patrol_cache
+from trail_encoding import encode_trail, wants_compact
+from security import parse_accuracy, validate_coordinates, validate_coordinates_array, validate_patrol_id
+from trail_simplify import get_simplified_trails, resolve_tolerance
+from trail_stats import to_response as stats_response, trail_stats
+
+router = APIRouter(prefix="/api")
+
+SUPER_ADMIN_HQ_ID = 'SUPER_ADMIN'
+MAX_DEVICE_CLOCK_SKEW = timedelta(minutes=5)  # Batch points further in the future are rejected
+
+
+def _hq_filter(hq_id: str) -> dict:
+    """Super admin sees every HQ; everyone else only their own"""
+    return {} if hq_id == SUPER_ADMIN_HQ_ID else {'hq_id': hq_id}
+
+
+def _since_hours(hours: Optional[int]) -> Optional[datetime]:
+    return datetime.now(timezone.utc) - timedelta(hours=hours) if hours else None
+
+
+@router.post("/mqtt/location/{patrol_id}")
+async def mqtt_location_update(patrol_id: str, lat: float, lng: float, accuracy: Optional[float] = None):
+    """REST fallback for patrol location updates (same pipeline as MQTT)"""
+    if not validate_patrol_id(patrol_id):
+        raise HTTPException(status_code=400, detail="Invalid patrol ID format")
+    if not validate_coordinates(lat, lng):
+        raise HTTPException(status_code=400, detail="Invalid coordinates")
+
+    patrol = await patrol_cache.get(get_db(), patrol_id)
+    if not patrol:
+        raise HTTPException(status_code=404, detail="Patrol not found")
+
+    accuracy = parse_accuracy(accuracy)
+    timestamp = datetime.now(timezone.utc).isoformat()
+    if not partition_leases.owns(patrol_id):
+        # Another bridge worker holds this patrol's ingest state; hand the fix over through the broker
+        mqtt_bridge.forward_location(patrol_id, {'lat': lat, 'lng': lng, 'accuracy': accuracy})
+    elif not await mqtt_bridge.ingest.submit(patrol_id, lat, lng, timestamp, accuracy):
+        raise HTTPException(status_code=503, detail="Location ingest is overloaded, retry later")
+
+    return {
+        'success': True,
+        'patrol_id': patrol_id,
+        'latitude': lat,
+        'longitude': lng,
+        'timestamp': timestamp
+    }
+
+
+@router.post("/mqtt/location/{patrol_id}/batch")
+async def mqtt_location_batch(patrol_id: str, batch: LocationBatch):
+    """
+    Offline queue replay: points keep their device timestamps, are validated as
+    one vector, deduplicated (within the request and against stored points by
+    timestamp) and written in a single ingest flush
+    """
+    if not validate_patrol_id(patrol_id):
+        raise HTTPException(status_code=400, detail="Invalid patrol ID format")
+
+    db = get_db()
+    patrol = await patrol_cache.get(db, patrol_id)
+    if not patrol:
+        raise HTTPException(status_code=404, detail="Patrol not found")
+
+    received = len(batch.points)
+    if not received:
+        return {'success': True, 'patrol_id': patrol_id, 'received': 0, 'accepted': 0, 'duplicates': 0, 'rejected': []}
+
+    lats = np.array([p.latitude for p in batch.points], dtype=np.float64)
+    lngs = np.array([p.longitude for p in batch.points], dtype=np.float64)
+    times = np.array([round(trail_store.parse_timestamp(p.timestamp).timestamp() * 1000) for p in batch.points],
+                     dtype=np.int64)
+    latest_allowed = (datetime.now(timezone.utc) + MAX_DEVICE_CLOCK_SKEW).timestamp() * 1000
+
+    valid = validate_coordinates_array(lats, lngs) & (times <= latest_allowed)
+    rejected = np.flatnonzero(~valid).tolist()
+
+    # One fix per device timestamp; np.unique also leaves them in time order
+    candidates = np.flatnonzero(valid)
+    _, first = np.unique(times[candidates], return_index=True)
+    keep = candidates[first]
+
+    session_date = (await stored_session_dates(db, [patrol_id])).get(patrol_id) or current_session_date()
+    stored = await trail_store.existing_timestamps(db, patrol_id, session_date, times[keep].tolist())
+    if stored:
+        keep = keep[~np.isin(times[keep], list(stored))]
+
+    points = [{
+        'patrol_id': patrol_id,
+        'latitude': float(lats[i]),
+        'longitude': float(lngs[i]),
+        'timestamp': datetime.fromtimestamp(times[i] / 1000.0, tz=timezone.utc).isoformat(),
+    } for i in keep]
+
+    if points and not await mqtt_bridge.ingest.write_batch(points):
+        raise HTTPException(status_code=503, detail="Location ingest is unavailable, retry later")
+
+    return {
+        'success': True,
+        'patrol_id': patrol_id,
+        'received': received,
+        'accepted': len(points),
+        'duplicates': int(valid.sum()) - len(points),
+        'rejected': rejected
+    }
+
+
+def _trail_body(points: list, compact: bool) -> dict:
+    """Map-ready trail coordinates, either as [lat, lng] pairs or an encoded polyline"""
+    if compact:
+        return {'encoded': encode_trail(points, with_timestamps=False)}
+    return {'points': [[p['lat'], p['lng']] for p in points]}
+
+
+def _parse_cursor(since: str) -> datetime:
+    try:
+        return trail_store.decode_cursor(since)
+    except (TypeError, ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="Invalid since cursor")
+
+
+@router.get("/patrols/trails/all")
+async def get_all_trails(hq_id: str, hours: int = 24, tolerance: Optional[float] = None,
+                         zoom: Optional[int] = None, since: Optional[str] = None,
+                         format: Optional[str] = None, accept: Optional[str] = Header(None)):
+    """
+    Current-session trails for every patrol of an HQ that has points.
+    Pass `tolerance` (metres) or the map `zoom` to get Douglas-Peucker simplified trails.
+
+    With `since`, the response becomes {session_date, next_cursor, trails}: `since=0`
+    returns full trails plus a cursor, and any later cursor returns only the points
+    stored after it (raw, unsimplified) for the patrols that have new points.
+
+    `format=polyline` (or the compact Accept type) replaces `points` with `encoded`.
+    """
+    db = get_db()
+    session_date = current_session_date()
+    patrols = await db.patrols.find(
+        {**_hq_filter(hq_id), 'session_date': session_date},
+        {'_id': 0, 'id': 1, 'name': 1, 'status': 1, 'latitude': 1}
+    ).to_list(None)
+    patrol_ids = [p['id'] for p in patrols]
+
+    after = _parse_cursor(since) if since is not None else None
+    until = trail_store.cursor_upper_bound()
+
+    if after is not None and after.timestamp() > 0:
+        trails = await trail_store.get_trail_updates(db, patrol_ids, session_date, after, until)
+    else:
+        # A full fetch that hands out a cursor stops at it, so the next delta does not resend points
+        bound = until if since is not None else None
+        start = _since_hours(hours)
+        reference_lat = next((p['latitude'] for p in patrols if p.get('latitude')), 0.0)
+        tolerance_m = resolve_tolerance(tolerance, zoom, reference_lat)
+        if tolerance_m is None:
+            trails = await trail_store.get_trails(db, patrol_ids, session_date, start, bound)
+        else:
+            trails = await get_simplified_trails(db, patrol_ids, session_date, tolerance_m, bound)
+            if start:
+                trails = {
+                    patrol_id: [p for p in points if trail_store.parse_timestamp(p['timestamp']) >= start]
+                    for patrol_id, points in trails.items()
+                }
+
+    compact = wants_compact(format, accept)
+    result = []
+    for patrol in patrols:
+        points = trails.get(patrol['id'])
+        if not points:
+            continue
+        result.append({
+            'patrol_id': patrol['id'],
+            'patrol_name': patrol.get('name'),
+            'status': patrol.get('status'),
+            **_trail_body(points, compact)
+        })
+
+    if since is None:
+        return result
+    return {
+        'session_date': session_date,
+        'next_cursor': trail_store.encode_cursor(max(until, after) if after else until),
+        'trails': result
+    }
+
+
+@router.get("/patrols/history")
+async def get_patrol_history(hq_id: str, date: str, format: Optional[str] = None,
+                             accept: Optional[str] = Header(None)):
+    """Per-patrol session summary and trail for a past (or current) session date"""
+    db = get_db()
+    sessions = await trail_stats.get_for_date(db, date, None if hq_id == SUPER_ADMIN_HQ_ID else hq_id)
+    if not sessions:
+        return []
+
+    patrols = await db.patrols.find(
+        {'id': {'$in': list(sessions)}},
+        {'_id': 0, 'id': 1, 'name': 1, 'status': 1, 'assigned_area': 1}
+    ).to_list(None)
+    trails = await trail_store.get_trails(db, list(sessions), date)
+    is_today = date == current_session_date()
+    compact = wants_compact(format, accept)
+
+    history = []
+    for patrol in patrols:
+        stats = stats_response(sessions[patrol['id']])
+        completed = not is_today or patrol.get('status') == 'finished'
+        history.append({
+            'patrol_id': patrol['id'],
+            'patrol_name': patrol.get('name'),
+            'status': 'completed' if completed else 'active',
+            'assigned_area': patrol.get('assigned_area'),
+            'session_date': date,
+            'session_start': stats['first_timestamp'],
+            'session_end': stats['last_timestamp'] if completed else None,
+            'location_count': stats['point_count'],
+            'total_distance': stats['total_distance'],
+            'stats': stats,
+            **_trail_body(trails.get(patrol['id'], []), compact)
+        })
+    return history
+
+
+@router.get("/patrols/{patrol_id}/trail", response_model=PatrolTrailResponse)
+async def get_patrol_trail(patrol_id: str, hours: Optional[int] = None, since: Optional[str] = None,
+                           format: Optional[str] = None, accept: Optional[str] = Header(None)):
+    """
+    Trail for the patrol's current session.
+    With a `since` cursor only points stored after it are returned; every
+    response carries `next_cursor` for the following delta request.
+    `format=polyline` returns `encoded` (polyline + timestamps) instead of `points`.
+    """
+    db = get_db()
+    after = _parse_cursor(since) if since is not None else None
+    until = trail_store.cursor_upper_bound()
+    next_cursor = trail_store.encode_cursor(max(until, after) if after else until)
+
+    patrol = await patrol_cache.get(db, patrol_id)
+    if not patrol:
+        return {'patrol_id': patrol_id, 'points': [], 'total_distance': 0, 'next_cursor': next_cursor}
+
+    session_date = (await stored_session_dates(db, [patrol_id])).get(patrol_id) or current_session_date()
+    if after is not None and after.timestamp() > 0:
+        updates = await trail_store.get_trail_updates(db, [patrol_id], session_date, after, until)
+        points = updates.get(patrol_id, [])
+    else:
+        points = await trail_store.get_patrol_trail(db, patrol_id, session_date, _since_hours(hours), until=until)
+    stats = stats_response(await trail_stats.get(db, patrol_id, session_date))
+    if wants_compact(format, accept):
+        return JSONResponse({
+            'patrol_id': patrol_id,
+            'encoded': encode_trail(points),
+            'total_distance': stats['total_distance'],
+            'stats': stats,
+            'next_cursor': next_cursor
+        })
+    return {
+        'patrol_id': patrol_id,
+        'points': [{'latitude': p['lat'], 'longitude': p['lng'], 'timestamp': p['timestamp']} for p in points],
+        'total_distance': stats['total_distance'],
+        'stats': stats,
+        'next_cursor': next_cursor
+    }
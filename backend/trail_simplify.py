@@ -0,0 +1,216 @@
+"""
+Trail Simplification
+Douglas-Peucker decimation of trail points (vectorized with NumPy) with a
+per-(patrol, session_date, tolerance) cache that the ingest pipeline
+invalidates whenever new points are written for a patrol. Other workers'
+flushes are not seen here, so entries also expire after
+SIMPLIFIED_CACHE_TTL_SECONDS.
+"""
+import math
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import trail_store
+
+METERS_PER_DEGREE = 111320.0
+WEB_MERCATOR_METERS_PER_PIXEL_Z0 = 156543.03392  # At the equator, 256px tiles
+TRAIL_SIMPLIFY_PIXELS = float(os.environ.get('TRAIL_SIMPLIFY_PIXELS', '1.0'))  # Allowed deviation in screen pixels
+SIMPLIFIED_CACHE_MAX_ENTRIES = int(os.environ.get('SIMPLIFIED_CACHE_MAX_ENTRIES', '4096'))
+SIMPLIFIED_CACHE_TTL_SECONDS = float(os.environ.get('SIMPLIFIED_CACHE_TTL_SECONDS', '10'))
+
+
+def zoom_to_tolerance(zoom: int, latitude: float = 0.0) -> float:
+    """Tolerance in metres that keeps the error under TRAIL_SIMPLIFY_PIXELS at a map zoom level"""
+    meters_per_pixel = WEB_MERCATOR_METERS_PER_PIXEL_Z0 * math.cos(math.radians(latitude)) / (2 ** zoom)
+    return meters_per_pixel * TRAIL_SIMPLIFY_PIXELS
+
+
+def resolve_tolerance(tolerance: Optional[float] = None, zoom: Optional[int] = None,
+                      latitude: float = 0.0) -> Optional[float]:
+    """Pick the tolerance from an explicit value in metres or a zoom level; None means raw points"""
+    if tolerance is not None and tolerance > 0:
+        return round(tolerance, 1)
+    if zoom is not None:
+        return round(zoom_to_tolerance(max(0, min(zoom, 22)), latitude), 1)
+    return None
+
+
+def douglas_peucker_mask(coords: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Boolean mask of points to keep. `coords` is an (n, 2) planar array; each
+    segment's perpendicular distances are computed in one vectorized pass.
+    """
+    n = len(coords)
+    keep = np.zeros(n, dtype=bool)
+    if n < 3:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        a = coords[start]
+        d = coords[end] - a
+        rel = coords[start + 1:end] - a
+        norm = math.hypot(d[0], d[1])
+        if norm == 0:
+            dist = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            dist = np.abs(d[0] * rel[:, 1] - d[1] * rel[:, 0]) / norm
+        idx = int(np.argmax(dist))
+        if dist[idx] > tolerance:
+            split = start + 1 + idx
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return keep
+
+
+def simplify_points(points: List[dict], tolerance_m: float) -> List[dict]:
+    """Simplify trail points ({'lat', 'lng', ...}) keeping first and last points"""
+    if len(points) < 3 or tolerance_m <= 0:
+        return list(points)
+
+    lat = np.fromiter((p['lat'] for p in points), dtype=np.float64, count=len(points))
+    lng = np.fromiter((p['lng'] for p in points), dtype=np.float64, count=len(points))
+    # Local equirectangular projection to metres
+    coords = np.column_stack((
+        lng * math.cos(math.radians(float(lat.mean()))) * METERS_PER_DEGREE,
+        lat * METERS_PER_DEGREE
+    ))
+    keep = douglas_peucker_mask(coords, tolerance_m)
+    return [p for p, k in zip(points, keep) if k]
+
+
+class SimplifiedTrailCache:
+    """
+    LRU of simplified trails keyed by (patrol_id, session_date, tolerance).
+    Readers take generation() before loading points and pass it to put(), which
+    drops the result if the patrol was invalidated while it was being computed.
+    Each entry also records the `recv` bound its points were read up to.
+    """
+
+    def __init__(self, max_entries: int = SIMPLIFIED_CACHE_MAX_ENTRIES,
+                 ttl_seconds: float = SIMPLIFIED_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._entries: "OrderedDict[Tuple[str, str, float], Tuple[float, Optional[datetime], List[dict]]]" = OrderedDict()
+        self._generations: Dict[str, int] = {}  # patrol_id -> invalidation count
+        self._epoch = 0  # Bumped by a full invalidate
+        self.hits = 0
+        self.misses = 0
+        self.stale_puts = 0
+
+    def generation(self, patrol_id: str) -> Tuple[int, int]:
+        return self._epoch, self._generations.get(patrol_id, 0)
+
+    def get(self, patrol_id: str, session_date: str, tolerance: float
+            ) -> Optional[Tuple[Optional[datetime], List[dict]]]:
+        """(recv bound, points) of a cached trail; a None bound means every stored point"""
+        key = (patrol_id, session_date, tolerance)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, patrol_id: str, session_date: str, tolerance: float, points: List[dict],
+            generation: Tuple[int, int], until: Optional[datetime] = None) -> None:
+        if generation != self.generation(patrol_id):
+            self.stale_puts += 1  # New points were written after these were read
+            return
+        key = (patrol_id, session_date, tolerance)
+        self._entries[key] = (time.monotonic() + self.ttl, until, points)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, patrol_id: Optional[str] = None) -> None:
+        """Drop every tolerance for a patrol, or everything when patrol_id is None"""
+        if patrol_id is None:
+            self._entries.clear()
+            self._generations.clear()
+            self._epoch += 1
+            return
+        self.invalidate_many([patrol_id])
+
+    def invalidate_many(self, patrol_ids: Iterable[str]) -> None:
+        ids = set(patrol_ids)
+        if not ids:
+            return
+        for patrol_id in ids:
+            self._generations[patrol_id] = self._generations.get(patrol_id, 0) + 1
+        if len(self._generations) > 4 * self.max_entries:
+            # Counters only have to differ from what in-flight readers saw
+            self._generations.clear()
+            self._epoch += 1
+        for key in [k for k in self._entries if k[0] in ids]:
+            del self._entries[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 4) if total else 0,
+            'stale_puts': self.stale_puts,
+        }
+
+
+# Global instance, invalidated by the ingest pipeline
+simplified_trail_cache = SimplifiedTrailCache()
+
+
+async def get_simplified_trails(db, patrol_ids: List[str], session_date: str,
+                                tolerance_m: float, until: Optional[datetime] = None) -> Dict[str, List[dict]]:
+    """
+    Simplified session trails, computing and caching only the patrols not cached yet.
+    With `until`, only points stored up to it are returned: entries read up to an
+    earlier bound get the points stored since appended (raw), and entries read past
+    it are recomputed.
+    """
+    trails = {}
+    missing = []
+    behind: Dict[datetime, List[str]] = {}
+    for patrol_id in patrol_ids:
+        cached = simplified_trail_cache.get(patrol_id, session_date, tolerance_m)
+        if cached is None:
+            missing.append(patrol_id)
+            continue
+        covered, points = cached
+        if until is not None and (covered is None or covered > until):
+            missing.append(patrol_id)
+            continue
+        trails[patrol_id] = points
+        if covered is not None and (until is None or covered < until):
+            behind.setdefault(covered, []).append(patrol_id)
+
+    upper = until or datetime.now(timezone.utc)
+    for covered, ids in behind.items():
+        updates = await trail_store.get_trail_updates(db, ids, session_date, covered, upper)
+        for patrol_id, points in updates.items():
+            trails[patrol_id] = trails[patrol_id] + points
+
+    if missing:
+        generations = {patrol_id: simplified_trail_cache.generation(patrol_id) for patrol_id in missing}
+        raw = await trail_store.get_trails(db, missing, session_date, until=until)
+        for patrol_id in missing:
+            simplified = simplify_points(raw.get(patrol_id, []), tolerance_m)
+            simplified_trail_cache.put(patrol_id, session_date, tolerance_m, simplified,
+                                       generations[patrol_id], until)
+            trails[patrol_id] = simplified
+    return trails
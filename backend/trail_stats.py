@@ -0,0 +1,284 @@
+"""
+Incremental Trail Statistics
+Running per-session aggregates (distance, moving time, max speed, bounding
+box, point count) updated on every ingest flush and stored in the
+trail_sessions collection, so trail/history/end-session reads are O(1).
+
+Each flush folds its points in with one atomic pipeline update per session:
+counts and distances are added, extremes take the min/max, and the last
+point only moves forward. Nothing in memory changes until the write
+succeeds. The only state kept here is each live session's last point (the
+start of the next segment), bounded by TRAIL_STATS_MAX_SESSIONS.
+
+Points that arrive older than the session's last point cannot be folded into
+distance/moving time/max speed incrementally; the session is marked
+`needs_rebuild` and recomputed once from trail_points on the next read. The
+same happens when the stored last point is not the one a flush continued
+from (another worker wrote to the session in between).
+"""
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from pymongo import ASCENDING, UpdateOne
+
+import trail_store
+
+TRAIL_SESSIONS_COLLECTION = 'trail_sessions'
+TRAIL_STATS_MAX_SESSIONS = int(os.environ.get('TRAIL_STATS_MAX_SESSIONS', '10000'))
+MOVING_SPEED_KMH = 1.0          # Slower segments count as stationary
+MAX_PLAUSIBLE_SPEED_KMH = 200.0  # Faster segments are GPS glitches and ignored for max_speed
+MIN_SPEED_INTERVAL_SECONDS = 1.0
+
+Tail = Tuple[float, float, datetime]  # Last point of a session: lat, lng, ts
+
+
+async def ensure_stats_indexes(db) -> None:
+    """Index used to list every session of a date (history)"""
+    await db[TRAIL_SESSIONS_COLLECTION].create_index(
+        [('session_date', ASCENDING), ('hq_id', ASCENDING)], name='session_date_hq'
+    )
+
+
+def session_key(patrol_id: str, session_date: str) -> str:
+    return f"{patrol_id}:{session_date}"
+
+
+def _stored_ts(value) -> datetime:
+    """Timestamp at the millisecond precision BSON stores, so tails compare equal to stored ones"""
+    ts = trail_store.parse_timestamp(value)
+    return ts.replace(microsecond=ts.microsecond // 1000 * 1000)
+
+
+class SessionStats:
+    """Aggregates for one patrol session"""
+
+    def __init__(self, patrol_id: str, hq_id: Optional[str], session_date: str):
+        self.patrol_id = patrol_id
+        self.hq_id = hq_id
+        self.session_date = session_date
+        self.point_count = 0
+        self.distance_km = 0.0
+        self.moving_seconds = 0.0
+        self.max_speed_kmh = 0.0
+        self.min_lat = self.min_lng = self.max_lat = self.max_lng = None
+        self.first_ts: Optional[datetime] = None
+        self.last_ts: Optional[datetime] = None
+        self.last_lat: Optional[float] = None
+        self.last_lng: Optional[float] = None
+        self.needs_rebuild = False
+
+    def add_point(self, lat: float, lng: float, ts: datetime) -> None:
+        self.point_count += 1
+        if self.min_lat is None:
+            self.min_lat = self.max_lat = lat
+            self.min_lng = self.max_lng = lng
+        else:
+            self.min_lat, self.max_lat = min(self.min_lat, lat), max(self.max_lat, lat)
+            self.min_lng, self.max_lng = min(self.min_lng, lng), max(self.max_lng, lng)
+        if self.first_ts is None or ts < self.first_ts:
+            self.first_ts = ts
+
+        if self.last_ts is not None and ts < self.last_ts:
+            # Out of order: order-dependent aggregates need a rebuild
+            self.needs_rebuild = True
+            return
+
+        if self.last_ts is not None:
+            segment_km = trail_store.haversine_km(self.last_lat, self.last_lng, lat, lng)
+            seconds = (ts - self.last_ts).total_seconds()
+            self.distance_km += segment_km
+            if seconds > 0:
+                speed = segment_km / (seconds / 3600.0)
+                if speed >= MOVING_SPEED_KMH:
+                    self.moving_seconds += seconds
+                if seconds >= MIN_SPEED_INTERVAL_SECONDS and speed <= MAX_PLAUSIBLE_SPEED_KMH:
+                    self.max_speed_kmh = max(self.max_speed_kmh, speed)
+
+        self.last_ts = ts
+        self.last_lat = lat
+        self.last_lng = lng
+
+    def to_doc(self) -> dict:
+        return {
+            'patrol_id': self.patrol_id,
+            'hq_id': self.hq_id,
+            'session_date': self.session_date,
+            'point_count': self.point_count,
+            'distance_km': self.distance_km,
+            'moving_seconds': self.moving_seconds,
+            'max_speed_kmh': self.max_speed_kmh,
+            'bbox': None if self.min_lat is None else {
+                'min_lat': self.min_lat, 'min_lng': self.min_lng,
+                'max_lat': self.max_lat, 'max_lng': self.max_lng,
+            },
+            'first_ts': self.first_ts,
+            'last_ts': self.last_ts,
+            'first_timestamp': self.first_ts.isoformat() if self.first_ts else None,
+            'last_timestamp': self.last_ts.isoformat() if self.last_ts else None,
+            'last_lat': self.last_lat,
+            'last_lng': self.last_lng,
+            'needs_rebuild': self.needs_rebuild,
+        }
+
+    def fold(self, tail_ts: Optional[datetime]) -> list:
+        """
+        Pipeline update adding these stats (a flush's points, continued from
+        the tail at tail_ts) to a stored session
+        """
+        def literal(value):
+            return {'$literal': value}
+
+        def plus(field: str, value):
+            return {'$add': [{'$ifNull': [f'${field}', 0]}, value]}
+
+        newer = {'$gte': [self.last_ts, {'$ifNull': ['$last_ts', self.last_ts]}]}
+        earlier = {'$lte': [self.first_ts, {'$ifNull': ['$first_ts', self.first_ts]}]}
+        diverged = {'$ne': [{'$ifNull': ['$last_ts', None]}, tail_ts]}
+        return [{'$set': {
+            'patrol_id': literal(self.patrol_id),
+            'hq_id': literal(self.hq_id),
+            'session_date': literal(self.session_date),
+            'point_count': plus('point_count', self.point_count),
+            'distance_km': plus('distance_km', self.distance_km),
+            'moving_seconds': plus('moving_seconds', self.moving_seconds),
+            'max_speed_kmh': {'$max': ['$max_speed_kmh', self.max_speed_kmh]},
+            'bbox': {
+                'min_lat': {'$min': ['$bbox.min_lat', self.min_lat]},
+                'min_lng': {'$min': ['$bbox.min_lng', self.min_lng]},
+                'max_lat': {'$max': ['$bbox.max_lat', self.max_lat]},
+                'max_lng': {'$max': ['$bbox.max_lng', self.max_lng]},
+            },
+            'first_ts': {'$min': ['$first_ts', self.first_ts]},
+            'first_timestamp': {'$cond': [earlier, literal(self.first_ts.isoformat()), '$first_timestamp']},
+            'last_ts': {'$max': ['$last_ts', self.last_ts]},
+            'last_timestamp': {'$cond': [newer, literal(self.last_ts.isoformat()), '$last_timestamp']},
+            'last_lat': {'$cond': [newer, self.last_lat, '$last_lat']},
+            'last_lng': {'$cond': [newer, self.last_lng, '$last_lng']},
+            'needs_rebuild': {'$or': [{'$ifNull': ['$needs_rebuild', False]}, self.needs_rebuild, diverged]},
+        }}]
+
+
+def to_response(doc: Optional[dict]) -> dict:
+    """API shape of a session's stats (zeros when the session has no points)"""
+    doc = doc or {}
+    return {
+        'point_count': doc.get('point_count', 0),
+        'total_distance': round(doc.get('distance_km', 0.0), 2),
+        'moving_minutes': round(doc.get('moving_seconds', 0.0) / 60.0, 1),
+        'max_speed_kmh': round(doc.get('max_speed_kmh', 0.0), 1),
+        'bbox': doc.get('bbox'),
+        'first_timestamp': doc.get('first_timestamp'),
+        'last_timestamp': doc.get('last_timestamp'),
+    }
+
+
+class TrailStatsAccumulator:
+    """Remembers where each live session's trail ends and produces the writes that extend its stats"""
+
+    def __init__(self, max_sessions: int = TRAIL_STATS_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._tails: "OrderedDict[Tuple[str, str], Tail]" = OrderedDict()
+
+    async def _load_tails(self, db, keys: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[Tail]]:
+        tails = {}
+        missing = []
+        for key in keys:
+            tails[key] = self._tails.get(key)
+            if tails[key] is None:
+                missing.append(key)
+        if missing:
+            ids = [session_key(pid, date) for pid, date in missing]
+            projection = {'patrol_id': 1, 'session_date': 1, 'last_lat': 1, 'last_lng': 1,
+                          'last_ts': 1, 'last_timestamp': 1}
+            async for doc in db[TRAIL_SESSIONS_COLLECTION].find({'_id': {'$in': ids}}, projection):
+                last = doc.get('last_ts') or doc.get('last_timestamp')
+                if last is not None and doc.get('last_lat') is not None:
+                    tails[(doc['patrol_id'], doc['session_date'])] = (doc['last_lat'], doc['last_lng'], _stored_ts(last))
+        return tails
+
+    async def prepare(self, db, sessions: Dict[Tuple[str, str], Tuple[Optional[str], List[dict]]]
+                      ) -> Tuple[List[UpdateOne], Dict[Tuple[str, str], Tail]]:
+        """
+        Build the trail_sessions upserts for a flush's points.
+        `sessions` maps (patrol_id, session_date) -> (hq_id, points sorted by timestamp).
+        Returns the operations and the new tails to commit() once they are written.
+        """
+        tails = await self._load_tails(db, sessions)
+
+        operations = []
+        new_tails = {}
+        for (patrol_id, session_date), (hq_id, points) in sessions.items():
+            tail = tails[(patrol_id, session_date)]
+            delta = SessionStats(patrol_id, hq_id, session_date)
+            if tail is not None:
+                delta.last_lat, delta.last_lng, delta.last_ts = tail
+            for p in points:
+                delta.add_point(p['latitude'], p['longitude'], _stored_ts(p['timestamp']))
+            operations.append(UpdateOne(
+                {'_id': session_key(patrol_id, session_date)},
+                delta.fold(tail[2] if tail else None),
+                upsert=True
+            ))
+            new_tails[(patrol_id, session_date)] = (delta.last_lat, delta.last_lng, delta.last_ts)
+        return operations, new_tails
+
+    def commit(self, tails: Dict[Tuple[str, str], Tail]) -> None:
+        """Remember where the written sessions now end"""
+        for key, tail in tails.items():
+            self._tails[key] = tail
+            self._tails.move_to_end(key)
+        while len(self._tails) > self.max_sessions:
+            self._tails.popitem(last=False)
+
+    def forget(self, patrol_id: str, session_date: Optional[str] = None) -> None:
+        """Drop in-memory state, e.g. when a session ends"""
+        for key in [k for k in self._tails if k[0] == patrol_id and (session_date is None or k[1] == session_date)]:
+            del self._tails[key]
+
+    async def rebuild(self, db, patrol_id: str, session_date: str, hq_id: Optional[str] = None,
+                      expected: Optional[dict] = None) -> dict:
+        """
+        Recompute a session from its stored points (used for out-of-order data and migrations).
+        With `expected` (the stats document read before), the result is only stored if no
+        flush has changed the session since; otherwise it stays marked for the next read.
+        """
+        points = await trail_store.get_patrol_trail(db, patrol_id, session_date, limit=None)
+        stats = SessionStats(patrol_id, hq_id, session_date)
+        for p in points:
+            stats.add_point(p['lat'], p['lng'], _stored_ts(p['timestamp']))
+        doc = stats.to_doc()
+        query = {'_id': session_key(patrol_id, session_date)}
+        if expected is None:
+            await db[TRAIL_SESSIONS_COLLECTION].update_one(query, {'$set': doc}, upsert=True)
+        else:
+            query['point_count'] = expected.get('point_count')
+            result = await db[TRAIL_SESSIONS_COLLECTION].update_one(query, {'$set': doc})
+            if not result.matched_count:
+                return doc
+        self.forget(patrol_id, session_date)  # Reloaded from the rebuilt document on the next flush
+        return doc
+
+    async def get(self, db, patrol_id: str, session_date: str) -> Optional[dict]:
+        """Stats document for one session, rebuilding it first if it was marked stale"""
+        doc = await db[TRAIL_SESSIONS_COLLECTION].find_one({'_id': session_key(patrol_id, session_date)})
+        if doc and doc.get('needs_rebuild'):
+            doc = await self.rebuild(db, patrol_id, session_date, doc.get('hq_id'), expected=doc)
+        return doc
+
+    async def get_for_date(self, db, session_date: str, hq_id: Optional[str] = None) -> Dict[str, dict]:
+        """Stats documents for every patrol session on a date, keyed by patrol_id"""
+        query = {'session_date': session_date}
+        if hq_id:
+            query['hq_id'] = hq_id
+        result = {}
+        async for doc in db[TRAIL_SESSIONS_COLLECTION].find(query):
+            if doc.get('needs_rebuild'):
+                doc = await self.rebuild(db, doc['patrol_id'], session_date, doc.get('hq_id'), expected=doc)
+            result[doc['patrol_id']] = doc
+        return result
+
+
+# Global instance fed by the ingest pipeline
+trail_stats = TrailStatsAccumulator()
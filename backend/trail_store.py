@@ -0,0 +1,209 @@
+"""
+Trail Point Storage
+Patrol trail points live in a MongoDB time-series collection keyed by
+patrol_id / hq_id / session_date, instead of an embedded `trail` array on
+each patrol document.
+"""
+import math
+import os
+from datetime import datetime, timezone, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+import pymongo
+from pymongo import ASCENDING, DESCENDING
+
+TRAIL_COLLECTION = 'trail_points'
+TRAIL_MAX_POINTS = 5000  # Per patrol per session, same cap as the old embedded array
+
+# A trail insert is abandoned (client side and via maxTimeMS) after this long
+TRAIL_WRITE_TIMEOUT_SECONDS = float(os.environ.get('TRAIL_WRITE_TIMEOUT_SECONDS', '5'))
+# Delta sync cursors trail the clock by more than the longest insert: `recv` is
+# stamped as the insert starts, so a point is visible before a cursor passes it
+CURSOR_VISIBILITY_LAG_SECONDS = TRAIL_WRITE_TIMEOUT_SECONDS + 1
+
+
+async def ensure_trail_collection(db) -> None:
+    """Create the time-series collection and its compound indexes if missing"""
+    existing = await db.list_collection_names(filter={'name': TRAIL_COLLECTION})
+    if not existing:
+        await db.create_collection(
+            TRAIL_COLLECTION,
+            timeseries={'timeField': 'ts', 'metaField': 'meta', 'granularity': 'seconds'}
+        )
+    collection = db[TRAIL_COLLECTION]
+    await collection.create_index(
+        [('meta.patrol_id', ASCENDING), ('meta.session_date', ASCENDING), ('ts', ASCENDING)],
+        name='patrol_session_ts'
+    )
+    await collection.create_index(
+        [('meta.hq_id', ASCENDING), ('meta.session_date', ASCENDING), ('ts', ASCENDING)],
+        name='hq_session_ts'
+    )
+    await collection.create_index(
+        [('meta.session_date', ASCENDING), ('recv', ASCENDING)],
+        name='session_recv'
+    )
+
+
+def parse_timestamp(value) -> datetime:
+    """Accept ISO strings or datetimes; naive values are treated as UTC"""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
+def format_timestamp(value) -> str:
+    """
+    Canonical ISO form (UTC, always with microseconds): timestamps in this form
+    sort and compare correctly as strings
+    """
+    return parse_timestamp(value).astimezone(timezone.utc).isoformat(timespec='microseconds')
+
+
+def make_point(patrol_id: str, hq_id: str, session_date: str, latitude: float, longitude: float, timestamp,
+               received_at: Optional[datetime] = None) -> dict:
+    """Build a time-series document for one trail point; insert_points() restamps `recv` as it writes"""
+    return {
+        'ts': parse_timestamp(timestamp),
+        'meta': {'patrol_id': patrol_id, 'hq_id': hq_id, 'session_date': session_date},
+        'lat': float(latitude),
+        'lng': float(longitude),
+        'recv': received_at or datetime.now(timezone.utc),
+    }
+
+
+def encode_cursor(value: datetime) -> str:
+    """Opaque delta-sync cursor (milliseconds since epoch)"""
+    return str(int(parse_timestamp(value).timestamp() * 1000))
+
+
+def decode_cursor(cursor: str) -> datetime:
+    """Parse a cursor from encode_cursor; raises ValueError on garbage"""
+    return datetime.fromtimestamp(int(cursor) / 1000.0, tz=timezone.utc)
+
+
+def cursor_upper_bound() -> datetime:
+    """Newest `recv` a delta read may return right now"""
+    return datetime.now(timezone.utc) - timedelta(seconds=CURSOR_VISIBILITY_LAG_SECONDS)
+
+
+def to_trail_point(doc: dict) -> dict:
+    """Convert a stored document to the point shape the API has always returned"""
+    return {
+        'lat': doc['lat'],
+        'lng': doc['lng'],
+        'timestamp': parse_timestamp(doc['ts']).isoformat(),
+        'session_date': doc['meta']['session_date'],
+    }
+
+
+async def insert_points(db, docs: List[dict]) -> None:
+    """
+    Insert trail points in one unordered write, stamping `recv` just before it
+    and bounding it by TRAIL_WRITE_TIMEOUT_SECONDS, so the points are visible
+    before any delta cursor (CURSOR_VISIBILITY_LAG_SECONDS behind) passes them
+    """
+    if docs:
+        received_at = datetime.now(timezone.utc)
+        for doc in docs:
+            doc['recv'] = received_at
+        with pymongo.timeout(TRAIL_WRITE_TIMEOUT_SECONDS):
+            await db[TRAIL_COLLECTION].insert_many(docs, ordered=False)
+
+
+def _session_query(session_date: str, since: Optional[datetime] = None,
+                   until: Optional[datetime] = None) -> dict:
+    query = {'meta.session_date': session_date}
+    if since is not None:
+        query['ts'] = {'$gte': parse_timestamp(since)}
+    if until is not None:
+        query['recv'] = {'$lte': until}
+    return query
+
+
+async def get_patrol_trail(db, patrol_id: str, session_date: str, since: Optional[datetime] = None,
+                           limit: Optional[int] = TRAIL_MAX_POINTS, until: Optional[datetime] = None) -> List[dict]:
+    """
+    Points for one patrol's session, oldest first (newest `limit` points kept; None for all).
+    `until` leaves out points stored after it, so a response's cursor covers exactly what it returned.
+    """
+    query = _session_query(session_date, since, until)
+    query['meta.patrol_id'] = patrol_id
+    if limit is None:
+        docs = await db[TRAIL_COLLECTION].find(query, {'_id': 0}).sort('ts', ASCENDING).to_list(None)
+    else:
+        cursor = db[TRAIL_COLLECTION].find(query, {'_id': 0}).sort('ts', DESCENDING).limit(limit)
+        docs = await cursor.to_list(length=limit)
+        docs.reverse()
+    return [to_trail_point(doc) for doc in docs]
+
+
+async def get_trails(db, patrol_ids: Iterable[str], session_date: str,
+                     since: Optional[datetime] = None, until: Optional[datetime] = None) -> Dict[str, List[dict]]:
+    """Points for several patrols' sessions in a single query, grouped by patrol (stored up to `until`)"""
+    query = _session_query(session_date, since, until)
+    query['meta.patrol_id'] = {'$in': list(patrol_ids)}
+    cursor = db[TRAIL_COLLECTION].find(query, {'_id': 0}).sort(
+        [('meta.patrol_id', ASCENDING), ('ts', ASCENDING)]
+    )
+    trails: Dict[str, List[dict]] = {}
+    async for doc in cursor:
+        trails.setdefault(doc['meta']['patrol_id'], []).append(to_trail_point(doc))
+    for patrol_id, points in trails.items():
+        if len(points) > TRAIL_MAX_POINTS:
+            trails[patrol_id] = points[-TRAIL_MAX_POINTS:]
+    return trails
+
+
+async def get_trail_updates(db, patrol_ids: Iterable[str], session_date: str,
+                            after: datetime, until: datetime) -> Dict[str, List[dict]]:
+    """Points stored in (after, until] for several patrols, grouped by patrol and ordered by ts"""
+    query = {
+        'meta.session_date': session_date,
+        'meta.patrol_id': {'$in': list(patrol_ids)},
+        'recv': {'$gt': after, '$lte': until},
+    }
+    cursor = db[TRAIL_COLLECTION].find(query, {'_id': 0}).sort(
+        [('meta.patrol_id', ASCENDING), ('ts', ASCENDING)]
+    )
+    updates: Dict[str, List[dict]] = {}
+    async for doc in cursor:
+        updates.setdefault(doc['meta']['patrol_id'], []).append(to_trail_point(doc))
+    return updates
+
+
+async def existing_timestamps(db, patrol_id: str, session_date: str, timestamps_ms: Iterable[int]) -> Set[int]:
+    """Which of the given epoch-ms timestamps are already stored for the session (replay dedupe)"""
+    timestamps_ms = [int(t) for t in timestamps_ms]
+    if not timestamps_ms:
+        return set()
+    query = _session_query(session_date)
+    query['meta.patrol_id'] = patrol_id
+    query['ts'] = {
+        '$gte': datetime.fromtimestamp(min(timestamps_ms) / 1000.0, tz=timezone.utc),
+        '$lte': datetime.fromtimestamp(max(timestamps_ms) / 1000.0, tz=timezone.utc),
+    }
+    docs = await db[TRAIL_COLLECTION].find(query, {'_id': 0, 'ts': 1}).to_list(None)
+    return {round(parse_timestamp(doc['ts']).timestamp() * 1000) for doc in docs}
+
+
+async def delete_patrol_points(db, patrol_id: str, session_date: Optional[str] = None) -> int:
+    """Remove a patrol's points (optionally only one session)"""
+    query = {'meta.patrol_id': patrol_id}
+    if session_date:
+        query['meta.session_date'] = session_date
+    result = await db[TRAIL_COLLECTION].delete_many(query)
+    return result.deleted_count
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance between two points in kilometres"""
+    r = 6371.0
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * r * math.asin(math.sqrt(a))
+
@@ -0,0 +1,409 @@
+"""
+Vector Tiles
+Mapbox Vector Tiles for the pre-converted KML layers (kml_layers.py) and the
+day's patrol trails. A map then only downloads what is in view, simplified
+for the zoom it is shown at, instead of whole GeoJSON documents.
+
+Geometries are projected to Web Mercator once per layer and indexed in a
+shapely STRtree. A tile is an index query, a clip to the tile plus a small
+buffer, a simplification to TILE_SIMPLIFY_PIXELS of error at the tile's
+zoom, and an encode.
+
+Encoded tiles sit in a memory LRU bounded in bytes. KML layer ids are
+content hashes, so their tiles never change: they are also written to disk,
+and a replaced KML simply has new layer ids. The disk tier is trimmed to
+TILE_DISK_MAX_BYTES by a background thread, never by the request writing. Trail indexes pull points
+stored since their last refresh (the `recv` cursor, so fixes ingested by
+any worker are seen), and only the cached tiles those points touch are
+dropped.
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import mapbox_vector_tile
+import numpy as np
+import orjson
+import shapely
+from mapbox_vector_tile.encoder import on_invalid_geometry_make_valid
+from pymongo import ASCENDING
+
+import trail_store
+from kml_layers import KML_LAYER_DIR, LAYER_ID_PATTERN, artifact_path
+
+TRAILS_LAYER = 'trails'
+TILE_EXTENT = 4096
+TILE_BUFFER = 64  # In tile units; features are clipped this far outside the tile
+TILE_MAX_ZOOM = int(os.environ.get('TILE_MAX_ZOOM', '20'))
+TILE_SIMPLIFY_PIXELS = float(os.environ.get('TILE_SIMPLIFY_PIXELS', '0.5'))
+TILE_CACHE_MAX_BYTES = int(os.environ.get('TILE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+TILE_DISK_DIR = Path(os.environ.get('TILE_DISK_DIR', str(KML_LAYER_DIR / 'tiles')))
+TILE_DISK_MAX_BYTES = int(os.environ.get('TILE_DISK_MAX_BYTES', str(512 * 1024 * 1024)))
+TILE_DISK_SWEEP_EVERY = 500  # Disk writes between size checks
+TILE_INDEX_MAX_LAYERS = int(os.environ.get('TILE_INDEX_MAX_LAYERS', '32'))
+TRAIL_TILE_REFRESH_SECONDS = float(os.environ.get('TRAIL_TILE_REFRESH_SECONDS', '2'))
+
+MERCATOR_ORIGIN = 20037508.342789244
+MERCATOR_MAX_LAT = 85.0511287798
+KML_PROPERTIES = ('name', 'folder', 'styleUrl')
+
+TileKey = Tuple
+
+
+def to_mercator(coords: np.ndarray) -> np.ndarray:
+    """(n, 2) lng/lat -> Web Mercator metres"""
+    lng = coords[:, 0]
+    lat = np.clip(coords[:, 1], -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT)
+    x = lng * MERCATOR_ORIGIN / 180.0
+    y = np.log(np.tan(np.radians(90.0 + lat) / 2.0)) * MERCATOR_ORIGIN / math.pi
+    return np.column_stack((x, y))
+
+
+def tile_size(z: int) -> float:
+    return 2 * MERCATOR_ORIGIN / (2 ** z)
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Mercator bounds of an XYZ tile (y counted from the top)"""
+    size = tile_size(z)
+    minx = -MERCATOR_ORIGIN + x * size
+    maxy = MERCATOR_ORIGIN - y * size
+    return minx, maxy - size, minx + size, maxy
+
+
+def valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= TILE_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _tile_intersects(key: TileKey, bbox: Tuple[float, float, float, float]) -> bool:
+    """Does the (buffered) tile at the end of a cache key overlap a mercator bbox"""
+    z, x, y = key[-3:]
+    minx, miny, maxx, maxy = tile_bounds(z, x, y)
+    pad = tile_size(z) * TILE_BUFFER / TILE_EXTENT
+    return minx - pad <= bbox[2] and bbox[0] <= maxx + pad and miny - pad <= bbox[3] and bbox[1] <= maxy + pad
+
+
+class _GeometryIndex:
+    """Mercator geometries of one layer with an STRtree"""
+
+    def __init__(self, geometries: np.ndarray, properties: List[dict]):
+        self.geometries = geometries
+        self.properties = properties
+        self.tree = shapely.STRtree(geometries)
+
+    def features(self, z: int, x: int, y: int) -> List[dict]:
+        """Features clipped to the buffered tile, then simplified for its zoom"""
+        minx, miny, maxx, maxy = tile_bounds(z, x, y)
+        pad = tile_size(z) * TILE_BUFFER / TILE_EXTENT
+        box = (minx - pad, miny - pad, maxx + pad, maxy + pad)
+        hits = self.tree.query(shapely.box(*box))
+        if len(hits) == 0:
+            return []
+        # Clipping first keeps the simplify cost proportional to what is in the tile
+        clipped = shapely.clip_by_rect(self.geometries[hits], *box)
+        tolerance = tile_size(z) / 256 * TILE_SIMPLIFY_PIXELS
+        simplified = shapely.simplify(clipped, tolerance, preserve_topology=True)
+        return [
+            {'geometry': geometry, 'properties': self.properties[i]}
+            for i, geometry in zip(hits.tolist(), simplified) if not geometry.is_empty
+        ]
+
+
+def _encode(layer_name: str, features: List[dict], z: int, x: int, y: int) -> bytes:
+    if not features:
+        return b''
+    return mapbox_vector_tile.encode(
+        [{'name': layer_name, 'features': features}],
+        default_options={
+            'quantize_bounds': tile_bounds(z, x, y),
+            'extents': TILE_EXTENT,
+            'on_invalid_geometry': on_invalid_geometry_make_valid,
+        }
+    )
+
+
+def _load_kml_index(layer_id: str) -> Optional[_GeometryIndex]:
+    path = artifact_path(layer_id)
+    if not path.exists():
+        return None
+    features = orjson.loads(path.read_bytes()).get('features', [])
+    geometries = shapely.from_geojson([orjson.dumps(f['geometry']) for f in features])
+    geometries = shapely.transform(geometries, to_mercator)
+    properties = [
+        {k: v for k, v in ((k, (f.get('properties') or {}).get(k)) for k in KML_PROPERTIES) if v is not None}
+        for f in features
+    ]
+    return _GeometryIndex(geometries, properties)
+
+
+class _TrailIndex:
+    """One HQ's trails for a session day, kept current from the recv cursor"""
+
+    def __init__(self, hq_id: Optional[str], session_date: str):
+        self.hq_id = hq_id
+        self.session_date = session_date
+        self.points: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}  # patrol_id -> (ts ms, mercator xy)
+        self.cursor: Optional[datetime] = None
+        self.refreshed_at = 0.0
+        self.index: Optional[_GeometryIndex] = None
+        self.lock = asyncio.Lock()
+
+    def _query(self, after: Optional[datetime], until: datetime) -> dict:
+        query = {'meta.session_date': self.session_date, 'recv': {'$lte': until}}
+        if after is not None:
+            query['recv']['$gt'] = after
+        if self.hq_id:
+            query['meta.hq_id'] = self.hq_id
+        return query
+
+    async def refresh(self, db) -> List[Tuple[float, float, float, float]]:
+        """Pull new points; returns mercator bboxes of trail sections that changed"""
+        until = trail_store.cursor_upper_bound()
+        cursor = db[trail_store.TRAIL_COLLECTION].find(
+            self._query(self.cursor, until), {'_id': 0, 'meta.patrol_id': 1, 'ts': 1, 'lat': 1, 'lng': 1}
+        ).sort([('meta.patrol_id', ASCENDING), ('ts', ASCENDING)])
+        new: Dict[str, List[tuple]] = {}
+        async for doc in cursor:
+            ts = trail_store.parse_timestamp(doc['ts']).timestamp() * 1000
+            new.setdefault(doc['meta']['patrol_id'], []).append((ts, doc['lng'], doc['lat']))
+        self.cursor = until
+        self.refreshed_at = time.monotonic()
+
+        changed = []
+        for patrol_id, rows in new.items():
+            rows = np.array(rows, dtype=float)
+            ts, xy = rows[:, 0], to_mercator(rows[:, 1:])
+            old = self.points.get(patrol_id)
+            if old is not None:
+                in_order = ts[0] >= old[0][-1]
+                ts, xy = np.concatenate((old[0], ts)), np.concatenate((old[1], xy))
+                if in_order:
+                    touched = xy[len(old[0]) - 1:]  # Includes the segment joining the old end
+                else:
+                    order = np.argsort(ts, kind='stable')  # Replayed offline points land mid-trail
+                    ts, xy = ts[order], xy[order]
+                    touched = xy
+            else:
+                touched = xy
+            if len(ts) > trail_store.TRAIL_MAX_POINTS:
+                ts, xy = ts[-trail_store.TRAIL_MAX_POINTS:], xy[-trail_store.TRAIL_MAX_POINTS:]
+                touched = xy  # Start of the trail moved too
+            self.points[patrol_id] = (ts, xy)
+            changed.append((*touched.min(axis=0), *touched.max(axis=0)))
+
+        if new or self.index is None:
+            patrol_ids = [p for p, (ts, _) in self.points.items() if len(ts) >= 2]
+            self.index = _GeometryIndex(
+                np.array([shapely.linestrings(self.points[p][1]) for p in patrol_ids], dtype=object),
+                [{'patrol_id': p, 'points': len(self.points[p][0])} for p in patrol_ids]
+            ) if patrol_ids else None
+        return changed
+
+
+class VectorTileCache:
+    """Tile generation plus memory LRU (all tiles) and disk tier (immutable KML tiles)"""
+
+    def __init__(self, max_bytes: int = TILE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._tiles: "OrderedDict[TileKey, bytes]" = OrderedDict()
+        self._bytes = 0
+        self._kml: "OrderedDict[str, _GeometryIndex]" = OrderedDict()
+        self._trails: "OrderedDict[Tuple[Optional[str], str], _TrailIndex]" = OrderedDict()
+        self._trail_keys: Dict[Tuple[Optional[str], str], Set[TileKey]] = {}
+        self._disk_writes = 0
+        self._sweeper: Optional[threading.Thread] = None
+        self._lock = threading.Lock()  # KML tiles are rendered in worker threads
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def _get(self, key: TileKey) -> Optional[bytes]:
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is not None:
+                self._tiles.move_to_end(key)
+            return tile
+
+    def _put(self, key: TileKey, tile: bytes) -> None:
+        with self._lock:
+            self._drop(key)
+            self._tiles[key] = tile
+            self._bytes += len(tile)
+            if key[0] == TRAILS_LAYER:
+                self._trail_keys.setdefault(key[1:3], set()).add(key)
+            while self._bytes > self.max_bytes and self._tiles:
+                self._drop(next(iter(self._tiles)))
+
+    def _drop(self, key: TileKey) -> None:
+        """Caller holds self._lock"""
+        tile = self._tiles.pop(key, None)
+        if tile is not None:
+            self._bytes -= len(tile)
+            if key[0] == TRAILS_LAYER:
+                self._trail_keys.get(key[1:3], set()).discard(key)
+
+    # KML layers
+
+    def _kml_index(self, layer_id: str) -> Optional[_GeometryIndex]:
+        with self._lock:
+            index = self._kml.get(layer_id)
+            if index is not None:
+                self._kml.move_to_end(layer_id)
+                return index
+        index = _load_kml_index(layer_id)  # Outside the lock; a concurrent duplicate load is harmless
+        if index is None:
+            return None
+        with self._lock:
+            self._kml[layer_id] = index
+            while len(self._kml) > TILE_INDEX_MAX_LAYERS:
+                self._kml.popitem(last=False)
+        return index
+
+    @staticmethod
+    def _disk_path(layer_id: str, z: int, x: int, y: int) -> Path:
+        return TILE_DISK_DIR / layer_id / str(z) / str(x) / f"{y}.mvt"
+
+    def _sweep_disk(self) -> None:
+        """Delete least recently used tile files once the directory is over its budget"""
+        files = []
+        for path in TILE_DISK_DIR.rglob('*.mvt'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        if total <= TILE_DISK_MAX_BYTES:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total <= TILE_DISK_MAX_BYTES * 0.8:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def _sweep_in_background(self) -> None:
+        try:
+            self._sweep_disk()
+        except OSError as e:
+            print(f"Tile disk sweep failed: {e}")
+        finally:
+            with self._lock:
+                self._sweeper = None
+
+    def _count_disk_write(self) -> None:
+        """Every TILE_DISK_SWEEP_EVERY writes, start a sweep unless one is running"""
+        with self._lock:
+            self._disk_writes += 1
+            if self._disk_writes % TILE_DISK_SWEEP_EVERY or self._sweeper is not None:
+                return
+            self._sweeper = threading.Thread(target=self._sweep_in_background, name='tile-disk-sweep', daemon=True)
+            sweeper = self._sweeper
+        sweeper.start()
+
+    def kml_tile(self, layer_id: str, z: int, x: int, y: int) -> Optional[bytes]:
+        """Blocking; run in a worker thread. None when the layer does not exist."""
+        key = ('kml', layer_id, z, x, y)
+        tile = self._get(key)
+        if tile is not None:
+            self.hits += 1
+            return tile
+
+        path = self._disk_path(layer_id, z, x, y)
+        if path.exists():
+            tile = path.read_bytes()
+            os.utime(path)  # mtime is the LRU clock for the disk sweep
+            self.disk_hits += 1
+        else:
+            index = self._kml_index(layer_id)
+            if index is None:
+                return None
+            tile = _encode(layer_id, index.features(z, x, y), z, x, y)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(tile)
+            os.replace(tmp, path)
+            self._count_disk_write()
+            self.misses += 1
+        self._put(key, tile)
+        return tile
+
+    # Trails
+
+    async def _trail_index(self, db, hq_id: Optional[str], session_date: str) -> _TrailIndex:
+        hq_session = (hq_id, session_date)
+        trails = self._trails.get(hq_session)
+        if trails is None:
+            trails = _TrailIndex(hq_id, session_date)
+            self._trails[hq_session] = trails
+            while len(self._trails) > TILE_INDEX_MAX_LAYERS:
+                self._forget_trails(next(iter(self._trails)))
+        else:
+            self._trails.move_to_end(hq_session)
+
+        async with trails.lock:
+            if time.monotonic() - trails.refreshed_at >= TRAIL_TILE_REFRESH_SECONDS:
+                changed = await trails.refresh(db)
+                with self._lock:
+                    keys = self._trail_keys.get(hq_session, set())
+                    for key in [k for k in keys if any(_tile_intersects(k, bbox) for bbox in changed)]:
+                        self._drop(key)
+                        self.invalidated += 1
+        return trails
+
+    def _forget_trails(self, hq_session: Tuple[Optional[str], str]) -> None:
+        self._trails.pop(hq_session, None)
+        with self._lock:
+            for key in list(self._trail_keys.pop(hq_session, ())):
+                self._drop(key)
+
+    async def trail_tile(self, db, hq_id: Optional[str], session_date: str, z: int, x: int, y: int) -> bytes:
+        """Tile of a session day's trails (hq_id None: every HQ); generated on the event loop"""
+        trails = await self._trail_index(db, hq_id, session_date)
+        key = (TRAILS_LAYER, hq_id, session_date, z, x, y)
+        tile = self._get(key)
+        if tile is not None:
+            self.hits += 1
+            return tile
+        self.misses += 1
+        index = trails.index  # Refresh swaps in a new index, so the thread reads a stable one
+        if index is None:
+            tile = b''
+        else:
+            tile = await asyncio.to_thread(lambda: _encode(TRAILS_LAYER, index.features(z, x, y), z, x, y))
+        # A refresh during the encode swapped the index and already dropped the keys it
+        # touched; caching this tile now would keep it stale
+        if trails.index is index and self._trails.get((hq_id, session_date)) is trails:
+            self._put(key, tile)
+        return tile
+
+    def stats(self) -> dict:
+        with self._lock:
+            tiles, size = len(self._tiles), self._bytes
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'tiles': tiles,
+            'bytes': size,
+            'kml_indexes': len(self._kml),
+            'trail_indexes': len(self._trails),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'invalidated': self.invalidated,
+            'hit_rate': round((self.hits + self.disk_hits) / total, 4) if total else 0,
+        }
+
+
+def is_kml_layer(layer: str) -> bool:
+    return bool(LAYER_ID_PATTERN.match(layer))
+
+
+vector_tiles = VectorTileCache()
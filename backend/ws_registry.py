@@ -0,0 +1,258 @@
+"""
+WebSocket Connection Registry
+Connections indexed by hq_id, each with its own bounded send queue and writer
+task, so a slow socket only delays itself instead of the whole fan-out.
+
+Messages are encoded once per event and the same frame is queued for every
+client. Location updates are coalesced per HQ into one `patrol_locations`
+frame per tick (newest point per patrol wins); SOS alerts go out immediately.
+
+The WebSocket endpoint registers clients with
+    connection = connection_registry.register(client_id, websocket, hq_id)
+and calls `await connection_registry.unregister(client_id)` on disconnect.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Dict, Optional, Set
+
+import orjson
+
+WS_COALESCE_INTERVAL_MS = int(os.environ.get('WS_COALESCE_INTERVAL_MS', '250'))
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '1024'))
+WS_SEND_TIMEOUT = float(os.environ.get('WS_SEND_TIMEOUT', '5.0'))  # seconds
+WS_SLOW_CLIENT_TIMEOUT = float(os.environ.get('WS_SLOW_CLIENT_TIMEOUT', '30.0'))  # seconds overflowing without a send before disconnect
+
+
+def encode_message(payload: dict) -> str:
+    """Serialize a WebSocket message once; the result is shared by every recipient"""
+    return orjson.dumps(payload).decode('utf-8')
+
+
+class ClientConnection:
+    """One WebSocket client with its own send queue and writer task"""
+
+    def __init__(self, client_id: str, hq_id: str, ws, registry: "ConnectionRegistry"):
+        self.client_id = client_id
+        self.hq_id = hq_id
+        self.ws = ws
+        self.registry = registry
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.priority: deque = deque()  # critical messages that arrived while the queue was full
+        self.sent = 0
+        self.dropped = 0
+        self.full_since: Optional[float] = None  # first overflow since the last successful send
+        self.last_send_ms = 0.0
+        self.max_send_ms = 0.0
+        self.total_send_ms = 0.0
+        self.closed = False
+        self._task = asyncio.create_task(self._writer())
+
+    def enqueue(self, message: str, critical: bool = False) -> bool:
+        """
+        Queue a message without blocking. When the queue is full the oldest queued
+        message is dropped (newest location wins); critical messages are never
+        dropped and are sent ahead of the backlog instead.
+        Returns False if a message had to be dropped.
+        """
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if critical:
+            self.priority.append(message)
+            return True
+
+        try:
+            self.queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+        self.queue.put_nowait(message)
+        self.dropped += 1
+        self.registry.dropped += 1
+
+        now = time.monotonic()
+        if self.full_since is None:
+            self.full_since = now
+        elif now - self.full_since > WS_SLOW_CLIENT_TIMEOUT:
+            print(f"WebSocket client {self.client_id} too slow, disconnecting")
+            self.closed = True
+            asyncio.create_task(self.registry.unregister(self.client_id, close=True))
+        return False
+
+    async def _writer(self) -> None:
+        while True:
+            # The queue is full whenever priority is non-empty, so get() never blocks past it
+            message = self.priority.popleft() if self.priority else await self.queue.get()
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.ws.send_text(message), timeout=WS_SEND_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"WebSocket send error to {self.client_id}: {e}")
+                asyncio.create_task(self.registry.unregister(self.client_id, close=True))
+                return
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.sent += 1
+            self.full_since = None
+            self.last_send_ms = elapsed_ms
+            self.max_send_ms = max(self.max_send_ms, elapsed_ms)
+            self.total_send_ms += elapsed_ms
+
+    async def close(self, close_socket: bool = False) -> None:
+        self.closed = True
+        self._task.cancel()
+        try:
+            await self._task
+        except (asyncio.CancelledError, Exception):
+            pass
+        if close_socket:
+            try:
+                await self.ws.close()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'client_id': self.client_id,
+            'queue_depth': self.queue.qsize() + len(self.priority),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'last_send_ms': round(self.last_send_ms, 2),
+            'max_send_ms': round(self.max_send_ms, 2),
+            'avg_send_ms': round(self.total_send_ms / self.sent, 2) if self.sent else 0,
+        }
+
+
+class ConnectionRegistry:
+    """Active WebSocket connections, indexed by client_id and by hq_id"""
+
+    def __init__(self):
+        self.clients: Dict[str, ClientConnection] = {}
+        self.by_hq: Dict[str, Set[str]] = {}
+        self.dropped = 0
+
+    def register(self, client_id: str, ws, hq_id: Optional[str] = None) -> ClientConnection:
+        """Add a connection (must be called from the event loop); replaces any previous one with the same id"""
+        existing = self.clients.pop(client_id, None)
+        if existing:
+            self._unindex(existing)
+            asyncio.create_task(existing.close())
+
+        connection = ClientConnection(client_id, hq_id or client_id, ws, self)
+        self.clients[client_id] = connection
+        self.by_hq.setdefault(connection.hq_id, set()).add(client_id)
+        return connection
+
+    def _unindex(self, connection: ClientConnection) -> None:
+        members = self.by_hq.get(connection.hq_id)
+        if members:
+            members.discard(connection.client_id)
+            if not members:
+                del self.by_hq[connection.hq_id]
+
+    async def unregister(self, client_id: str, close: bool = False) -> None:
+        connection = self.clients.pop(client_id, None)
+        if connection:
+            self._unindex(connection)
+            await connection.close(close_socket=close)
+
+    def broadcast(self, hq_id: str, message: str, critical: bool = False) -> int:
+        """Queue a message for every client of an HQ; returns how many clients it was queued for"""
+        count = 0
+        for client_id in list(self.by_hq.get(hq_id, ())):
+            connection = self.clients.get(client_id)
+            if connection:
+                connection.enqueue(message, critical=critical)
+                count += 1
+        return count
+
+    def stats(self) -> dict:
+        connections = [c.stats() for c in self.clients.values()]
+        return {
+            'connections': len(connections),
+            'hqs': len(self.by_hq),
+            'queued': sum(c['queue_depth'] for c in connections),
+            'max_queue_depth': max((c['queue_depth'] for c in connections), default=0),
+            'sent': sum(c['sent'] for c in connections),
+            'dropped': self.dropped,
+            'max_send_ms': max((c['max_send_ms'] for c in connections), default=0),
+            'clients': connections,
+        }
+
+
+class LocationCoalescer:
+    """
+    Collects location updates per HQ and broadcasts them as one
+    `patrol_locations` frame every WS_COALESCE_INTERVAL_MS
+    """
+
+    def __init__(self, registry: ConnectionRegistry, interval_ms: int = WS_COALESCE_INTERVAL_MS):
+        self.registry = registry
+        self.interval = interval_ms / 1000.0
+        self._pending: Dict[str, Dict[str, dict]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.updates_in = 0
+        self.updates_out = 0
+        self.frames = 0
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    def add(self, hq_id: str, update: dict) -> None:
+        """Queue an update ({'patrol_id', 'latitude', 'longitude', 'timestamp'}) for the next tick"""
+        self.updates_in += 1
+        pending = self._pending.setdefault(hq_id, {})
+        current = pending.get(update['patrol_id'])
+        if current is None or update['timestamp'] >= current['timestamp']:
+            pending[update['patrol_id']] = update
+
+    def flush(self) -> None:
+        pending, self._pending = self._pending, {}
+        for hq_id, updates in pending.items():
+            if hq_id not in self.registry.by_hq:
+                continue  # Nobody watching, skip the encode
+            frame = encode_message({'type': 'patrol_locations', 'updates': list(updates.values())})
+            self.registry.broadcast(hq_id, frame)
+            self.updates_out += len(updates)
+            self.frames += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Location broadcast error: {e}")
+
+    def stats(self) -> dict:
+        return {
+            'interval_ms': int(self.interval * 1000),
+            'pending_hqs': len(self._pending),
+            'updates_in': self.updates_in,
+            'updates_out': self.updates_out,
+            'frames': self.frames,
+        }
+
+
+# Global instances shared by the WebSocket endpoint and the MQTT bridge
+connection_registry = ConnectionRegistry()
+location_coalescer = LocationCoalescer(connection_registry)
@@ -10,10 +10,13 @@ const API = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
 // Google Maps KML URL from the uploaded KMZ file
 const KML_SOURCE_URL = 'https://www.google.com/maps/d/kml?mid=1aQqIVEKSDv4m631OQJyIzDBtJsdf5U0';
 
-// Helper to fetch GeoJSON directly from backend (server-side KML parsing)
-const fetchGeoJSONFromBackend = async (url) => {
+// Layers at least this large are drawn from /api/tiles vector tiles instead of downloaded whole
+const KML_TILE_MIN_BYTES = 256 * 1024;
+
+// Layer manifest for a remote KML; the backend converts it once and splits it into layers
+const fetchManifestFromBackend = async (url) => {
   try {
-    const apiUrl = `${API}/api/kml/geojson?url=${encodeURIComponent(url)}`;
+    const apiUrl = `${API}/api/kml/manifest?url=${encodeURIComponent(url)}`;
     const response = await fetch(apiUrl);
     
     if (!response.ok) {
@@ -23,11 +26,18 @@ const fetchGeoJSONFromBackend = async (url) => {
     
     return await response.json();
   } catch (error) {
-    console.error('Error fetching GeoJSON from backend:', error);
+    console.error('Error fetching KML manifest from backend:', error);
     throw error;
   }
 };
 
+// One pre-converted layer; ids are content hashes, so the browser caches them indefinitely
+const fetchLayerGeoJSON = async (layerId) => {
+  const response = await fetch(`${API}/api/kml/layers/${layerId}`);
+  if (!response.ok) throw new Error(`Layer ${layerId}: HTTP ${response.status}`);
+  return await response.json();
+};
+
 // Fetch uploaded KML files for HQ
 const fetchUploadedKMLFiles = async (hqId) => {
   try {
@@ -40,7 +50,18 @@ const fetchUploadedKMLFiles = async (hqId) => {
   }
 };
 
-// Fetch GeoJSON for uploaded file
+// Layer manifest for an uploaded file (404 for files uploaded before conversion at upload time)
+const fetchUploadedFileManifest = async (fileId) => {
+  try {
+    const response = await fetch(`${API}/api/kml/files/${fileId}/layers`);
+    return response.ok ? await response.json() : null;
+  } catch (error) {
+    console.error('Error fetching file layers:', error);
+    return null;
+  }
+};
+
+// Fetch the whole GeoJSON for an uploaded file (fallback when it has no manifest)
 const fetchUploadedFileGeoJSON = async (fileId) => {
   try {
     const response = await fetch(`${API}/api/kml/files/${fileId}`);
@@ -52,61 +73,10 @@ const fetchUploadedFileGeoJSON = async (fileId) => {
   }
 };
 
-// Extract layer groups from GeoJSON features
-const extractLayers = (geojson) => {
-  if (!geojson || !geojson.features) {
-    console.log('No features in GeoJSON');
-    return [];
-  }
-  
-  console.log(`Extracting layers from ${geojson.features.length} features`);
-  
-  const layerMap = new Map();
-  
-  geojson.features.forEach((feature, index) => {
-    // Get folder/layer name from properties - handle various KML exports
-    const folderName = feature.properties?.folder || 
-                       feature.properties?.styleUrl?.replace('#', '') || 
-                       feature.properties?.name?.substring(0, 30) || 
-                       `Layer ${Math.floor(index / 50)}`;
-    
-    // Group by first part of name (e.g., "(1 EB) Name" -> "1 EB")
-    const nameMatch = feature.properties?.name?.match(/^\(([^)]+)\)/);
-    const groupKey = nameMatch ? nameMatch[1] : folderName;
-    
-    if (!layerMap.has(groupKey)) {
-      layerMap.set(groupKey, {
-        id: `layer_${layerMap.size}`,
-        name: groupKey,
-        visible: false,  // OFF by default - user must toggle ON
-        features: [],
-        color: getColorFromStyle(groupKey),
-        type: 'mixed'
-      });
-    }
-    
-    layerMap.get(groupKey).features.push(feature);
-  });
-  
-  // Update layer types based on majority geometry
-  layerMap.forEach(layer => {
-    const types = layer.features.map(f => f.geometry?.type).filter(Boolean);
-    const pointCount = types.filter(t => t === 'Point').length;
-    const polyCount = types.filter(t => t === 'Polygon').length;
-    const lineCount = types.filter(t => t === 'LineString').length;
-    
-    if (pointCount > polyCount && pointCount > lineCount) {
-      layer.type = 'point';
-    } else if (polyCount > pointCount && polyCount > lineCount) {
-      layer.type = 'polygon';
-    } else if (lineCount > pointCount && lineCount > polyCount) {
-      layer.type = 'line';
-    }
-  });
-  
-  const layers = Array.from(layerMap.values());
-  console.log(`Created ${layers.length} layer groups`);
-  return layers;
+// Load the features of a layer that was listed from a manifest
+const loadLayerFeatures = async (layer) => {
+  const collections = await Promise.all(layer.layerIds.map(fetchLayerGeoJSON));
+  return collections.flatMap(collection => collection.features || []);
 };
 
 // Get color from KML style
@@ -247,21 +217,34 @@ export const KMLLayerPanel = ({ onLayersUpdate, mapRef, hqId }) => {
       const files = await fetchUploadedKMLFiles(hqId);
       setUploadedFiles(files);
       
-      // Load GeoJSON for each file
+      // Manifest for each file; features load when the layer is switched on
       const layersPromises = files.map(async (file) => {
-        const geojson = await fetchUploadedFileGeoJSON(file.id);
-        if (geojson) {
+        const layer = {
+          id: `uploaded_${file.id}`,
+          name: `📁 ${file.name}`,
+          visible: false,  // OFF by default - user must toggle ON
+          color: '#FF9800',
+          isUploaded: true,
+          fileId: file.id
+        };
+        const manifest = await fetchUploadedFileManifest(file.id);
+        if (manifest) {
+          const types = new Set(manifest.layers.map(l => l.type));
+          const tiled = manifest.layers.reduce((total, l) => total + l.bytes, 0) >= KML_TILE_MIN_BYTES;
           return {
-            id: `uploaded_${file.id}`,
-            name: `📁 ${file.name}`,
-            visible: false,  // OFF by default - user must toggle ON
-            features: geojson.features || [],
-            color: '#FF9800',
-            type: 'mixed',
-            isUploaded: true,
-            fileId: file.id
+            ...layer,
+            features: [],
+            featureCount: manifest.feature_count,
+            layerIds: manifest.layers.map(l => l.id),
+            type: types.size === 1 ? [...types][0] : 'mixed',
+            tiled,
+            loaded: tiled
           };
         }
+        const geojson = await fetchUploadedFileGeoJSON(file.id);
+        if (geojson) {
+          return { ...layer, features: geojson.features || [], type: 'mixed', loaded: true };
+        }
         return null;
       });
       
@@ -279,14 +262,26 @@ export const KMLLayerPanel = ({ onLayersUpdate, mapRef, hqId }) => {
     setError(null);
     
     try {
-      // Use server-side KML to GeoJSON conversion
-      const geojson = await fetchGeoJSONFromBackend(KML_SOURCE_URL);
+      // Layers are listed from the manifest and fetched when switched on
+      const manifest = await fetchManifestFromBackend(KML_SOURCE_URL);
       
-      console.log(`Received ${geojson.features?.length || 0} features from backend`);
+      console.log(`Received manifest: ${manifest.layers.length} layers, ${manifest.feature_count} features`);
       
-      const extractedLayers = extractLayers(geojson);
-      console.log(`Extracted ${extractedLayers.length} layer groups`);
-      setLayers(extractedLayers);
+      setLayers(manifest.layers.map(layer => {
+        const tiled = layer.bytes >= KML_TILE_MIN_BYTES;
+        return {
+          id: `layer_${layer.id}`,
+          name: layer.name,
+          visible: false,  // OFF by default - user must toggle ON
+          features: [],
+          featureCount: layer.feature_count,
+          layerIds: [layer.id],
+          color: getColorFromStyle(layer.name),
+          type: layer.type,
+          tiled,
+          loaded: tiled  // Tiled layers have nothing to fetch up front
+        };
+      }));
       setLastSync(new Date());
       
       // Also load uploaded files
@@ -336,25 +331,41 @@ export const KMLLayerPanel = ({ onLayersUpdate, mapRef, hqId }) => {
     };
   }, [resetInactivityTimer]);
 
+  // Fetch features for layers being switched on, then apply the change
+  const setVisibility = async (setter, current, shouldShow) => {
+    const pending = current.filter(layer => shouldShow(layer) && !layer.loaded);
+    const loaded = {};
+    if (pending.length > 0) {
+      const results = await Promise.allSettled(pending.map(loadLayerFeatures));
+      results.forEach((result, i) => {
+        if (result.status === 'fulfilled') {
+          loaded[pending[i].id] = result.value;
+        } else {
+          toast.error(`Failed to load layer ${pending[i].name}`);
+        }
+      });
+    }
+    setter(prev => prev.map(layer => {
+      const visible = shouldShow(layer);
+      if (loaded[layer.id]) {
+        return { ...layer, visible, features: loaded[layer.id], loaded: true };
+      }
+      return { ...layer, visible: visible && layer.loaded !== false };
+    }));
+  };
+
   // Toggle layer visibility
   const toggleLayer = (layerId, isUploaded = false) => {
-    if (isUploaded) {
-      const updatedLayers = uploadedLayers.map(layer =>
-        layer.id === layerId ? { ...layer, visible: !layer.visible } : layer
-      );
-      setUploadedLayers(updatedLayers);
-    } else {
-      const updatedLayers = layers.map(layer =>
-        layer.id === layerId ? { ...layer, visible: !layer.visible } : layer
-      );
-      setLayers(updatedLayers);
-    }
+    const [setter, current] = isUploaded ? [setUploadedLayers, uploadedLayers] : [setLayers, layers];
+    const target = current.find(layer => layer.id === layerId);
+    if (!target) return;
+    setVisibility(setter, current, layer => (layer.id === layerId ? !target.visible : layer.visible));
   };
 
   // Show/hide all layers
   const toggleAllLayers = (visible) => {
-    setLayers(layers.map(layer => ({ ...layer, visible })));
-    setUploadedLayers(uploadedLayers.map(layer => ({ ...layer, visible })));
+    setVisibility(setLayers, layers, () => visible);
+    setVisibility(setUploadedLayers, uploadedLayers, () => visible);
   };
 
   // Calculate total layers
@@ -516,7 +527,7 @@ export const KMLLayerPanel = ({ onLayersUpdate, mapRef, hqId }) => {
                   <span className="text-xs text-white truncate flex-1" title={layer.name}>
                     {layer.name}
                   </span>
-                  <span className="text-xs text-gray-500">{layer.features.length}</span>
+                  <span className="text-xs text-gray-500">{layer.featureCount ?? layer.features.length}</span>
                   <Button
                     size="sm"
                     variant="ghost"
@@ -555,7 +566,7 @@ export const KMLLayerPanel = ({ onLayersUpdate, mapRef, hqId }) => {
                     <span className="text-xs text-white truncate flex-1" title={layer.name}>
                       {layer.name}
                     </span>
-                    <span className="text-xs text-gray-500">{layer.features.length}</span>
+                    <span className="text-xs text-gray-500">{layer.featureCount ?? layer.features.length}</span>
                   </div>
                 ))}
               </div>
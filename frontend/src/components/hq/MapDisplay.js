@@ -1,11 +1,13 @@
 import React, { useRef, useEffect, useImperativeHandle, forwardRef, useState, useCallback } from 'react';
-import { MapContainer, TileLayer, Marker, Polyline, Popup, CircleMarker, useMap, GeoJSON } from 'react-leaflet';
+import { MapContainer, TileLayer, Marker, Polyline, Popup, CircleMarker, useMap, useMapEvents, GeoJSON } from 'react-leaflet';
 import L from 'leaflet';
 import 'leaflet.heat';
+import 'leaflet.vectorgrid';
 import { Button } from '@/components/ui/button';
 import { Eye, EyeOff, Thermometer, ZoomIn, ZoomOut, Locate, Layers, ChevronLeft, ChevronRight } from 'lucide-react';
 import { Switch } from '@/components/ui/switch';
 import { KMLLayerPanel } from './KMLLayerPanel';
+import { trailPositions } from '@/utils/trailCodec';
 
 // Fix for default marker icon
 delete L.Icon.Default.prototype._getIconUrl;
@@ -265,6 +267,50 @@ const PatrolTrail = ({ trail, color = '#0ea5e9', showMarkers = true }) => {
   );
 };
 
+// leaflet.vectorgrid still calls L.DomEvent.fakeStop, which Leaflet 1.8 removed
+if (!L.DomEvent.fakeStop) {
+  L.DomEvent.fakeStop = () => true;
+}
+
+const API = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
+
+// One KML layer drawn from /api/tiles vector tiles (only tiles in view are downloaded)
+const VectorTileOverlay = ({ layerId, color }) => {
+  const map = useMap();
+
+  useEffect(() => {
+    const style = {
+      color,
+      weight: 2,
+      opacity: 0.8,
+      fill: true,
+      fillColor: color,
+      fillOpacity: 0.3,
+      radius: 6
+    };
+    const layer = L.vectorGrid.protobuf(`${API}/api/tiles/${layerId}/{z}/{x}/{y}.mvt`, {
+      vectorTileLayerStyles: { [layerId]: style },
+      rendererFactory: L.canvas.tile,
+      interactive: true,
+      maxNativeZoom: 20
+    });
+    layer.on('click', (e) => {
+      const name = e.layer?.properties?.name;
+      if (!name) return;
+      const content = document.createElement('div');
+      content.className = 'font-mono text-xs p-2 min-w-[120px] font-bold text-emerald-700';
+      content.textContent = name;
+      L.popup().setLatLng(e.latlng).setContent(content).openOn(map);
+    });
+    layer.addTo(map);
+    return () => {
+      map.removeLayer(layer);
+    };
+  }, [map, layerId, color]);
+
+  return null;
+};
+
 // KML Layer Renderer
 const KMLLayerRenderer = ({ layers }) => {
   if (!layers || layers.length === 0) return null;
@@ -325,9 +371,14 @@ const KMLLayerRenderer = ({ layers }) => {
     });
   };
 
+  const visible = layers.filter(layer => layer.visible);
+
   return (
     <>
-      {layers.filter(layer => layer.visible).map((layer) => (
+      {visible.filter(layer => layer.tiled).flatMap((layer) => layer.layerIds.map((layerId) => (
+        <VectorTileOverlay key={`kml-tiles-${layerId}`} layerId={layerId} color={layer.color || '#3388ff'} />
+      )))}
+      {visible.filter(layer => !layer.tiled).map((layer) => (
         <GeoJSON
           key={`kml-${layer.id}-${layer.visible}`}
           data={{ type: 'FeatureCollection', features: layer.features }}
@@ -383,6 +434,14 @@ const HeatMapLayer = ({ patrols, visible }) => {
   return null;
 };
 
+// Reports zoom changes so trails can be requested at a matching simplification level
+const ZoomWatcher = ({ onZoomChange }) => {
+  useMapEvents({
+    zoomend: (e) => onZoomChange?.(e.target.getZoom())
+  });
+  return null;
+};
+
 export const MapDisplay = forwardRef(({ 
   patrols, 
   visiblePatrols,
@@ -398,7 +457,8 @@ export const MapDisplay = forwardRef(({
   onPatrolClick,
   showControls = true,
   hqId,
-  sosAlerts = []
+  sosAlerts = [],
+  onZoomChange
 }, ref) => {
   const mapCenter = [21.4272, 92.0058];
   const controllerRef = useRef(null);
@@ -504,6 +564,8 @@ export const MapDisplay = forwardRef(({
           patrols={patrols}
         />
 
+        <ZoomWatcher onZoomChange={onZoomChange} />
+
         {/* Heat Map Layer */}
         <HeatMapLayer patrols={patrols} visible={showHeatMap} />
 
@@ -530,12 +592,13 @@ export const MapDisplay = forwardRef(({
         {/* All trails when enabled */}
         {showTrails && allTrails && Array.isArray(allTrails) && allTrails.map((trailData) => {
           if (trailData.patrol_id === selectedPatrolId) return null;
-          if (!trailData.points || trailData.points.length === 0) return null;
+          const positions = trailPositions(trailData);
+          if (positions.length === 0) return null;
           const isFinished = trailData.status === 'finished';
           return (
             <PatrolTrail 
               key={trailData.patrol_id} 
-              trail={trailData.points} 
+              trail={positions} 
               color={isFinished ? '#6b7280' : '#22c55e'} 
               showMarkers={false}
             />
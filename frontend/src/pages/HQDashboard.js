@@ -18,6 +18,7 @@ import { SessionManager } from '@/components/hq/SessionManager';
 import { JitsiMeetModal } from '@/components/hq/JitsiMeetModal';
 import { SecureMessaging } from '@/components/hq/SecureMessaging';
 import { SOSAlertsPanel } from '@/components/hq/SOSAlerts';
+import { decodeTrail, trailPositions } from '@/utils/trailCodec';
 
 const API = `${process.env.REACT_APP_BACKEND_URL}/api`;
 const WS_URL = process.env.REACT_APP_BACKEND_URL?.replace('https://', 'wss://').replace('http://', 'ws://');
@@ -292,11 +293,15 @@ export const HQDashboard = () => {
   const reconnectTimeoutRef = useRef(null);
   const pollingIntervalRef = useRef(null);
   const fetchPatrolsRef = useRef(null);
+  const fetchSOSAlertsRef = useRef(null);
   const sosPollingRef = useRef(null);
   const [wsConnected, setWsConnected] = useState(false);
 
   // Ref for map control
   const mapRef = useRef(null);
+  const mapZoomRef = useRef(10);
+  const trailCursorRef = useRef(null);
+  const trailSessionRef = useRef(null);
 
   // WebSocket connection - using ref to avoid self-reference in useCallback
   const connectWebSocketRef = useRef(null);
@@ -358,19 +363,47 @@ export const HQDashboard = () => {
                     }
                   : p
               ));
+            } else if (data.type === 'patrol_locations') {
+              // Coalesced location updates: newest point per patrol since the last frame
+              const updates = new Map(data.updates.map(u => [u.patrol_id, u]));
+              setPatrols(prev => prev.map(p => {
+                const u = updates.get(p.id);
+                return u
+                  ? { 
+                      ...p, 
+                      latitude: u.latitude, 
+                      longitude: u.longitude, 
+                      last_update: u.timestamp,
+                      is_tracking: true
+                    }
+                  : p;
+              }));
             } else if (data.type === 'patrol_update') {
               // General patrol update
               setPatrols(prev => prev.map(p => p.id === data.patrol?.id ? { ...p, ...data.patrol } : p));
             } else if (data.type === 'sos_alert') {
-              // SOS alert
-              toast.error(`SOS ALERT from Patrol ${data.patrol_id}`, { duration: 10000 });
+              // SOS alert (auto_triggered: raised by the server-side inactivity monitor)
+              const label = data.auto_triggered ? 'AUTO SOS (inactivity)' : 'SOS ALERT';
+              toast.error(`${label} from Patrol ${data.patrol_id}`, { duration: 10000 });
+              fetchSOSAlertsRef.current?.();
               setNotifications(prev => [{
                 id: Date.now(),
-                message: `SOS ALERT: ${data.message}`,
+                message: `${label}: ${data.message}`,
                 level: 'critical',
                 timestamp: data.timestamp
               }, ...prev]);
               setStats(prev => ({ ...prev, notifications: (prev.notifications || 0) + 1 }));
+            } else if (data.type === 'geofence_event') {
+              // Area transition from the server-side geofence engine
+              const warning = data.event === 'exit' || data.event === 'out_of_area';
+              (warning ? toast.warning : toast.info)(data.message, { duration: warning ? 8000 : 4000 });
+              setNotifications(prev => [{
+                id: `${data.patrol_id}-${data.event}-${data.timestamp}`,
+                message: data.message,
+                level: warning ? 'warning' : 'info',
+                timestamp: data.timestamp
+              }, ...prev]);
+              setStats(prev => ({ ...prev, notifications: (prev.notifications || 0) + 1 }));
             } else if (data.type === 'notification') {
               setNotifications(prev => [data.notification, ...prev]);
               setStats(prev => ({ ...prev, notifications: (prev.notifications || 0) + 1 }));
@@ -551,13 +584,55 @@ export const HQDashboard = () => {
   const fetchAllTrails = useCallback(async () => {
     if (!hqId) return;
     try {
-      const response = await axios.get(`${API}/patrols/trails/all?hq_id=${hqId}&hours=24`);
-      setAllTrails(response.data);
+      // Server simplifies trails to the current zoom level; since=0 also returns a delta cursor.
+      // Trails arrive as encoded polylines and are decoded in MapDisplay.
+      const response = await axios.get(`${API}/patrols/trails/all?hq_id=${hqId}&hours=24&zoom=${mapZoomRef.current}&since=0&format=polyline`);
+      trailCursorRef.current = response.data.next_cursor;
+      trailSessionRef.current = response.data.session_date;
+      setAllTrails(response.data.trails);
     } catch (error) {
       console.error('Error fetching trails:', error);
     }
   }, [hqId]);
 
+  // Polling fallback: fetch only points stored since the last cursor and append them
+  const fetchTrailUpdates = useCallback(async () => {
+    if (!hqId) return;
+    if (!trailCursorRef.current) {
+      fetchAllTrails();
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/patrols/trails/all?hq_id=${hqId}&since=${trailCursorRef.current}`);
+      const { session_date, next_cursor, trails } = response.data;
+      if (session_date !== trailSessionRef.current) {
+        // New session day - start over with full trails
+        fetchAllTrails();
+        return;
+      }
+      trailCursorRef.current = next_cursor;
+      if (!trails.length) return;
+      setAllTrails(prev => {
+        const updates = new Map(trails.map(t => [t.patrol_id, t]));
+        const merged = prev.map(t => {
+          const update = updates.get(t.patrol_id);
+          if (!update) return t;
+          updates.delete(t.patrol_id);
+          return { ...t, status: update.status, encoded: undefined, points: [...trailPositions(t), ...update.points] };
+        });
+        return [...merged, ...updates.values()];
+      });
+    } catch (error) {
+      console.error('Error fetching trail updates:', error);
+    }
+  }, [hqId, fetchAllTrails]);
+
+  // Re-fetch trails at the new simplification level when the map zoom changes
+  const handleMapZoomChange = useCallback((zoom) => {
+    mapZoomRef.current = zoom;
+    fetchAllTrails();
+  }, [fetchAllTrails]);
+
   const fetchStats = useCallback(async () => {
     if (!hqId) return;
     try {
@@ -579,6 +654,11 @@ export const HQDashboard = () => {
     }
   }, [hqId]);
 
+  // Keep fetchSOSAlertsRef updated (WebSocket SOS frames refresh the list immediately)
+  useEffect(() => {
+    fetchSOSAlertsRef.current = fetchSOSAlerts;
+  }, [fetchSOSAlerts]);
+
   // Fetch unread message count
   const fetchUnreadCount = useCallback(async () => {
     if (!hqId) return;
@@ -628,9 +708,9 @@ export const HQDashboard = () => {
 
   const fetchTrail = useCallback(async (patrolId) => {
     try {
-      const response = await axios.get(`${API}/patrols/${patrolId}/trail?hours=24`);
-      if (response.data && response.data.points) {
-        setTrail(response.data.points.map(p => [p.latitude, p.longitude]));
+      const response = await axios.get(`${API}/patrols/${patrolId}/trail?hours=24&format=polyline`);
+      if (response.data && response.data.encoded) {
+        setTrail(decodeTrail(response.data.encoded).positions);
       }
     } catch (error) {
       console.error('Error fetching trail:', error);
@@ -664,7 +744,7 @@ export const HQDashboard = () => {
     const pollingInterval = setInterval(() => {
       if (wsRef.current?.readyState !== WebSocket.OPEN) {
         fetchPatrols();
-        fetchAllTrails();
+        fetchTrailUpdates();
       }
     }, 10000);
 
@@ -686,7 +766,7 @@ export const HQDashboard = () => {
         clearInterval(sosPollingRef.current);
       }
     };
-  }, [hqId, fetchPatrols, fetchStats, fetchNotifications, fetchFilterOptions, fetchAllTrails, fetchSOSAlerts, fetchUnreadCount]);
+  }, [hqId, fetchPatrols, fetchStats, fetchNotifications, fetchFilterOptions, fetchAllTrails, fetchTrailUpdates, fetchSOSAlerts, fetchUnreadCount]);
 
   // Handle patrol click from list - fly to map
   const handlePatrolClickFromList = (patrol) => {
@@ -1037,6 +1117,7 @@ export const HQDashboard = () => {
           onPatrolClick={handlePatrolClickFromMap}
           hqId={hqId}
           sosAlerts={sosAlerts}
+          onZoomChange={handleMapZoomChange}
         />
 
         {/* Floating Right Panel with Auto-hide */}
@@ -12,6 +12,7 @@ import {
 } from 'lucide-react';
 
 const API = process.env.REACT_APP_BACKEND_URL || 'http://localhost:8001';
+const LOCATION_SYNC_CHUNK = 200; // Points per offline-queue batch upload
 
 // Background and Logo URLs
 const BACKGROUND_IMAGE = 'https://customer-assets.emergentagent.com/job_2d9837ea-ce33-42ad-9eb8-91e7ec7df4fd/artifacts/lt1jykmh_IMG_8817.PNG';
@@ -435,17 +436,30 @@ export const PatrolCommander = () => {
     
     const queue = [...offlineQueue];
     setOfflineQueue([]);
-    
-    for (const item of queue) {
+
+    // Locations go up in chunks with their original device timestamps
+    const locations = queue.filter(item => item.type === 'location');
+    for (let i = 0; i < locations.length; i += LOCATION_SYNC_CHUNK) {
+      const chunk = locations.slice(i, i + LOCATION_SYNC_CHUNK);
       try {
-        if (item.type === 'location') {
-          await fetch(`${API}/api/mqtt/location/${patrolId}?lat=${item.lat}&lng=${item.lng}`, { method: 'POST' });
-        }
+        const response = await fetch(`${API}/api/mqtt/location/${patrolId}/batch`, {
+          method: 'POST',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({
+            points: chunk.map(item => ({
+              latitude: item.lat,
+              longitude: item.lng,
+              timestamp: item.timestamp || new Date().toISOString()
+            }))
+          })
+        });
+        // 4xx means the chunk itself is bad; only retry on server/network errors
+        if (response.status >= 500) throw new Error(`Batch upload failed: ${response.status}`);
       } catch (error) {
-        setOfflineQueue(prev => [...prev, item]);
+        setOfflineQueue(prev => [...prev, ...chunk]);
       }
     }
-    
+
     if (queue.length > 0) {
       toast.success(`Synced ${queue.length} updates`);
       setLastSync(new Date().toISOString());
@@ -0,0 +1,62 @@
+// Decoder for the compact trail format (`format=polyline`) served by the trail endpoints.
+// Coordinates are a Google encoded polyline; timestamps are delta-encoded epoch seconds.
+
+// Arithmetic instead of bitwise ops: absolute timestamps overflow 32-bit integers
+const decodeSigned = (encoded) => {
+  const values = [];
+  let index = 0;
+  while (index < encoded.length) {
+    let result = 0;
+    let factor = 1;
+    let byte;
+    do {
+      byte = encoded.charCodeAt(index++) - 63;
+      result += (byte & 0x1f) * factor;
+      factor *= 32;
+    } while (byte >= 0x20);
+    values.push(result % 2 === 1 ? -(result + 1) / 2 : result / 2);
+  }
+  return values;
+};
+
+export const decodePolyline = (encoded, precision = 5) => {
+  const factor = Math.pow(10, precision);
+  const deltas = decodeSigned(encoded || '');
+  const positions = [];
+  let lat = 0;
+  let lng = 0;
+  for (let i = 0; i + 1 < deltas.length; i += 2) {
+    lat += deltas[i];
+    lng += deltas[i + 1];
+    positions.push([lat / factor, lng / factor]);
+  }
+  return positions;
+};
+
+export const decodeDeltas = (encoded) => {
+  let current = 0;
+  return decodeSigned(encoded || '').map(delta => (current += delta));
+};
+
+// Full decode: { positions: [[lat, lng], ...], timestamps: [ISO string, ...] }
+export const decodeTrail = (encoded) => {
+  if (!encoded) return { positions: [], timestamps: [] };
+  const positions = decodePolyline(encoded.polyline, encoded.precision);
+  const timestamps = encoded.timestamps
+    ? decodeDeltas(encoded.timestamps).map(s => new Date(s * 1000).toISOString())
+    : [];
+  return { positions, timestamps };
+};
+
+// Map-ready positions for a trail entry that has either `points` or `encoded`.
+// Decoded results are cached per trail object so re-renders do not decode again.
+const positionsCache = new WeakMap();
+
+export const trailPositions = (trailData) => {
+  if (!trailData) return [];
+  if (trailData.points) return trailData.points;
+  if (!positionsCache.has(trailData)) {
+    positionsCache.set(trailData, decodeTrail(trailData.encoded).positions);
+  }
+  return positionsCache.get(trailData);
+};